@@ -1,5 +1,8 @@
 import logging
+import multiprocessing as mp
 import os
+import tempfile
+import uuid
 
 import numpy as np
 import rasterio
@@ -7,13 +10,30 @@ from rasterio.crs import CRS
 from rasterio.features import rasterize
 from rasterio.warp import calculate_default_transform
 from rasterio.windows import bounds
+from satlomasproc.chips.manifest import (
+    CHIP_FAILED,
+    CHIP_LOW_CONTRAST,
+    CHIP_WRITTEN,
+    ChipManifest,
+    params_hash,
+    raster_key,
+)
+from satlomasproc.chips.shards import ShardWriter, write_latest_key
 from satlomasproc.chips.utils import (
+    INDEX_FORMATS,
+    StripReader,
+    filter_windows_by_aoi,
+    get_rasters_percentiles,
+    is_low_contrast,
     rescale_intensity,
     sliding_windows,
     write_chips_geojson,
+    write_chips_index,
 )
+from satlomasproc.raster import write_raster
 from shapely.geometry import box, shape
 from shapely.ops import transform, unary_union
+from shapely.strtree import STRtree
 from shapely.validation import explain_validity
 from skimage import exposure
 from skimage.io import imsave
@@ -38,6 +58,35 @@ def get_shape(feature):
         return None
 
 
+class IndexedShapes(list):
+    """
+    List of shapes with an STRtree spatial index, to quickly query the shapes
+    that may intersect with a chip window.
+
+    The index is not pickled (older Shapely versions do not support it), and
+    it is rebuilt lazily on the first query.
+    """
+
+    def __init__(self, shapes=()):
+        super().__init__(shapes)
+        self._tree = STRtree(self) if self else None
+
+    def intersecting(self, shp):
+        """Return shapes whose bounding box intersects with +shp+"""
+        if not self:
+            return []
+        if getattr(self, "_tree", None) is None:
+            self._tree = STRtree(self)
+        hits = self._tree.query(shp)
+        # Shapely >= 2.0 returns indexes instead of geometries
+        if len(hits) and not hasattr(hits[0], "geom_type"):
+            hits = [self[k] for k in hits]
+        return list(hits)
+
+    def __getstate__(self):
+        return {}
+
+
 def mask_from_polygons(polygons, *, win, t):
     transform = rasterio.windows.transform(win, t)
     if polygons is None or len(polygons) == 0:
@@ -60,22 +109,42 @@ def multiband_chip_mask_by_classes(
     window_shape=None,
     metadata={},
 ):
-    multi_band_mask = []
     if polys_dict is None and label_path is not None:
         polys_dict = classify_polygons(label_path, label_property, classes)
+
+    multi_band_mask = chip_mask_by_classes(
+        classes, transform, window, polys_dict, window_shape=window_shape
+    )
+
+    write_mask_tif(
+        multi_band_mask,
+        mask_path,
+        window=window,
+        transform=transform,
+        metadata=metadata,
+    )
+
+
+def chip_mask_by_classes(classes, transform, window, polys_dict, window_shape=None):
+    """Return a list of masks of +window+, one for each class in +classes+"""
     if window_shape is None:
         window_shape = box(*rasterio.windows.bounds(window, transform))
 
+    multi_band_mask = []
     for k in classes:
-        multi_band_mask.append(
-            mask_from_polygons(polys_dict[k], win=window, t=transform)
-        )
+        polys = polys_dict[k]
+        if isinstance(polys, IndexedShapes):
+            polys = polys.intersecting(window_shape)
+        multi_band_mask.append(mask_from_polygons(polys, win=window, t=transform))
+    return multi_band_mask
 
+
+def write_mask_tif(mask, mask_path, cog=None, *, window, transform, metadata):
     kwargs = metadata.copy()
     kwargs.update(
         driver="GTiff",
         dtype=rasterio.uint8,
-        count=len(multi_band_mask),
+        count=len(mask),
         nodata=0,
         transform=rasterio.windows.transform(window, transform),
         width=window.width,
@@ -83,9 +152,40 @@ def multiband_chip_mask_by_classes(
     )
 
     os.makedirs(os.path.dirname(mask_path), exist_ok=True)
-    with rasterio.open(mask_path, "w", **kwargs) as dst:
-        for i in range(len(multi_band_mask)):
-            dst.write(multi_band_mask[i], i + 1)
+    write_raster(np.asarray(mask), mask_path, cog=cog, profile=kwargs)
+
+
+def burn_class_masks(polys_dict, classes, *, windows, transform, path):
+    """
+    Rasterize each class once over the extent of +windows+, into a
+    memory-mapped .npy file at +path+ with one band per class.
+
+    Returns the (row, col) offset of the burned extent, needed to slice chip
+    masks from it later.
+    """
+    row_off = min(w.row_off for w in windows)
+    col_off = min(w.col_off for w in windows)
+    height = max(w.row_off + w.height for w in windows) - row_off
+    width = max(w.col_off + w.width for w in windows) - col_off
+    extent = rasterio.windows.Window(col_off, row_off, width, height)
+    extent_transform = rasterio.windows.transform(extent, transform)
+
+    _logger.info("Burn %d classes over extent %s", len(classes), extent)
+    masks = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.uint8, shape=(len(classes), height, width)
+    )
+    for i, k in enumerate(tqdm(classes)):
+        if polys_dict[k]:
+            rasterize(
+                polys_dict[k],
+                out=masks[i],
+                default_value=255,
+                transform=extent_transform,
+            )
+    masks.flush()
+    del masks
+
+    return row_off, col_off
 
 
 def classify_polygons(labels, label_property, classes):
@@ -126,7 +226,7 @@ def prepare_label_shapes(
 ):
     if mask_type == "class":
         polys_dict = classify_polygons(labels, label_property, classes)
-        return polys_dict
+        return {k: IndexedShapes(polys) for k, polys in polys_dict.items()}
     else:
         raise RuntimeError(f"mask type '{mask_type}' not supported")
 
@@ -147,11 +247,42 @@ def extract_chips(
     skip_existing=True,
     within=False,
     dry_run=False,
+    workers=1,
+    read_mode="window",
+    mask_mode="window",
+    index_format="geojson",
+    manifest=False,
+    stats_path=None,
+    output_format="files",
+    shard_size=1024,
+    cog=None,
     *,
     size,
     step_size,
     output_dir,
 ):
+    """
+    Extract chips from all +rasters+ into +output_dir+
+
+    With +output_format+ 'files', each chip and mask is written as a separate
+    file, in images/ and masks/.  With 'npy', chips and masks are written into
+    memory-mappable .npy shards of +shard_size+ chips, in shards/ (see
+    satlomasproc.chips.shards).  If +cog+ options are given, chip files are
+    written as tiled, compressed COGs (see satlomasproc.raster).
+
+    With +rescale_mode+ 'raster-percentiles', percentiles in +rescale_range+
+    are calculated once per raster, instead of once per chip, and all chips
+    of a raster are rescaled with the same values.  With 'global-percentiles',
+    percentiles are calculated once from all rasters together.  Percentiles
+    are cached in a JSON file at +stats_path+ (defaults to 'stats.json' in
+    +output_dir+), which can be reused for extracting prediction chips with
+    the same radiometry as training chips.
+
+    If +manifest+ is true, the status of each chip is tracked in a SQLite
+    manifest in +output_dir+, and reruns only extract the chips that were not
+    written (or skipped for low contrast) before with the same parameters,
+    rasters and labels.
+    """
     if aoi:
         _logger.info("Prepare AOI shape")
         aoi_poly = prepare_aoi_shape(aoi)
@@ -166,6 +297,21 @@ def extract_chips(
     else:
         polys_dict = None
 
+    band_ranges = {}
+    if rescale_mode in ("raster-percentiles", "global-percentiles"):
+        lower_cut, upper_cut = rescale_range
+        band_ranges = get_rasters_percentiles(
+            rasters,
+            lower_cut=lower_cut,
+            upper_cut=upper_cut,
+            group=rescale_mode == "global-percentiles",
+            stats_path=stats_path or os.path.join(output_dir, "stats.json"),
+        )
+
+    chip_manifest = None
+    if manifest and not dry_run:
+        chip_manifest = ChipManifest(os.path.join(output_dir, "manifest.sqlite"))
+
     for raster in tqdm(rasters):
         extract_chips_from_raster(
             raster,
@@ -186,8 +332,21 @@ def extract_chips(
             aoi_poly=aoi_poly,
             polys_dict=polys_dict,
             dry_run=dry_run,
+            workers=workers,
+            read_mode=read_mode,
+            mask_mode=mask_mode,
+            index_format=index_format,
+            skip_existing=skip_existing,
+            manifest=chip_manifest,
+            band_ranges=band_ranges.get(raster),
+            output_format=output_format,
+            shard_size=shard_size,
+            cog=cog,
         )
 
+    if chip_manifest:
+        chip_manifest.close()
+
 
 def extract_chips_from_raster(
     raster,
@@ -206,16 +365,88 @@ def extract_chips_from_raster(
     aoi_poly=None,
     polys_dict=None,
     dry_run=False,
+    workers=1,
+    read_mode="window",
+    mask_mode="window",
+    index_format="geojson",
+    manifest=None,
+    band_ranges=None,
+    output_format="files",
+    shard_size=1024,
+    cog=None,
     *,
     size,
     step_size,
     output_dir,
 ):
+    """
+    Extract chips from +raster+, and optionally mask chips from +polys_dict+
+
+    A GeoJSON index of chips is written if +write_geojson+ is true.  Use
+    +index_format+ 'gpkg' or 'fgb' to write it as a spatially indexed
+    GeoPackage or FlatGeobuf file instead.
+
+    With +mask_mode+ 'window', labels are rasterized for each chip window.
+    With 'raster', each class is rasterized once over the extent of all
+    windows, into a temporary memory-mapped array, and mask chips are sliced
+    from it.
+
+    If +band_ranges+ is given, it must be a list of (min, max) input ranges
+    for each band of +raster+ (e.g. precomputed percentiles).  Chips are then
+    rescaled with these ranges, instead of +rescale_mode+ and +rescale_range+.
+
+    If a ChipManifest is given in +manifest+, windows already extracted with
+    the same parameters are skipped, and the raster is skipped entirely if a
+    previous run with the same parameters (and AOI) completed without errors.
+    """
 
     basename, _ = os.path.splitext(os.path.basename(raster))
 
-    masks_folder = os.path.join(output_dir, "masks")
-    image_folder = os.path.join(output_dir, "images")
+    # Shards of runs with different parameters are written in different
+    # directories, and each run uses its own shard names.  Band ranges are not
+    # part of the key, so that all rasters of a run share the same dataset.
+    shard_key = params_hash(
+        size=size,
+        step_size=step_size,
+        bands=bands,
+        rescale_mode=rescale_mode,
+        rescale_range=rescale_range,
+        labels=labels,
+        label_property=label_property,
+        mask_type=mask_type,
+        classes=classes,
+        crs=crs,
+    )[:12]
+    run_id = uuid.uuid4().hex[:8]
+
+    if manifest:
+        chip_params = params_hash(
+            size=size,
+            step_size=step_size,
+            bands=bands,
+            rescale_mode=rescale_mode,
+            rescale_range=rescale_range,
+            band_ranges=band_ranges,
+            type=type,
+            # Labels are keyed by path and modification time, so chips are
+            # extracted again if labels are edited
+            labels=raster_key(labels) if labels else None,
+            label_property=label_property,
+            mask_type=mask_type,
+            classes=classes,
+            crs=crs,
+            output_format=output_format,
+        )
+        run_params = params_hash(
+            chip_params=chip_params,
+            aoi=aoi_poly.wkb_hex if aoi_poly else None,
+            within=within,
+            write_geojson=write_geojson,
+            index_format=index_format,
+        )
+        if manifest.is_complete(raster, run_params):
+            _logger.info("%s was already extracted, skipping", raster)
+            return
 
     with rasterio.open(raster) as ds:
         _logger.info("Raster size: %s", (ds.width, ds.height))
@@ -228,6 +459,10 @@ def extract_chips_from_raster(
         if bands is None:
             bands = list(range(1, min(ds.count, 3) + 1))
 
+        if band_ranges is not None:
+            rescale_mode = "values"
+            rescale_range = [band_ranges[b - 1] for b in bands]
+
         _logger.info("Building windows")
         win_size = (size, size)
         win_step_size = (step_size, step_size)
@@ -236,93 +471,387 @@ def extract_chips_from_raster(
         )
         _logger.info("Total windows: %d", len(windows))
 
-        _logger.info("Building window shapes")
-        window_shapes = [
-            box(*rasterio.windows.bounds(w, ds.transform)) for w, _ in windows
-        ]
-        window_and_shapes = zip(windows, window_shapes)
-
         # Filter windows by AOI shape
         if aoi_poly:
             _logger.info("Filtering windows by AOI")
             _logger.info("Using \"%s\" function",
                          'within' if within else 'intersects')
-            filter_fn = lambda w, aoi: w.within(
-                aoi) if within else w.intersects(aoi)
-            window_and_shapes = [(w, s) for w, s in window_and_shapes
-                                 if filter_fn(s, aoi_poly)]
-            _logger.info("Total windows after filtering: %d",
-                         len(window_and_shapes))
+            idxs = filter_windows_by_aoi(
+                [w for w, _ in windows],
+                aoi_poly,
+                within=within,
+                transform=ds.transform,
+                cell_size=step_size,
+            )
+            windows = [windows[k] for k in idxs]
+            _logger.info("Total windows after filtering: %d", len(windows))
+
+        _logger.info("Building window shapes")
+        window_shapes = [
+            box(*rasterio.windows.bounds(w, ds.transform)) for w, _ in windows
+        ]
+        window_and_shapes = zip(windows, window_shapes)
 
         meta = ds.meta.copy()
         if crs:
             meta["crs"] = CRS.from_string(crs)
 
-        chips = []
-        for c, ((window, (i, j)), win_shape) in tqdm(
-            list(enumerate(window_and_shapes))
-        ):
-            _logger.debug("%s %s", window, (i, j))
+        # Store chip windows for generating GeoJSON later
+        window_and_shapes = list(window_and_shapes)
+        chips = [
+            (win_shape, (c, i, j))
+            for c, ((_, (i, j)), win_shape) in enumerate(window_and_shapes)
+        ]
 
-            img_path = os.path.join(image_folder, f"{basename}_{i}_{j}.{type}")
-            mask_path = os.path.join(masks_folder, f"{basename}_{i}_{j}.{type}")
+        pending = window_and_shapes
+        if manifest:
+            done = manifest.done_windows(raster, chip_params)
+            pending = [item for item in pending if item[0][1] not in done]
+            _logger.info(
+                "Windows already extracted: %d, pending: %d", len(done), len(pending)
+            )
 
-            # Store chip window for generating GeoJSON later
-            chip = (win_shape, (c, i, j))
-            chips.append(chip)
+        if not dry_run and pending:
+            kwargs = dict(
+                basename=basename,
+                output_dir=output_dir,
+                meta=meta,
+                bands=bands,
+                type=type,
+                rescale_mode=rescale_mode,
+                rescale_range=rescale_range,
+                labels=labels,
+                label_property=label_property,
+                mask_type=mask_type,
+                classes=classes,
+                polys_dict=polys_dict,
+                # With a manifest, pending chips are extracted again even if
+                # their files exist, as they may be from other parameters
+                skip_existing=skip_existing and not manifest,
+                read_mode=read_mode,
+                output_format=output_format,
+                shard_size=shard_size,
+                cog=cog,
+                shard_key=shard_key,
+                run_id=run_id,
+            )
+            if output_format == "npy":
+                write_latest_key(output_dir, shard_key)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                if labels and mask_type == "class" and mask_mode == "raster":
+                    keys = list(classes if classes is not None else polys_dict.keys())
+                    masks_path = os.path.join(tmpdir, "masks.npy")
+                    masks_offset = burn_class_masks(
+                        polys_dict,
+                        keys,
+                        windows=[w for (w, _), _ in pending],
+                        transform=ds.transform,
+                        path=masks_path,
+                    )
+                    kwargs.update(masks_path=masks_path, masks_offset=masks_offset)
+                elif mask_mode not in ("window", "raster"):
+                    raise RuntimeError(f"unknown mask_mode {mask_mode}")
+
+                on_chip = None
+                if manifest:
+                    on_chip = lambda i, j, status: manifest.add(
+                        raster, chip_params, i, j, status
+                    )
 
-            if dry_run:
-                continue
+                if workers > 1:
+                    _extract_chips_parallel(
+                        raster, pending, workers=workers, on_chip=on_chip, **kwargs
+                    )
+                else:
+                    extract_chips_from_windows(
+                        ds, pending, progress=True, on_chip=on_chip, **kwargs
+                    )
 
-            if (
-                skip_existing
-                and os.path.exists(img_path)
-                and (not labels or os.path.exists(mask_path))
-            ):
-                continue
+        if write_geojson:
+            driver, ext = INDEX_FORMATS[index_format]
+            index_path = os.path.join(output_dir, "{}.{}".format(basename, ext))
+            if index_format == "geojson":
+                write_chips_geojson(
+                    index_path,
+                    chips,
+                    type=type,
+                    crs=str(meta["crs"]),
+                    basename=basename,
+                )
+            else:
+                write_chips_index(
+                    index_path,
+                    chips,
+                    type=type,
+                    crs=str(meta["crs"]),
+                    basename=basename,
+                    driver=driver,
+                )
 
-            # Extract chip image from original image
-            img = ds.read(window=window)
-            img = np.nan_to_num(img)
-            img = np.array([img[b - 1, :, :] for b in bands])
+    if manifest and not dry_run:
+        manifest.flush()
+        failed = manifest.count(raster, chip_params, CHIP_FAILED)
+        if failed:
+            _logger.warning("%d chips failed to be extracted from %s", failed, raster)
+        else:
+            manifest.mark_complete(raster, run_params)
 
-            # Rescale intensity (if needed)
-            if rescale_mode:
-                img = rescale_intensity(img, rescale_mode, rescale_range)
 
-            # Write chip image
-            if type == "tif":
-                image_was_saved = write_tif(
+def extract_chips_from_windows(
+    ds,
+    window_and_shapes,
+    rescale_mode=None,
+    rescale_range=None,
+    type="tif",
+    labels=None,
+    label_property="class",
+    mask_type="class",
+    classes=None,
+    polys_dict=None,
+    skip_existing=True,
+    read_mode="window",
+    masks_path=None,
+    masks_offset=None,
+    progress=False,
+    on_chip=None,
+    output_format="files",
+    shard_size=1024,
+    cog=None,
+    shard_key=None,
+    run_id=None,
+    *,
+    basename,
+    output_dir,
+    meta,
+    bands,
+):
+    """
+    Extract chips (and masks) from an open dataset for a list of windows
+
+    With +read_mode+ 'window', each chip is read on its own.  With 'strip',
+    windows must be sorted by row, and chips are sliced from a horizontal
+    strip buffer so that overlapping windows do not decode the same pixels
+    more than once.
+
+    If +masks_path+ is given, mask chips are sliced from that memory-mapped
+    array of burned classes (see +burn_class_masks+), whose first pixel is at
+    +masks_offset+ (row, col), instead of rasterizing labels for each chip.
+
+    If +on_chip+ is given, it is called with (i, j, status) for each window,
+    and errors on a single chip are logged and reported as failed instead of
+    being raised.  With +output_format+ 'npy', written chips are reported
+    only once their shard is written.  Shards are written in a directory for
+    +shard_key+ (see ShardWriter), with names prefixed by +run_id+.
+    """
+    masks_folder = os.path.join(output_dir, "masks")
+    image_folder = os.path.join(output_dir, "images")
+
+    if read_mode == "strip":
+        read_window = StripReader(
+            ds, [w for (w, _), _ in window_and_shapes], indexes=bands
+        ).read
+    elif read_mode == "window":
+        read_window = lambda window: ds.read(bands, window=window)
+    else:
+        raise RuntimeError(f"unknown read_mode {read_mode}")
+
+    burned_masks = np.load(masks_path, mmap_mode="r") if masks_path else None
+
+    writer = None
+    if output_format == "npy":
+        (_, (i, j)), _ = window_and_shapes[0]
+        writer = ShardWriter(
+            output_dir,
+            shard_size=shard_size,
+            prefix=f"{basename}_{run_id}_{i}_{j}",
+            crs=meta["crs"],
+            key=shard_key,
+        )
+    elif output_format != "files":
+        raise RuntimeError(f"unknown output_format {output_format}")
+    # Names of chips in shards already written, and chips pending to be
+    # reported until their shard is written
+    flushed = []
+    deferred = {}
+
+    def chip_mask(window, win_shape):
+        if burned_masks is not None:
+            mask_i = window.row_off - masks_offset[0]
+            mask_j = window.col_off - masks_offset[1]
+            return burned_masks[
+                :,
+                mask_i : mask_i + window.height,
+                mask_j : mask_j + window.width,
+            ]
+        elif mask_type == "class":
+            keys = classes if classes is not None else polys_dict.keys()
+            return chip_mask_by_classes(
+                keys, ds.transform, window, polys_dict, window_shape=win_shape
+            )
+
+    def extract_chip(window, win_shape, name, img_path, mask_path):
+        # Extract chip image (only selected bands) from original image
+        img = read_window(window)
+        if img.dtype.kind == "f":
+            img = np.nan_to_num(img, copy=False)
+
+        # Rescale intensity (if needed)
+        if rescale_mode:
+            img = rescale_intensity(img, rescale_mode, rescale_range)
+
+        # Add chip image and mask to current shard
+        if writer is not None:
+            if is_low_contrast(img):
+                return False
+            mask = chip_mask(window, win_shape) if labels else None
+            flushed.extend(
+                writer.add(
+                    name,
                     img,
-                    img_path,
+                    mask,
+                    transform=rasterio.windows.transform(window, ds.transform),
+                )
+            )
+            return True
+
+        # Write chip image
+        if type == "tif":
+            image_was_saved = write_tif(
+                img,
+                img_path,
+                window=window,
+                meta=meta.copy(),
+                transform=ds.transform,
+                bands=bands,
+                cog=cog,
+            )
+        else:
+            image_was_saved = write_image(img, img_path)
+
+        # If there are labels, and chip was extracted succesfully, generate a mask
+        if image_was_saved and labels:
+            mask = chip_mask(window, win_shape)
+            if mask is not None:
+                write_mask_tif(
+                    mask,
+                    mask_path,
                     window=window,
-                    meta=meta.copy(),
                     transform=ds.transform,
-                    bands=bands,
+                    metadata=meta,
+                    cog=cog,
                 )
-            else:
-                image_was_saved = write_image(img, img_path)
-
-            # If there are labels, and chip was extracted succesfully, generate a mask
-            if image_was_saved and labels:
-                if mask_type == "class":
-                    keys = classes if classes is not None else polys_dict.keys()
-                    multiband_chip_mask_by_classes(
-                        classes=keys,
-                        transform=ds.transform,
-                        window=window,
-                        window_shape=win_shape,
-                        polys_dict=polys_dict,
-                        metadata=meta,
-                        mask_path=mask_path,
-                        label_property=label_property,
-                    )
 
-        if write_geojson:
-            geojson_path = os.path.join(output_dir, "{}.geojson".format(basename))
-            write_chips_geojson(
-                geojson_path, chips, type=type, crs=str(meta["crs"]), basename=basename
-            )
+        return image_was_saved
+
+    def report_flushed():
+        if on_chip:
+            for name in flushed:
+                i, j = deferred.pop(name)
+                on_chip(i, j, CHIP_WRITTEN)
+        flushed.clear()
+
+    for (window, (i, j)), win_shape in tqdm(window_and_shapes, disable=not progress):
+        _logger.debug("%s %s", window, (i, j))
+
+        name = f"{basename}_{i}_{j}"
+        img_path = os.path.join(image_folder, f"{name}.{type}")
+        mask_path = os.path.join(masks_folder, f"{name}.{type}")
+
+        if (
+            writer is None
+            and skip_existing
+            and os.path.exists(img_path)
+            and (not labels or os.path.exists(mask_path))
+        ):
+            status = CHIP_WRITTEN
+        elif on_chip is None:
+            extract_chip(window, win_shape, name, img_path, mask_path)
+            flushed.clear()
+            continue
+        else:
+            try:
+                saved = extract_chip(window, win_shape, name, img_path, mask_path)
+                status = CHIP_WRITTEN if saved else CHIP_LOW_CONTRAST
+            except Exception:
+                _logger.exception("Failed to extract chip %s from window %s", (i, j), window)
+                status = CHIP_FAILED
+
+        if writer is not None and status == CHIP_WRITTEN:
+            deferred[name] = (i, j)
+            report_flushed()
+        elif on_chip:
+            on_chip(i, j, status)
+
+    if writer is not None:
+        flushed.extend(writer.flush())
+        report_flushed()
+
+
+# Per-process state for parallel extraction. Each worker opens its own dataset
+# handle once, and receives the (possibly large) label shapes only once.
+_worker_state = {}
+
+
+def _init_extract_worker(raster, kwargs, record_statuses):
+    _worker_state["ds"] = rasterio.open(raster)
+    _worker_state["kwargs"] = kwargs
+    _worker_state["record_statuses"] = record_statuses
+
+
+def _extract_chips_worker(window_and_shapes):
+    """
+    Extract chips of a row band.  Returns the number of windows, and the
+    statuses of chips if they are being recorded (failed chips are then
+    reported instead of raised, like in the serial path).
+    """
+    statuses = []
+    on_chip = None
+    if _worker_state["record_statuses"]:
+        on_chip = lambda i, j, status: statuses.append((i, j, status))
+    extract_chips_from_windows(
+        _worker_state["ds"],
+        window_and_shapes,
+        on_chip=on_chip,
+        **_worker_state["kwargs"],
+    )
+    return len(window_and_shapes), statuses
+
+
+def _row_bands(window_and_shapes, n):
+    """Split windows into at most +n+ groups of consecutive rows"""
+    rows = {}
+    for item in window_and_shapes:
+        (_, (i, _)), _ = item
+        rows.setdefault(i, []).append(item)
+    rows = list(rows.values())
+    band_size = max(1, int(np.ceil(len(rows) / n)))
+    return [
+        [item for row in rows[k : k + band_size] for item in row]
+        for k in range(0, len(rows), band_size)
+    ]
+
+
+def _extract_chips_parallel(
+    raster, window_and_shapes, on_chip=None, *, workers, **kwargs
+):
+    # Use more bands than workers, so that slow bands (e.g. with many labels)
+    # do not leave the other workers idle.
+    bands = _row_bands(window_and_shapes, workers * 4)
+    _logger.info("Extract chips in %d row bands with %d workers", len(bands), workers)
+    with mp.Pool(
+        workers,
+        initializer=_init_extract_worker,
+        initargs=(raster, kwargs, on_chip is not None),
+    ) as pool:
+        with tqdm(total=len(window_and_shapes)) as pbar:
+            # Errors of a worker (if chip statuses are not recorded) are
+            # raised here, as they are in the serial path
+            results = pool.imap_unordered(_extract_chips_worker, bands)
+            for n_windows, statuses in results:
+                if on_chip:
+                    for i, j, status in statuses:
+                        on_chip(i, j, status)
+                pbar.update(n_windows)
 
 
 def write_image(img, path, percentiles=None):
@@ -335,8 +864,9 @@ def write_image(img, path, percentiles=None):
     return True
 
 
-def write_tif(img, path, *, window, meta, transform, bands):
-    if exposure.is_low_contrast(img):
+def write_tif(img, path, cog=None, *, window, meta, transform, bands):
+    """Write +img+ chip (with +bands+ already selected) if it is not low contrast"""
+    if is_low_contrast(img):
         return False
     os.makedirs(os.path.dirname(path), exist_ok=True)
     meta.update(
@@ -349,7 +879,5 @@ def write_tif(img, path, *, window, meta, transform, bands):
             "count": len(bands),
         }
     )
-    img = np.array([img[b - 1, :, :] for b in bands])
-    with rasterio.open(path, "w", **meta) as dst:
-        dst.write(img)
+    write_raster(img, path, cog=cog, profile=meta)
     return True
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+_logger = logging.getLogger(__name__)
+
+CHIP_WRITTEN = "written"
+CHIP_LOW_CONTRAST = "low_contrast"
+CHIP_FAILED = "failed"
+
+# Chips with these statuses are not extracted again on reruns
+DONE_STATUSES = (CHIP_WRITTEN, CHIP_LOW_CONTRAST)
+
+
+def params_hash(**params):
+    """Return a stable hash of extraction parameters"""
+    data = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def raster_key(raster):
+    """
+    Return the (path, mtime) pair that identifies a version of a raster (or
+    of any other file, e.g. labels)
+    """
+    return os.path.abspath(raster), os.path.getmtime(raster)
+
+
+class ChipManifest:
+    """
+    SQLite manifest of extracted chips, stored in an output directory.
+
+    Chips are keyed by raster path and modification time, a hash of the
+    parameters that affect chip contents, and window position.  Each chip has
+    a status: written, skipped because of low contrast, or failed.
+
+    Rasters can also be marked as complete for a hash of run parameters
+    (e.g. chip parameters plus AOI), so that a rerun can skip them entirely.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = []
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chips (
+                raster TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                params TEXT NOT NULL,
+                i INTEGER NOT NULL,
+                j INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                PRIMARY KEY (raster, mtime, params, i, j)
+            );
+            CREATE TABLE IF NOT EXISTS rasters (
+                raster TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                params TEXT NOT NULL,
+                PRIMARY KEY (raster, mtime, params)
+            );
+            """
+        )
+
+    def done_windows(self, raster, params):
+        """Return the set of (i, j) windows already extracted from +raster+"""
+        self.flush()
+        path, mtime = raster_key(raster)
+        rows = self.conn.execute(
+            "SELECT i, j FROM chips WHERE raster = ? AND mtime = ? AND params = ?"
+            " AND status IN (%s)" % ", ".join("?" for _ in DONE_STATUSES),
+            (path, mtime, params, *DONE_STATUSES),
+        )
+        return set(rows)
+
+    def count(self, raster, params, status):
+        self.flush()
+        path, mtime = raster_key(raster)
+        (n,) = self.conn.execute(
+            "SELECT COUNT(*) FROM chips WHERE raster = ? AND mtime = ? AND params = ?"
+            " AND status = ?",
+            (path, mtime, params, status),
+        ).fetchone()
+        return n
+
+    def add(self, raster, params, i, j, status):
+        """Record the status of a chip.  Records are written in batches."""
+        path, mtime = raster_key(raster)
+        self._pending.append((path, mtime, params, i, j, status))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chips VALUES (?, ?, ?, ?, ?, ?)", self._pending
+            )
+        self._pending = []
+
+    def is_complete(self, raster, params):
+        path, mtime = raster_key(raster)
+        row = self.conn.execute(
+            "SELECT 1 FROM rasters WHERE raster = ? AND mtime = ? AND params = ?",
+            (path, mtime, params),
+        ).fetchone()
+        return row is not None
+
+    def mark_complete(self, raster, params):
+        self.flush()
+        path, mtime = raster_key(raster)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rasters VALUES (?, ?, ?)", (path, mtime, params)
+            )
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,177 @@
+import csv
+import logging
+import os
+from glob import glob
+
+import numpy as np
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+_logger = logging.getLogger(__name__)
+
+INDEX_FIELDS = ["name", "shard", "position", "width", "height", "crs", "transform"]
+
+# File in the shards directory with the key of the last extraction
+LATEST_FILE = "LATEST"
+
+
+class ShardWriter:
+    """
+    Writes chips (and masks) into .npy shards of up to +shard_size+ chips,
+    inside 'shards/<key>' in +output_dir+, where +key+ identifies the
+    extraction parameters, so that runs with different parameters do not
+    overwrite nor mix with each other.  +prefix+ should be unique for each
+    run and writer (e.g. raster name, run id and first window).
+
+    Each shard is made of '<prefix>_<n>.images.npy' with an array of shape
+    (N, bands, height, width), an optional '<prefix>_<n>.masks.npy' with an
+    array of shape (N, classes, height, width), and a '<prefix>_<n>.csv'
+    index table with the name, position in the shard and geotransform of each
+    chip.  The index table is written last, so only complete shards are
+    listed by ChipShardDataset.
+    """
+
+    def __init__(self, output_dir, shard_size=1024, *, prefix, crs, key):
+        self.shards_dir = os.path.join(output_dir, "shards", key)
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.crs = CRS.from_user_input(crs).to_string() if crs else ""
+        self.n_shards = 0
+        self._reset()
+
+    def _reset(self):
+        self.names = []
+        self.images = []
+        self.masks = []
+        self.transforms = []
+
+    def add(self, name, image, mask=None, *, transform):
+        """
+        Add a chip to the current shard.  Returns the names of the chips
+        written, if the shard was full and got written, or an empty list.
+        """
+        self.names.append(name)
+        self.images.append(np.array(image))
+        if mask is not None:
+            self.masks.append(np.array(mask))
+        self.transforms.append(transform)
+        if len(self.names) >= self.shard_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """Write current shard, and return the names of the chips written"""
+        if not self.names:
+            return []
+
+        os.makedirs(self.shards_dir, exist_ok=True)
+        shard = f"{self.prefix}_{self.n_shards}"
+        base_path = os.path.join(self.shards_dir, shard)
+        np.save(f"{base_path}.images.npy", np.stack(self.images))
+        if self.masks:
+            np.save(f"{base_path}.masks.npy", np.stack(self.masks))
+
+        height, width = self.images[0].shape[1:]
+        with open(f"{base_path}.csv", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(INDEX_FIELDS)
+            for k, (name, t) in enumerate(zip(self.names, self.transforms)):
+                writer.writerow(
+                    [name, shard, k, width, height, self.crs, " ".join(map(str, t[:6]))]
+                )
+
+        names = self.names
+        self.n_shards += 1
+        self._reset()
+        return names
+
+
+def write_latest_key(output_dir, key):
+    """Record +key+ as the key of the last extraction into +output_dir+"""
+    shards_dir = os.path.join(output_dir, "shards")
+    os.makedirs(shards_dir, exist_ok=True)
+    with open(os.path.join(shards_dir, LATEST_FILE), "w") as f:
+        f.write(key)
+
+
+class ChipShardDataset:
+    """
+    Reads chips written by ShardWriter from the 'shards/<key>' directory of
+    +path+.  By default, +key+ is the key of the last extraction.
+
+    Only shards with the same extraction parameters are read.  If a chip is
+    in more than one shard (e.g. it was extracted again on a rerun), it is
+    read from the most recent one.
+
+    Shards are memory-mapped, so +image+ and +mask+ return views of the files
+    without copying nor decoding.
+    """
+
+    def __init__(self, path, key=None):
+        if key is None:
+            key = self.latest_key(path)
+        self.shards_dir = os.path.join(path, "shards", key)
+        index_paths = sorted(
+            glob(os.path.join(self.shards_dir, "*.csv")),
+            key=lambda p: (os.path.getmtime(p), p),
+        )
+        rows = {}
+        for index_path in index_paths:
+            with open(index_path, newline="") as f:
+                rows.update((r["name"], r) for r in csv.DictReader(f))
+        if not rows:
+            raise RuntimeError(f"{self.shards_dir} does not contain any shard")
+        self.rows = [rows[name] for name in sorted(rows)]
+        self.names = [r["name"] for r in self.rows]
+        self._arrays = {}
+
+    @staticmethod
+    def latest_key(path):
+        latest_path = os.path.join(path, "shards", LATEST_FILE)
+        if not os.path.exists(latest_path):
+            raise RuntimeError(f"{latest_path} not found, is {path} a shards dataset?")
+        with open(latest_path) as f:
+            return f.read().strip()
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "shards", LATEST_FILE))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _array(self, shard, kind):
+        key = (shard, kind)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(
+                os.path.join(self.shards_dir, f"{shard}.{kind}.npy"), mmap_mode="r"
+            )
+        return self._arrays[key]
+
+    def image(self, k):
+        """Return image chip +k+, as an array of shape (bands, height, width)"""
+        row = self.rows[k]
+        return self._array(row["shard"], "images")[int(row["position"])]
+
+    def mask(self, k):
+        """Return mask chip +k+, as an array of shape (classes, height, width)"""
+        row = self.rows[k]
+        return self._array(row["shard"], "masks")[int(row["position"])]
+
+    def transform(self, k):
+        return Affine(*map(float, self.rows[k]["transform"].split()))
+
+    def profile(self, k):
+        """Return a GeoTIFF profile with the georeference of chip +k+"""
+        row = self.rows[k]
+        return dict(
+            driver="GTiff",
+            width=int(row["width"]),
+            height=int(row["height"]),
+            crs=CRS.from_user_input(row["crs"]) if row["crs"] else None,
+            transform=self.transform(k),
+        )
@@ -1,15 +1,19 @@
+import hashlib
 import json
 import logging
 import math
 import os
-from functools import partial
+from functools import lru_cache
 
 import numpy as np
 import pyproj
 import rasterio
+from rasterio.features import rasterize
+from rasterio.transform import Affine
 from rasterio.windows import Window
-from shapely.geometry import mapping
+from shapely.geometry import box, mapping
 from shapely.ops import transform
+from shapely.prepared import prep
 from skimage import exposure
 from tqdm import tqdm
 
@@ -20,9 +24,36 @@ __license__ = "apache-2.0"
 _logger = logging.getLogger(__name__)
 
 
+# Output formats of chip index files: (fiona driver, file extension)
+INDEX_FORMATS = {
+    "geojson": ("GeoJSON", "geojson"),
+    "gpkg": ("GPKG", "gpkg"),
+    "fgb": ("FlatGeobuf", "fgb"),
+}
+
+
+@lru_cache(maxsize=None)
+def get_transformer(from_crs, to_crs):
+    return pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+
 def reproject_shape(shp, from_crs, to_crs):
-    project = partial(pyproj.transform, pyproj.Proj(from_crs), pyproj.Proj(to_crs))
-    return transform(project, shp)
+    return transform(get_transformer(from_crs, to_crs).transform, shp)
+
+
+def reproject_chip_rings(chip_pairs, from_crs, to_crs):
+    """
+    Reproject exterior rings of all chip shapes in a single call to the
+    transformer.  Returns a list of (N, 2) arrays of coordinates.
+    """
+    rings = [np.asarray(chip.exterior.coords) for chip, _ in chip_pairs]
+    if from_crs.lower() == to_crs.lower():
+        return rings
+    coords = np.concatenate(rings)
+    xs, ys = get_transformer(from_crs, to_crs).transform(coords[:, 0], coords[:, 1])
+    coords = np.column_stack([xs, ys])
+    splits = np.cumsum([len(r) for r in rings])[:-1]
+    return np.split(coords, splits)
 
 
 def sliding_windows(size, step_size, width, height, whole=False):
@@ -38,6 +69,140 @@ def sliding_windows(size, step_size, width, height, whole=False):
             yield Window(j, i, real_w, real_h), (pos_i, pos_j)
 
 
+def _summed_area_table(a):
+    sat = np.zeros((a.shape[0] + 1, a.shape[1] + 1), dtype=np.int64)
+    sat[1:, 1:] = a.cumsum(axis=0).cumsum(axis=1)
+    return sat
+
+
+def _dilate(a):
+    res = a.copy()
+    res[1:, :] |= a[:-1, :]
+    res[:-1, :] |= a[1:, :]
+    res[:, 1:] |= res[:, :-1].copy()
+    res[:, :-1] |= res[:, 1:].copy()
+    return res
+
+
+def filter_windows_by_aoi(windows, aoi, within=False, *, transform, cell_size):
+    """
+    Return the indexes of +windows+ that intersect with (or are within) +aoi+
+
+    The AOI is rasterized once over a coarse grid of +cell_size+ pixels.
+    Windows whose cells are all inside the AOI, or that do not touch it at
+    all, are decided from the grid alone.  Only windows with cells crossed by
+    the AOI boundary are tested exactly, against a prepared geometry.
+    """
+    if not windows:
+        return []
+
+    row_offs = np.array([w.row_off for w in windows], dtype=np.int64)
+    col_offs = np.array([w.col_off for w in windows], dtype=np.int64)
+    row_ends = row_offs + np.array([w.height for w in windows], dtype=np.int64)
+    col_ends = col_offs + np.array([w.width for w in windows], dtype=np.int64)
+
+    # Range of grid cells covered by each window
+    r0, c0 = row_offs // cell_size, col_offs // cell_size
+    r1, c1 = -(-row_ends // cell_size), -(-col_ends // cell_size)
+    grid_shape = (int(r1.max()), int(c1.max()))
+    grid_transform = transform * Affine.scale(cell_size)
+
+    touched = rasterize(
+        [aoi], out_shape=grid_shape, transform=grid_transform, all_touched=True
+    ).astype(bool)
+    # Dilate boundary cells by one cell, to be safe against precision issues
+    # when the boundary runs exactly along cell edges.
+    boundary = rasterize(
+        [aoi.boundary], out_shape=grid_shape, transform=grid_transform, all_touched=True
+    ).astype(bool)
+    boundary = _dilate(boundary)
+
+    def count(sat):
+        return sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+
+    n_cells = (r1 - r0) * (c1 - c0)
+    n_boundary = count(_summed_area_table(boundary))
+    n_touched = count(_summed_area_table(touched & ~boundary))
+
+    inside = (n_boundary == 0) & (n_touched == n_cells)
+    outside = (n_boundary == 0) & (n_touched == 0)
+    undecided = np.flatnonzero(~(inside | outside))
+    _logger.info(
+        "AOI grid: %d windows inside, %d outside, %d to test",
+        inside.sum(),
+        outside.sum(),
+        len(undecided),
+    )
+
+    prepared_aoi = prep(aoi)
+    test_fn = prepared_aoi.contains if within else prepared_aoi.intersects
+    for k in undecided:
+        shp = box(*rasterio.windows.bounds(windows[k], transform))
+        inside[k] = test_fn(shp)
+
+    return np.flatnonzero(inside).tolist()
+
+
+class StripReader:
+    """
+    Reads windows from a dataset through a buffer of full horizontal strips
+
+    The strip spans the columns of all +windows+, and is as high as the
+    tallest window.  When moving down to a window that overlaps the current
+    strip, only the new rows are read, so each pixel is decoded about once
+    even with overlapping windows.  Windows are expected to be sorted by row.
+
+    Only bands in +indexes+ are read (all bands by default).  Chips are
+    returned as views of the strip buffer, and are only valid until the next
+    call to +read+.
+    """
+
+    def __init__(self, ds, windows, indexes=None):
+        self.ds = ds
+        self.indexes = list(indexes) if indexes else list(ds.indexes)
+        self.col_off = min((w.col_off for w in windows), default=0)
+        col_end = max((w.col_off + w.width for w in windows), default=0)
+        self.width = col_end - self.col_off
+        self.height = max((w.height for w in windows), default=0)
+        self.row_off = None
+        self.valid_rows = 0
+        self.buffer = None
+
+    def read(self, window):
+        if (
+            self.row_off is None
+            or window.row_off < self.row_off
+            or window.row_off + window.height > self.row_off + self.valid_rows
+        ):
+            self._advance(window.row_off)
+        i = window.row_off - self.row_off
+        j = window.col_off - self.col_off
+        return self.buffer[:, i : i + window.height, j : j + window.width]
+
+    def _advance(self, row_off):
+        if self.buffer is None:
+            self.buffer = np.empty(
+                (len(self.indexes), self.height, self.width),
+                dtype=self.ds.dtypes[self.indexes[0] - 1],
+            )
+        height = min(self.height, self.ds.height - row_off)
+
+        # Keep the rows that overlap with the new strip, and read the rest
+        keep = 0
+        if self.row_off is not None and self.row_off < row_off:
+            shift = row_off - self.row_off
+            keep = min(max(0, self.valid_rows - shift), height)
+            if keep:
+                self.buffer[:, :keep] = self.buffer[:, shift : shift + keep]
+        if keep < height:
+            self.buffer[:, keep:height] = self.ds.read(
+                self.indexes,
+                window=Window(self.col_off, row_off + keep, self.width, height - keep),
+            )
+        self.row_off = row_off
+        self.valid_rows = height
+
+
 def rescale_intensity(image, rescale_mode, rescale_range):
     """
     Calculate percentiles from a range cut and
@@ -62,51 +227,369 @@ def rescale_intensity(image, rescale_mode, rescale_range):
     elif rescale_mode == "values":
         in_range = np.array(rescale_range).reshape(-1, 2)
         if in_range.shape[0] == 1:
-            in_range = [tuple(in_range[0]) for _ in range(image.shape[0])]
+            in_range = np.repeat(in_range, image.shape[0], axis=0)
     else:
         raise RuntimeError(f"unknown rescale_mode {rescale_mode}")
 
-    return np.array([
-            exposure.rescale_intensity(
-                image[i, :, :], in_range=tuple(in_range[i]), out_range=(1, 255)
-            ).astype(np.uint8)
-            for i in range(image.shape[0])
-        ])
+    # Rescale all bands at once, to the [1, 255] range
+    in_range = np.asarray(in_range, dtype=np.float64)
+    imin = in_range[:, 0].reshape(-1, 1, 1)
+    imax = in_range[:, 1].reshape(-1, 1, 1)
+    scale = np.where(imax > imin, imax - imin, 1)
+    res = (np.clip(image, imin, imax) - imin) / scale
+    res *= 254
+    res += 1
+    return res.astype(np.uint8)
 
 
-def calculate_raster_percentiles(raster, lower_cut=2, upper_cut=98, sample_size=128, size=2048):
-    size = (size, size)
+class PercentileSketch:
+    """
+    Mergeable per-band sketch for estimating percentiles in a single pass.
 
-    with rasterio.open(raster) as ds:
-        windows = list(sliding_windows(size, size, ds.width, ds.height))
-        _logger.info("Windows: %d, sample size: %d", len(windows), sample_size)
-        totals_per_bands = [[] for _ in range(ds.count)]
-        for window, _ in tqdm(windows):
-            img = ds.read(window=window).astype(np.float)
-            img[img == ds.nodata] = np.nan
-            if np.isnan(img).all():
-                continue
-            window_sample = []
-            for i in range(img.shape[0]):
-                values = img[i].flatten()
-                window_sample.append(
-                    np.random.choice(values, size=sample_size, replace=False)
+    Values are added with a weight: the number of pixels each one represents
+    (e.g. when values are sampled from a raster), so that merged sketches of
+    different rasters are weighted by their number of pixels, not by the
+    number of values sampled from each one.
+
+    For 8 and 16-bit integer rasters, it keeps a weighted histogram of all
+    values seen.  For other data types, it keeps a bounded weighted random
+    sample of values per band: when it grows over +max_samples+, it is
+    resampled with probabilities proportional to weights, and the total
+    weight is kept.  Added values are kept in chunks, and only concatenated
+    and resampled when they grow over twice +max_samples+ or when the sample
+    is read, so that adding many small chunks takes linear time.
+    """
+
+    def __init__(self, count, dtype, max_samples=1000000, seed=None):
+        self.count = count
+        self.dtype = np.dtype(dtype)
+        self.max_samples = max_samples
+        self.rng = np.random.RandomState(seed)
+        if self.dtype.kind in "ui" and self.dtype.itemsize <= 2:
+            info = np.iinfo(self.dtype)
+            self.offset = -int(info.min)
+            self.hist = np.zeros((count, int(info.max) - int(info.min) + 1))
+        else:
+            self.hist = None
+            self._samples = []
+            self._weights = []
+            self._size = 0
+
+    @property
+    def samples(self):
+        """Array of shape (count, n) of sampled values, with n <= max_samples"""
+        self._collect()
+        return self._samples[0]
+
+    @property
+    def weights(self):
+        """Array of shape (n,) of weights of sampled values"""
+        self._collect()
+        return self._weights[0]
+
+    def _collect(self):
+        """
+        Concatenate chunks of samples into one, and resample it if it has more
+        than +max_samples+ values
+        """
+        if len(self._samples) == 1 and self._size <= self.max_samples:
+            return
+        if self._samples:
+            samples = np.concatenate(self._samples, axis=1)
+            weights = np.concatenate(self._weights)
+        else:
+            samples = np.empty((self.count, 0), dtype=np.float64)
+            weights = np.empty(0, dtype=np.float64)
+        if samples.shape[1] > self.max_samples:
+            # Systematic resampling: a single random offset, and evenly
+            # spaced positions over cumulative weights.  Unlike independent
+            # draws, it does not lose distinct values on repeated resamplings.
+            cum = np.cumsum(weights)
+            total = cum[-1]
+            step = total / self.max_samples
+            positions = (self.rng.rand() + np.arange(self.max_samples)) * step
+            idx = np.searchsorted(cum, positions, side="right")
+            samples = samples[:, np.minimum(idx, len(cum) - 1)]
+            weights = np.full(self.max_samples, step)
+        self._samples, self._weights = [samples], [weights]
+        self._size = samples.shape[1]
+
+    @property
+    def empty(self):
+        if self.hist is not None:
+            return not self.hist[0].any()
+        return not self.weights.any()
+
+    def update(self, values, weights=None):
+        """
+        Add +values+, an array of shape (count, n), to the sketch, with
+        +weights+ of shape (n,) (1 for each value by default)
+        """
+        if values.shape[1] == 0:
+            return
+        if weights is None:
+            weights = np.ones(values.shape[1])
+        if self.hist is not None:
+            values = values.astype(np.int64) + self.offset
+            for i in range(self.count):
+                self.hist[i] += np.bincount(
+                    values[i], weights=weights, minlength=self.hist.shape[1]
                 )
-            for i, win in enumerate(window_sample):
-                totals_per_bands[i].append(win)
+        else:
+            self._samples.append(values.astype(np.float64))
+            self._weights.append(np.asarray(weights, dtype=np.float64))
+            self._size += values.shape[1]
+            if self._size > 2 * self.max_samples:
+                self._collect()
+
+    def merge(self, other):
+        if self.hist is not None:
+            self.hist += other.hist
+        else:
+            self.update(other.samples, other.weights)
+
+    def percentiles(self, q):
+        """
+        Return an array of shape (count, len(q)) of percentiles +q+ (NaN if
+        the sketch is empty)
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.hist is None:
+            return np.array(
+                [weighted_percentiles(v, self.weights, q) for v in self.samples]
+            )
+
+        return np.array(
+            [histogram_percentiles(h, q, offset=self.offset) for h in self.hist]
+        )
+
+
+def weighted_percentiles(values, weights, q):
+    """
+    Calculate percentiles +q+ of +values+ with +weights+.  With unit weights,
+    it is the same as np.percentile (see histogram_percentiles).
+    """
+    q = np.asarray(q, dtype=np.float64)
+    if not len(values):
+        return np.full(len(q), np.nan)
+    order = np.argsort(values)
+    values = values[order]
+    cum = np.cumsum(weights[order])
+    ranks = q / 100 * (cum[-1] - 1)
+    last = len(values) - 1
+    lo = np.minimum(np.searchsorted(cum, np.floor(ranks), side="right"), last)
+    hi = np.minimum(np.searchsorted(cum, np.ceil(ranks), side="right"), last)
+    frac = ranks - np.floor(ranks)
+    return values[lo] + (values[hi] - values[lo]) * frac
 
-        for i, totals in enumerate(totals_per_bands):
-            totals_per_bands[i] = np.array(totals).flatten()
 
-        totals = np.array(totals_per_bands)
-        _logger.info("Total shape: %s", totals.shape)
+def histogram_percentiles(hist, q, offset=0):
+    """
+    Calculate percentiles +q+ from a histogram of integer values, where
+    +hist[k]+ is the count of value +k - offset+.  Uses the same linear
+    interpolation as np.percentile.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    cum = np.cumsum(hist)
+    n = cum[-1]
+    if n == 0:
+        return np.full(len(q), np.nan)
+    ranks = q / 100 * (n - 1)
+    lo = np.searchsorted(cum, np.floor(ranks), side="right")
+    hi = np.searchsorted(cum, np.ceil(ranks), side="right")
+    frac = ranks - np.floor(ranks)
+    return (lo + (hi - lo) * frac) - offset
 
-        res = tuple(
-            tuple(p) for p in np.nanpercentile(totals, (lower_cut, upper_cut), axis=1).T
+
+def is_low_contrast(image, fraction_threshold=0.05, lower_percentile=1, upper_percentile=99):
+    """
+    Same as skimage.exposure.is_low_contrast, but for 8 and 16-bit integer
+    images, percentiles are calculated from a histogram of the image instead
+    of sorting it.  Other images are passed to skimage.
+    """
+    image = np.asanyarray(image)
+    if (
+        image.dtype.kind not in "ui"
+        or image.dtype.itemsize > 2
+        or (image.ndim == 3 and image.shape[2] in (3, 4))
+    ):
+        return exposure.is_low_contrast(
+            image,
+            fraction_threshold=fraction_threshold,
+            lower_percentile=lower_percentile,
+            upper_percentile=upper_percentile,
         )
-        _logger.info("Percentiles: %s", res)
 
-        return res
+    info = np.iinfo(image.dtype)
+    offset = -int(info.min)
+    values = image.ravel()
+    if offset:
+        values = values.astype(np.int64) + offset
+    hist = np.bincount(values, minlength=int(info.max) + offset + 1)
+    limits = histogram_percentiles(
+        hist, (lower_percentile, upper_percentile), offset=offset
+    )
+    ratio = (limits[1] - limits[0]) / (int(info.max) - int(info.min))
+    return ratio < fraction_threshold
+
+
+def raster_percentile_sketch(
+    raster, sample_size=4096, max_blocks=256, max_pixels=2 ** 22, seed=None
+):
+    """
+    Build a PercentileSketch of a raster without reading it completely.
+
+    If the raster has overviews, a decimated version of at most +max_pixels+
+    pixels is read (GDAL reads it from the overviews).  Otherwise, at most
+    +max_blocks+ random internal blocks are read.  Only pixels that are valid
+    (not nodata nor NaN) in all bands are considered.  For non-integer
+    rasters, up to +sample_size+ pixels are drawn from each block (or up to
+    +sample_size+ * +max_blocks+ pixels from the decimated raster), in a
+    single draw for all bands.
+
+    Values are weighted by the number of raster pixels they represent, so
+    that sketches of rasters of different sizes, or read in different ways,
+    can be merged.  A warning is logged if the raster has no valid pixels.
+    """
+    rng = np.random.RandomState(seed)
+
+    with rasterio.open(raster) as ds:
+        sketch = PercentileSketch(ds.count, ds.dtypes[0], seed=seed)
+
+        def add(img, n_samples, scale):
+            img = img.reshape(img.shape[0], -1)
+            valid = np.ones(img.shape[1], dtype=bool)
+            if ds.nodata is not None:
+                valid &= (img != ds.nodata).all(axis=0)
+            if img.dtype.kind == "f":
+                valid &= ~np.isnan(img).any(axis=0)
+            idx = np.flatnonzero(valid)
+            if not len(idx):
+                return
+            n_valid = len(idx)
+            if sketch.hist is None and n_valid > n_samples:
+                idx = rng.choice(idx, size=n_samples, replace=False)
+            weight = scale * n_valid / len(idx)
+            sketch.update(img[:, idx], np.full(len(idx), weight))
+
+        if ds.overviews(1):
+            factor = max(1, math.ceil(math.sqrt(ds.width * ds.height / max_pixels)))
+            out_shape = (
+                ds.count,
+                max(1, ds.height // factor),
+                max(1, ds.width // factor),
+            )
+            _logger.info("Read decimated raster with shape %s", out_shape)
+            scale = ds.width * ds.height / (out_shape[1] * out_shape[2])
+            add(ds.read(out_shape=out_shape), sample_size * max_blocks, scale)
+        else:
+            blocks = [w for _, w in ds.block_windows(1)]
+            scale = 1.0
+            if len(blocks) > max_blocks:
+                scale = len(blocks) / max_blocks
+                idxs = sorted(rng.choice(len(blocks), size=max_blocks, replace=False))
+                blocks = [blocks[k] for k in idxs]
+            _logger.info("Read %d blocks", len(blocks))
+            for window in tqdm(blocks):
+                add(ds.read(window=window), sample_size, scale)
+
+    if sketch.empty:
+        _logger.warning("%s has no valid pixels", raster)
+    return sketch
+
+
+def calculate_raster_percentiles(raster, lower_cut=2, upper_cut=98, **kwargs):
+    return calculate_rasters_percentiles(
+        [raster], lower_cut=lower_cut, upper_cut=upper_cut, **kwargs
+    )
+
+
+def calculate_rasters_percentiles(rasters, lower_cut=2, upper_cut=98, **kwargs):
+    """
+    Calculate per-band percentiles from all +rasters+ pixels, estimated with
+    a PercentileSketch (see +raster_percentile_sketch+ for options).
+
+    Rasters without valid pixels are skipped, and an error is raised if none
+    of them has valid pixels.
+    """
+    sketch = None
+    for raster in rasters:
+        raster_sketch = raster_percentile_sketch(raster, **kwargs)
+        if raster_sketch.empty:
+            continue
+        if sketch is None:
+            sketch = raster_sketch
+        else:
+            sketch.merge(raster_sketch)
+    if sketch is None:
+        raise RuntimeError(
+            f"Cannot calculate percentiles, no valid pixels in {', '.join(rasters)}"
+        )
+
+    res = tuple(
+        tuple(float(v) for v in p) for p in sketch.percentiles((lower_cut, upper_cut))
+    )
+    _logger.info("Percentiles: %s", res)
+
+    return res
+
+
+def raster_fingerprint(path, chunk_size=1024 * 1024):
+    """
+    Return a hash that identifies the contents of a raster file, computed
+    from its size and its first and last +chunk_size+ bytes, so that it is
+    cheap even for very large mosaics.
+    """
+    h = hashlib.sha1()
+    file_size = os.path.getsize(path)
+    h.update(str(file_size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(chunk_size))
+        if file_size > chunk_size:
+            f.seek(max(chunk_size, file_size - chunk_size))
+            h.update(f.read(chunk_size))
+    return h.hexdigest()
+
+
+def get_rasters_percentiles(rasters, lower_cut=2, upper_cut=98, group=False, *, stats_path):
+    """
+    Return a dict of raster path to per-band (lower, upper) percentiles.
+
+    Percentiles are cached in a JSON file at +stats_path+, keyed by raster
+    fingerprint (see +raster_fingerprint+) and cuts, and only calculated for
+    rasters not in the cache.  If +group+ is true, percentiles are calculated
+    once from a sample of all +rasters+ together, and shared by all of them.
+    """
+    stats = {}
+    if os.path.exists(stats_path):
+        with open(stats_path) as f:
+            stats = json.load(f)
+
+    fingerprints = {r: raster_fingerprint(r) for r in rasters}
+    if group:
+        group_fp = hashlib.sha1(
+            ":".join(sorted(fingerprints.values())).encode()
+        ).hexdigest()
+        keys = {r: f"group:{group_fp}:{lower_cut}:{upper_cut}" for r in rasters}
+    else:
+        keys = {r: f"{fingerprints[r]}:{lower_cut}:{upper_cut}" for r in rasters}
+
+    missing = [r for r in rasters if keys[r] not in stats]
+    if missing:
+        if group:
+            _logger.info("Calculate percentiles of %d rasters", len(rasters))
+            res = calculate_rasters_percentiles(rasters, lower_cut, upper_cut)
+            stats[keys[rasters[0]]] = res
+        else:
+            for r in missing:
+                _logger.info("Calculate percentiles of %s", r)
+                stats[keys[r]] = calculate_raster_percentiles(r, lower_cut, upper_cut)
+
+        os.makedirs(os.path.dirname(os.path.abspath(stats_path)), exist_ok=True)
+        with open(stats_path, "w") as f:
+            json.dump(stats, f, indent=2)
+
+    return {r: [tuple(p) for p in stats[keys[r]]] for r in rasters}
 
 
 def write_chips_geojson(output_path, chip_pairs, *, type, crs, basename):
@@ -117,22 +600,67 @@ def write_chips_geojson(output_path, chip_pairs, *, type, crs, basename):
     _logger.info("Write chips geojson")
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
+    # Shapes will be stored in EPSG:4326 projection
+    rings = reproject_chip_rings(chip_pairs, crs, "epsg:4326")
+
+    # Write features one at a time, instead of building the whole collection
+    # in memory
     with open(output_path, "w") as f:
-        d = {"type": "FeatureCollection", "features": []}
-        for i, (chip, (_fi, xi, yi)) in enumerate(chip_pairs):
-            # Shapes will be stored in EPSG:4326 projection
-            if crs != "epsg:4326":
-                chip_wgs = reproject_shape(chip, crs, "epsg:4326")
-            else:
-                chip_wgs = chip
+        f.write('{"type": "FeatureCollection", "features": [')
+        for i, ((_, (_fi, xi, yi)), ring) in enumerate(zip(chip_pairs, rings)):
             filename = f"{basename}_{xi}_{yi}.{type}"
             feature = {
                 "type": "Feature",
-                "geometry": mapping(chip_wgs),
+                "geometry": {"type": "Polygon", "coordinates": [ring.tolist()]},
                 "properties": {"id": i, "x": xi, "y": yi, "filename": filename},
             }
-            d["features"].append(feature)
-        f.write(json.dumps(d))
+            if i > 0:
+                f.write(", ")
+            f.write(json.dumps(feature))
+        f.write("]}")
+
+
+def write_chips_index(
+    output_path, chip_pairs, batch_size=10000, *, type, crs, basename, driver
+):
+    """
+    Write chip shapes to a vector file using a fiona +driver+ (e.g. GPKG or
+    FlatGeobuf).  These drivers also write a spatial index of the chips.
+    """
+    import fiona
+    from fiona.crs import from_epsg
+
+    if not chip_pairs:
+        _logger.warn("No chips to save")
+        return
+
+    _logger.info("Write chips index (%s)", driver)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if os.path.exists(output_path):
+        os.unlink(output_path)
+
+    rings = reproject_chip_rings(chip_pairs, crs, "epsg:4326")
+    schema = {
+        "geometry": "Polygon",
+        "properties": {"id": "int", "x": "int", "y": "int", "filename": "str"},
+    }
+    with fiona.open(
+        output_path, "w", driver=driver, schema=schema, crs=from_epsg(4326)
+    ) as dst:
+        batch = []
+        for i, ((_, (_fi, xi, yi)), ring) in enumerate(zip(chip_pairs, rings)):
+            filename = f"{basename}_{xi}_{yi}.{type}"
+            batch.append(
+                {
+                    "geometry": {"type": "Polygon", "coordinates": [ring.tolist()]},
+                    "properties": {"id": i, "x": xi, "y": yi, "filename": filename},
+                }
+            )
+            if len(batch) >= batch_size:
+                dst.writerecords(batch)
+                batch = []
+        if batch:
+            dst.writerecords(batch)
 
 
 def get_raster_band_count(path):
@@ -15,6 +15,7 @@ from satlomasproc.chips import (
     prepare_aoi_shape,
 )
 from satlomasproc.chips.utils import get_raster_band_count
+from satlomasproc.raster import COMPRESSIONS, COGOptions
 from tqdm import tqdm
 
 __author__ = "Damián Silvani"
@@ -90,21 +91,25 @@ def parse_args(args):
     parser.add_argument(
         "--rescale-mode",
         default="percentiles",
-        choices=["percentiles", "values"],
-        help="choose mode of intensity rescaling",
+        choices=["percentiles", "raster-percentiles", "global-percentiles", "values"],
+        help="choose mode of intensity rescaling. 'percentiles' calculates percentiles on each chip, 'raster-percentiles' once for each raster, and 'global-percentiles' once for all rasters",
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="(for 'raster-percentiles' and 'global-percentiles' modes) JSON file where percentiles are cached. Defaults to stats.json in output dir",
     )
 
     parser.add_argument(
         "--lower-cut",
         type=float,
         default=2,
-        help="(for 'percentiles' mode) lower cut of percentiles for cumulative count in intensity rescaling",
+        help="(for percentiles modes) lower cut of percentiles for cumulative count in intensity rescaling",
     )
     parser.add_argument(
         "--upper-cut",
         type=float,
         default=98,
-        help="(for 'percentiles' mode) upper cut of percentiles for cumulative count in intensity rescaling",
+        help="(for percentiles modes) upper cut of percentiles for cumulative count in intensity rescaling",
     )
 
     parser.add_argument(
@@ -129,6 +134,36 @@ def parse_args(args):
         "-t", "--type", help="output chip format", choices=["jpg", "tif"], default="tif"
     )
 
+    parser.add_argument(
+        "--output-format",
+        choices=["files", "npy"],
+        default="files",
+        help="write each chip and mask to its own file, or write them into memory-mappable .npy shards",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1024,
+        help="(for 'npy' output format) number of chips per shard",
+    )
+    parser.add_argument(
+        "--cog",
+        action="store_true",
+        help="write chips and masks as tiled, compressed Cloud Optimized GeoTIFFs",
+    )
+    parser.add_argument(
+        "--cog-compress",
+        choices=COMPRESSIONS,
+        default="deflate",
+        help="(with --cog) compression method",
+    )
+    parser.add_argument(
+        "--cog-block-size",
+        type=int,
+        default=512,
+        help="(with --cog) block size in pixels",
+    )
+
     parser.add_argument(
         "--write-geojson",
         help="write a GeoJSON file of chip polygons",
@@ -142,6 +177,12 @@ def parse_args(args):
         dest="write_geojson",
         action="store_false",
     )
+    parser.add_argument(
+        "--index-format",
+        choices=["geojson", "gpkg", "fgb"],
+        default="geojson",
+        help="file format of the chip polygons index (GeoPackage and FlatGeobuf include a spatial index)",
+    )
     parser.add_argument(
         "--dry-run",
         help="do not extract chips. It still writes GeoJSON if --write-geojson is used",
@@ -166,6 +207,36 @@ def parse_args(args):
         help="do not skip already existing chips (and masks)",
     )
 
+    parser.add_argument(
+        "--manifest",
+        dest="manifest",
+        default=False,
+        action="store_true",
+        help="track extracted chips in a manifest in the output dir, and only extract missing chips on reruns",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to extract chips",
+    )
+
+    parser.add_argument(
+        "--read-mode",
+        choices=["window", "strip"],
+        default="window",
+        help="read each chip window separately, or read full horizontal strips once and slice chips from them",
+    )
+
+    parser.add_argument(
+        "--mask-mode",
+        choices=["window", "raster"],
+        default="window",
+        help="rasterize labels for each chip window, or once for the whole raster and slice mask chips from it",
+    )
+
     parser.add_argument(
         "--version",
         action="version",
@@ -225,7 +296,7 @@ def main(args):
         )
 
     rescale_mode = args.rescale_mode if args.rescale else None
-    if rescale_mode == "percentiles":
+    if rescale_mode in ("percentiles", "raster-percentiles", "global-percentiles"):
         rescale_range = (args.lower_cut, args.upper_cut)
         _logger.info("Rescale intensity with percentiles %s", rescale_range)
     elif rescale_mode == "values":
@@ -235,6 +306,10 @@ def main(args):
         rescale_range = None
         _logger.info("No rescale intensity")
 
+    cog = None
+    if args.cog:
+        cog = COGOptions(block_size=args.cog_block_size, compress=args.cog_compress)
+
     _logger.info("Extract chips")
 
     extract_chips(
@@ -255,7 +330,16 @@ def main(args):
         size=args.size,
         step_size=args.step_size,
         output_dir=args.output_dir,
-        dry_run=args.dry_run
+        dry_run=args.dry_run,
+        workers=args.workers,
+        read_mode=args.read_mode,
+        mask_mode=args.mask_mode,
+        index_format=args.index_format,
+        manifest=args.manifest,
+        stats_path=args.stats_file,
+        output_format=args.output_format,
+        shard_size=args.shard_size,
+        cog=cog,
     )
 
 
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+This script detects changes between class rasters of consecutive periods
+(e.g. bimonthly mosaics), writing change masks, transition matrices and
+per-polygon transition areas.
+"""
+
+import argparse
+import logging
+import sys
+
+from satlomasproc import __version__
+from satlomasproc.unet.change_detection import detect_changes
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def transition(value):
+    """Parse a FROM:TO class transition"""
+    try:
+        from_, to = value.split(":")
+        return int(from_), int(to)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid transition {value!r}, use FROM:TO")
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Detect changes between class rasters of consecutive periods",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="satlomasproc {ver}".format(ver=__version__),
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+
+    parser.add_argument(
+        "rasters", nargs="+", help="class rasters, sorted by period (at least two)"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", required=True, help="path to output directory"
+    )
+    parser.add_argument(
+        "-C", "--num-classes", default=6, type=int, help="Number of classes"
+    )
+    parser.add_argument(
+        "-t",
+        "--transition",
+        dest="transitions",
+        action="append",
+        type=transition,
+        help="class transition to include in change masks, as FROM:TO (e.g. 1:2), "
+        "can be used multiple times (by default, any class change)",
+    )
+    parser.add_argument(
+        "-p",
+        "--polygons",
+        help="vector file of polygons to compute transition areas for",
+    )
+    parser.add_argument(
+        "--polygon-id",
+        help="property used to identify polygons (by default, their position)",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=1024,
+        help="size of blocks read at once, in pixels",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="number of threads comparing periods (by default, one per pair)",
+    )
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel, stream=sys.stdout, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    results = detect_changes(
+        args.rasters,
+        transitions=args.transitions,
+        polygons=args.polygons,
+        polygon_id_property=args.polygon_id,
+        block_size=args.block_size,
+        workers=args.workers,
+        num_classes=args.num_classes,
+        output_dir=args.output_dir,
+    )
+
+    for before, after, matrix, _ in results:
+        changed = matrix[1:, 1:].sum() - matrix[1:, 1:].trace()
+        print(f"{before} -> {after}: {changed} pixels changed class")
+
+
+def run():
+    """Entry point for console_scripts"""
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
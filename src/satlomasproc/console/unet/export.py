@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+This script exports a trained U-Net model to TFLite, optionally quantized, and
+checks its predictions and speed against the Keras model.
+"""
+
+import argparse
+import logging
+import sys
+
+from satlomasproc import __version__
+from satlomasproc.unet.export import (
+    QUANTIZATIONS,
+    compare_models,
+    export_tflite,
+)
+from satlomasproc.unet.predict import PredictConfig
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Export a model to TFLite",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="satlomasproc {ver}".format(ver=__version__),
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+
+    parser.add_argument("model", help="path to trained model (.h5)")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="path to output model (.tflite)",
+        default="./unet.tflite",
+    )
+    parser.add_argument(
+        "-q", "--quantization", choices=QUANTIZATIONS, help="quantization to apply"
+    )
+    parser.add_argument(
+        "--images",
+        help="path to image tiles (directory with images/, or shards/), to "
+        "calibrate int8 quantization and to compare exported and original models",
+    )
+    parser.add_argument(
+        "--max-samples",
+        default=100,
+        type=int,
+        help="maximum number of image tiles to use for calibration and comparison",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        default=0.5,
+        type=float,
+        help="threshold to binarize predictions when comparing models",
+    )
+    parser.add_argument(
+        "-W", "--width", default=320, type=int, help="Image tile width"
+    )
+    parser.add_argument(
+        "-H", "--height", default=320, type=int, help="Image tile height"
+    )
+    parser.add_argument(
+        "-N", "--num-channels", default=3, type=int, help="Number of channels"
+    )
+    parser.add_argument(
+        "-C", "--num-classes", default=1, type=int, help="Number of classes"
+    )
+    parser.add_argument(
+        "--batch-size", default=32, type=int, help="Batch size for prediction"
+    )
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel, stream=sys.stdout, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    config = PredictConfig(
+        batch_size=args.batch_size,
+        model_path=args.model,
+        height=args.height,
+        width=args.width,
+        n_channels=args.num_channels,
+        n_classes=args.num_classes,
+    )
+
+    export_tflite(
+        config,
+        quantization=args.quantization,
+        images_path=args.images,
+        max_samples=args.max_samples,
+        output=args.output,
+    )
+
+    if args.images:
+        res = compare_models(
+            config,
+            args.output,
+            threshold=args.threshold,
+            max_samples=args.max_samples,
+            images_path=args.images,
+        )
+        print(f"IoU between Keras and TFLite predictions: {res['iou']:.4f}")
+        print(f"IoU delta: {1 - res['iou']:.4f}")
+        print(f"Max. abs. difference of probabilities: {res['max_abs_diff']:.4f}")
+        print(f"Keras throughput: {res['keras_chips_per_sec']:.1f} chips/s")
+        print(f"TFLite throughput: {res['tflite_chips_per_sec']:.1f} chips/s")
+
+
+def run():
+    """Entry point for console_scripts"""
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
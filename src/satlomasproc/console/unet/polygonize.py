@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+This script polygonizes a class raster (e.g. a coalesced and binarized
+prediction) into a GeoPackage or FlatGeobuf file of simplified class polygons.
+"""
+
+import argparse
+import logging
+import sys
+
+from satlomasproc import __version__
+from satlomasproc.unet.polygonize import polygonize
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Polygonize a class raster",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="satlomasproc {ver}".format(ver=__version__),
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+
+    parser.add_argument("raster", help="Path to class raster")
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="path to output vector file (.gpkg or .fgb)",
+    )
+    parser.add_argument(
+        "-s",
+        "--simplify",
+        type=float,
+        default=0.0,
+        help="simplification tolerance, in CRS units (e.g. meters)",
+    )
+    parser.add_argument(
+        "--coverage",
+        action="store_true",
+        help="simplify neighbouring polygons together, without gaps or overlaps between them (may use much more memory on rasters without nodata)",
+    )
+    parser.add_argument(
+        "-a",
+        "--min-area",
+        type=float,
+        default=0.0,
+        help="minimum area of polygons, in CRS square units",
+    )
+    parser.add_argument(
+        "-b", "--band", type=int, default=1, help="band of the class raster"
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=1024,
+        help="size of tiles polygonized in parallel, in pixels",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="number of worker processes (by default, the number of CPUs)",
+    )
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel, stream=sys.stdout, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    polygonize(
+        args.raster,
+        simplify=args.simplify,
+        min_area=args.min_area,
+        band=args.band,
+        tile_size=args.tile_size,
+        workers=args.workers,
+        coverage=args.coverage,
+        output=args.output,
+    )
+
+
+def run():
+    """Entry point for console_scripts"""
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -9,6 +9,7 @@ import logging
 import sys
 
 from satlomasproc import __version__
+from satlomasproc.raster import COMPRESSIONS, COGOptions
 from satlomasproc.unet.predict import PredictConfig, predict
 
 __author__ = "Damián Silvani"
@@ -62,7 +63,10 @@ def parse_args(args):
         default="./results",
     )
     parser.add_argument(
-        "--model", "-m", help="path to trained model (.h5)", default="./unet.h5"
+        "--model",
+        "-m",
+        help="path to trained model (.h5 or .tflite)",
+        default="./unet.h5",
     )
     parser.add_argument("-W", "--width", type=int, help="Image tile width")
     parser.add_argument("-H", "--height", type=int, help="Image tile height")
@@ -75,6 +79,41 @@ def parse_args(args):
     parser.add_argument(
         "--batch-size", default=32, type=int, help="Batch size for prediction"
     )
+    parser.add_argument(
+        "--read-workers",
+        default=2,
+        type=int,
+        help="number of threads that read and preprocess batches",
+    )
+    parser.add_argument(
+        "--write-workers",
+        default=2,
+        type=int,
+        help="number of threads that write predicted batches",
+    )
+    parser.add_argument(
+        "--queue-size",
+        default=4,
+        type=int,
+        help="maximum number of batches read ahead or pending to be written",
+    )
+    parser.add_argument(
+        "--cog",
+        action="store_true",
+        help="write predictions as tiled, compressed Cloud Optimized GeoTIFFs",
+    )
+    parser.add_argument(
+        "--cog-compress",
+        choices=COMPRESSIONS,
+        default="deflate",
+        help="(with --cog) compression method",
+    )
+    parser.add_argument(
+        "--cog-block-size",
+        type=int,
+        default=512,
+        help="(with --cog) block size in pixels",
+    )
 
     return parser.parse_args(args)
 
@@ -100,6 +139,10 @@ def main(args):
     args = parse_args(args)
     setup_logging(args.loglevel)
 
+    cog = None
+    if args.cog:
+        cog = COGOptions(block_size=args.cog_block_size, compress=args.cog_compress)
+
     config = PredictConfig(
         batch_size=args.batch_size,
         model_path=args.model,
@@ -109,6 +152,10 @@ def main(args):
         width=args.width,
         n_channels=args.num_channels,
         n_classes=args.num_classes,
+        read_workers=args.read_workers,
+        write_workers=args.write_workers,
+        queue_size=args.queue_size,
+        cog=cog,
     )
 
     predict(config)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+This script performs model prediction over a whole raster using an already
+trained U-Net model, blending overlapping tiles into a single probability raster.
+"""
+
+import argparse
+import logging
+import sys
+
+from satlomasproc import __version__
+from satlomasproc.raster import COMPRESSIONS, COGOptions
+from satlomasproc.unet.predict import PredictConfig, predict_raster
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Predict over a whole raster",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="satlomasproc {ver}".format(ver=__version__),
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+
+    parser.add_argument("raster", help="Path to raster to predict")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="path to output probability raster",
+        default="./results.tif",
+    )
+    parser.add_argument(
+        "--model",
+        "-m",
+        help="path to trained model (.h5 or .tflite)",
+        default="./unet.h5",
+    )
+    parser.add_argument(
+        "-W", "--width", default=320, type=int, help="Model input width"
+    )
+    parser.add_argument(
+        "-H", "--height", default=320, type=int, help="Model input height"
+    )
+    parser.add_argument(
+        "--chip-size",
+        default=256,
+        type=int,
+        help="size of tiles read from the raster (the size of extracted training chips), resized to the model input size",
+    )
+    parser.add_argument(
+        "-s",
+        "--step-size",
+        type=int,
+        help="step size between tiles (by default, half the tile size)",
+    )
+    parser.add_argument(
+        "-b",
+        "--bands",
+        nargs="+",
+        type=int,
+        help="raster bands to use (by default, the first --num-channels bands)",
+    )
+    parser.add_argument(
+        "-N", "--num-channels", default=3, type=int, help="Number of channels"
+    )
+    parser.add_argument(
+        "-C", "--num-classes", default=1, type=int, help="Number of classes"
+    )
+    parser.add_argument(
+        "--batch-size", default=32, type=int, help="Batch size for prediction"
+    )
+    parser.add_argument(
+        "--rescale",
+        dest="rescale",
+        default=False,
+        action="store_true",
+        help="rescale intensity like training chips (see --rescale-mode)",
+    )
+    parser.add_argument(
+        "--no-rescale",
+        dest="rescale",
+        action="store_false",
+        help="do not rescale intensity",
+    )
+    parser.add_argument(
+        "--rescale-mode",
+        default="percentiles",
+        choices=["percentiles", "raster-percentiles", "global-percentiles", "values"],
+        help="choose mode of intensity rescaling. 'percentiles' calculates percentiles on each tile, 'raster-percentiles' and 'global-percentiles' once for the raster",
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="(for 'raster-percentiles' and 'global-percentiles' modes) JSON file where percentiles are cached (e.g. the one written when extracting training chips). Defaults to stats.json in output dir",
+    )
+    parser.add_argument(
+        "--lower-cut",
+        type=float,
+        default=2,
+        help="(for percentiles modes) lower cut of percentiles for cumulative count in intensity rescaling",
+    )
+    parser.add_argument(
+        "--upper-cut",
+        type=float,
+        default=98,
+        help="(for percentiles modes) upper cut of percentiles for cumulative count in intensity rescaling",
+    )
+    parser.add_argument(
+        "--min",
+        type=float,
+        help="(for 'values' mode) minimum value in intensity rescaling",
+    )
+    parser.add_argument(
+        "--max",
+        type=float,
+        help="(for 'values' mode) maximum value in intensity rescaling",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=COMPRESSIONS,
+        default="deflate",
+        help="compression method of output COG",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=512,
+        help="block size of output COG, in pixels",
+    )
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel, stream=sys.stdout, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    rescale_mode = args.rescale_mode if args.rescale else None
+    if rescale_mode in ("percentiles", "raster-percentiles", "global-percentiles"):
+        rescale_range = (args.lower_cut, args.upper_cut)
+        _logger.info("Rescale intensity with percentiles %s", rescale_range)
+    elif rescale_mode == "values":
+        rescale_range = (args.min, args.max)
+        _logger.info("Rescale intensity with values %s", rescale_range)
+    else:
+        rescale_range = None
+        _logger.info("No rescale intensity")
+
+    config = PredictConfig(
+        batch_size=args.batch_size,
+        model_path=args.model,
+        height=args.height,
+        width=args.width,
+        n_channels=args.num_channels,
+        n_classes=args.num_classes,
+        cog=COGOptions(block_size=args.block_size, compress=args.compress),
+    )
+
+    predict_raster(
+        config,
+        chip_size=args.chip_size,
+        step_size=args.step_size,
+        bands=args.bands,
+        rescale_mode=rescale_mode,
+        rescale_range=rescale_range,
+        stats_path=args.stats_file,
+        raster=args.raster,
+        output=args.output,
+    )
+
+
+def run():
+    """Entry point for console_scripts"""
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
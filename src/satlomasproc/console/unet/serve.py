@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+This script starts a prediction server that loads an already trained U-Net model
+once, and predicts chips or raster windows sent over HTTP.
+"""
+
+import argparse
+import logging
+import sys
+
+from satlomasproc import __version__
+from satlomasproc.unet.predict import PredictConfig
+from satlomasproc.unet.server import serve
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "mit"
+
+_logger = logging.getLogger(__name__)
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args ([str]): command line parameters as list of strings
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve predictions of a model over HTTP",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="satlomasproc {ver}".format(ver=__version__),
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+
+    parser.add_argument("--host", default="127.0.0.1", help="host to listen on")
+    parser.add_argument("--port", default=8765, type=int, help="port to listen on")
+    parser.add_argument(
+        "--root",
+        default=".",
+        help="directory with the chips and rasters to predict, and where outputs are written (requests can not use paths outside of it)",
+    )
+    parser.add_argument(
+        "--model",
+        "-m",
+        help="path to trained model (.h5 or .tflite)",
+        default="./unet.h5",
+    )
+    parser.add_argument(
+        "-W", "--width", default=320, type=int, help="Image tile width"
+    )
+    parser.add_argument(
+        "-H", "--height", default=320, type=int, help="Image tile height"
+    )
+    parser.add_argument(
+        "-N", "--num-channels", default=3, type=int, help="Number of channels"
+    )
+    parser.add_argument(
+        "-C", "--num-classes", default=1, type=int, help="Number of classes"
+    )
+    parser.add_argument(
+        "--batch-size", default=32, type=int, help="Batch size for prediction"
+    )
+    parser.add_argument(
+        "--max-latency",
+        default=10,
+        type=float,
+        help="maximum time (in ms) to wait for more chips to fill a batch",
+    )
+
+    return parser.parse_args(args)
+
+
+def setup_logging(loglevel):
+    """Setup basic logging
+
+    Args:
+      loglevel (int): minimum loglevel for emitting messages
+    """
+    logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
+    logging.basicConfig(
+        level=loglevel, stream=sys.stdout, format=logformat, datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+def main(args):
+    """Main entry point allowing external calls
+
+    Args:
+      args ([str]): command line parameter list
+    """
+    args = parse_args(args)
+    setup_logging(args.loglevel)
+
+    config = PredictConfig(
+        batch_size=args.batch_size,
+        model_path=args.model,
+        height=args.height,
+        width=args.width,
+        n_channels=args.num_channels,
+        n_classes=args.num_classes,
+    )
+
+    serve(
+        config,
+        max_latency=args.max_latency / 1000,
+        host=args.host,
+        port=args.port,
+        root=args.root,
+    )
+
+
+def run():
+    """Entry point for console_scripts"""
+    main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    run()
@@ -55,7 +55,7 @@ def parse_args(args):
 
     parser.add_argument(
         "train_dir",
-        help="Path to image tiles and masks (directory with images/ and masks/)",
+        help="Path to image tiles and masks (directory with images/ and masks/, or shards/)",
     )
     parser.add_argument(
         "-o", "--output", help="path to output model (.h5)", default="./unet.h5"
@@ -102,6 +102,29 @@ def parse_args(args):
         type=int,
         help="Seed number for the random number generation",
     )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        default=1,
+        type=int,
+        help="number of workers that build batches in parallel",
+    )
+    parser.add_argument(
+        "--max-queue-size",
+        default=10,
+        type=int,
+        help="maximum number of batches prefetched by workers",
+    )
+    parser.add_argument(
+        "--use-multiprocessing",
+        action="store_true",
+        help="use processes instead of threads as workers",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="directory where chips are decoded into a memory-mapped cache on the first run, "
+        "to avoid decoding GeoTIFFs on each batch and on later runs",
+    )
 
     return parser.parse_args(args)
 
@@ -140,6 +163,10 @@ def main(args):
         seed=args.seed,
         images_path=args.train_dir,
         model_path=args.output,
+        cache_dir=args.cache_dir,
+        workers=args.workers,
+        max_queue_size=args.max_queue_size,
+        use_multiprocessing=args.use_multiprocessing,
     )
 
     train(config)
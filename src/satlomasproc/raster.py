@@ -0,0 +1,193 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import attr
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+_logger = logging.getLogger(__name__)
+
+COMPRESSIONS = ("deflate", "zstd", "lerc")
+
+# Profile keys that are not GeoTIFF creation options
+PROFILE_KEYS = (
+    "driver",
+    "dtype",
+    "nodata",
+    "width",
+    "height",
+    "count",
+    "crs",
+    "transform",
+)
+
+@attr.s
+class COGOptions:
+    """
+    Options for writing Cloud Optimized GeoTIFFs.
+
+    +predictor+ is the TIFF predictor (1: none, 2: horizontal, 3: floating
+    point).  By default, 2 is used for integer rasters and 3 for float
+    rasters.  It is ignored with LERC compression.  +level+ is the DEFLATE or
+    ZSTD compression level (GDAL default if None).
+    """
+
+    block_size = attr.ib(default=512)
+    compress = attr.ib(default="deflate")
+    predictor = attr.ib(default=None)
+    level = attr.ib(default=None)
+    overviews = attr.ib(default=True)
+    resampling = attr.ib(default="nearest")
+
+    @block_size.validator
+    def _check_block_size(self, attribute, value):
+        if value <= 0 or value % 16:
+            raise ValueError("block_size must be a positive multiple of 16")
+
+    @compress.validator
+    def _check_compress(self, attribute, value):
+        if value not in COMPRESSIONS:
+            raise ValueError(f"compress must be one of {', '.join(COMPRESSIONS)}")
+
+
+def cog_profile(profile, options):
+    """Return a copy of +profile+ for writing a COG with +options+"""
+    profile = profile.copy()
+    for key in ("blockxsize", "blockysize", "compress", "predictor", "photometric"):
+        profile.pop(key, None)
+
+    # Do not use blocks larger than needed for small rasters (e.g. chips)
+    size = max(profile["width"], profile["height"])
+    block_size = min(options.block_size, -(-size // 16) * 16)
+
+    profile.update(
+        driver="GTiff",
+        tiled=True,
+        blockxsize=block_size,
+        blockysize=block_size,
+        compress=options.compress,
+        BIGTIFF="IF_SAFER",
+    )
+    if options.compress != "lerc":
+        predictor = options.predictor
+        if predictor is None:
+            predictor = 3 if np.dtype(profile["dtype"]).kind == "f" else 2
+        profile["predictor"] = predictor
+    if options.level is not None:
+        level_key = "zstd_level" if options.compress == "zstd" else "zlevel"
+        profile[level_key] = options.level
+    return profile
+
+
+def build_overviews(path, min_size=256, resampling=Resampling.nearest):
+    """
+    Build overviews of raster in +path+, by factors of 2 until it is smaller
+    than +min_size+.  Returns true if any overview was built.
+    """
+    with rasterio.open(path, "r+") as dst:
+        factors = []
+        factor = 2
+        while max(dst.width, dst.height) / factor >= min_size:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            dst.build_overviews(factors, resampling)
+            dst.update_tags(ns="rio_overview", resampling=resampling.name)
+    return bool(factors)
+
+
+def finalize_cog(path, options):
+    """
+    Build internal overviews of the tiled GeoTIFF in +path+, and rewrite it
+    with the COG layout (overviews before full resolution data), so that
+    clients can read overviews and headers with a few range requests.
+
+    Rasters that fit in a single block are already valid COGs, and are left
+    as they are.
+    """
+    if not options.overviews:
+        return
+    if not build_overviews(
+        path, min_size=options.block_size, resampling=Resampling[options.resampling]
+    ):
+        return
+
+    with rasterio.open(path) as src:
+        profile = cog_profile(src.profile, options)
+    creation_options = {k: v for k, v in profile.items() if k not in PROFILE_KEYS}
+    tmp_path = f"{path}.cog.tmp"
+    rasterio.shutil.copy(
+        path, tmp_path, driver="GTiff", copy_src_overviews=True, **creation_options
+    )
+    os.replace(tmp_path, path)
+    _logger.debug("%s written as COG", path)
+
+
+class OverviewBuilder:
+    """
+    Finalizes COGs (see finalize_cog) in background threads, so that writers
+    can go on with the next raster while overviews are built.
+
+    Use it as a context manager: on exit, it waits for all submitted rasters
+    and raises the first error, if any.
+    """
+
+    def __init__(self, workers=1):
+        self.executor = ThreadPoolExecutor(workers)
+        self.futures = []
+
+    def submit(self, path, options):
+        self.futures.append(self.executor.submit(finalize_cog, path, options))
+
+    def wait(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def open_raster(path, cog=None, overview_builder=None, *, profile):
+    """
+    Open +path+ for writing with +profile+, and return the dataset.
+
+    If +cog+ options are given, the raster is written as a COG: tiled and
+    compressed, and finalized with internal overviews on close, in
+    +overview_builder+ threads if given.
+    """
+    if cog is not None:
+        profile = cog_profile(profile, cog)
+    with rasterio.open(path, "w", **profile) as dst:
+        yield dst
+    if cog is not None:
+        if overview_builder is not None:
+            overview_builder.submit(path, cog)
+        else:
+            finalize_cog(path, cog)
+
+
+def write_raster(img, path, cog=None, overview_builder=None, *, profile):
+    """Write +img+ (bands, height, width) to +path+ (see open_raster)"""
+    with open_raster(
+        path, cog=cog, overview_builder=overview_builder, profile=profile
+    ) as dst:
+        dst.write(img)
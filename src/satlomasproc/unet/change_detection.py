@@ -0,0 +1,258 @@
+import csv
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import fiona
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from rtree import index
+from satlomasproc.chips.utils import reproject_shape
+from satlomasproc.raster import COGOptions, open_raster
+from shapely.geometry import shape
+
+from .postprocess import sliding_windows
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+_logger = logging.getLogger(__name__)
+
+
+def check_same_grid(rasters):
+    """Raise an error if +rasters+ do not have the same size, CRS and transform"""
+    grids = []
+    for path in rasters:
+        with rasterio.open(path) as src:
+            grids.append((src.width, src.height, src.crs, src.transform))
+    for path, grid in zip(rasters[1:], grids[1:]):
+        if grid != grids[0]:
+            raise RuntimeError(f"{path} is not on the same grid as {rasters[0]}")
+
+
+class PolygonZones:
+    """
+    Polygons of a vector file, reprojected to +crs+, with an R-Tree index to
+    rasterize only the polygons that intersect each block.  Polygons are
+    identified by their position in the file, or by +id_property+.
+
+    Polygons should not overlap: where they do, pixels are counted for the
+    last one only.
+    """
+
+    def __init__(self, path, id_property=None, *, crs):
+        self.shapes = []
+        self.ids = []
+        with fiona.open(path) as src:
+            src_crs = CRS.from_user_input(src.crs_wkt) if src.crs_wkt else crs
+            for k, feat in enumerate(src):
+                shp = shape(feat["geometry"])
+                if src_crs != crs:
+                    shp = reproject_shape(shp, src_crs, crs)
+                self.shapes.append(shp)
+                self.ids.append(feat["properties"][id_property] if id_property else k)
+        self.index = index.Index()
+        for k, shp in enumerate(self.shapes):
+            self.index.insert(k, shp.bounds)
+        # The R-Tree index is shared by threads comparing different periods
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def rasterize(self, window, transform):
+        """
+        Return an array of polygon numbers (starting from 1, 0 is outside any
+        polygon) for +window+ of a raster with +transform+
+        """
+        bounds = rasterio.windows.bounds(window, transform)
+        with self.lock:
+            ks = sorted(self.index.intersection(bounds))
+        out_shape = (int(window.height), int(window.width))
+        if not ks:
+            return np.zeros(out_shape, dtype=np.uint32)
+        return rasterize(
+            ((self.shapes[k], k + 1) for k in ks),
+            out_shape=out_shape,
+            transform=rasterio.windows.transform(window, transform),
+            fill=0,
+            dtype=np.uint32,
+        )
+
+
+def change_mask(codes, transitions, n_values):
+    """
+    Return a change mask from transition +codes+ (from * n_values + to):
+    the position (starting from 1) of each pixel transition in +transitions+,
+    a list of (from, to) class pairs, or 0.  If +transitions+ is empty, the
+    mask is 1 where the class of valid pixels changed.
+    """
+    if not transitions:
+        from_, to = np.divmod(codes, n_values)
+        return ((from_ != to) & (from_ > 0) & (to > 0)).astype(np.uint8)
+    lut = np.zeros(n_values * n_values, dtype=np.uint8)
+    for k, (from_, to) in enumerate(transitions):
+        lut[from_ * n_values + to] = k + 1
+    return lut[codes]
+
+
+def compare_periods(
+    src_path,
+    dst_path,
+    transitions=None,
+    zones=None,
+    block_size=1024,
+    cog=None,
+    *,
+    num_classes,
+    output,
+):
+    """
+    Compare class rasters of two periods, +src_path+ (before) and +dst_path+
+    (after), on the same grid, in a single pass over blocks of +block_size+
+    pixels.
+
+    Writes a change mask to +output+ (see change_mask), and returns a
+    transition matrix of pixel counts, of shape (num_classes + 1,
+    num_classes + 1) with class 0 as nodata, and if +zones+ (PolygonZones)
+    are given, a transition matrix for each polygon, of shape (len(zones),
+    num_classes + 1, num_classes + 1).
+    """
+    n_values = num_classes + 1
+    matrix = np.zeros(n_values * n_values, dtype=np.int64)
+    zone_matrix = None
+    if zones is not None:
+        zone_matrix = np.zeros((len(zones) + 1) * n_values * n_values, np.int64)
+
+    with rasterio.open(src_path) as src, rasterio.open(dst_path) as dst:
+        profile = src.profile.copy()
+        profile.update(count=1, dtype=np.uint8, nodata=0)
+        cog = cog or COGOptions()
+        with open_raster(output, cog=cog, profile=profile) as out:
+            windows = sliding_windows(block_size, width=src.width, height=src.height)
+            for window, _ in windows:
+                before = src.read(1, window=window).astype(np.int64)
+                after = dst.read(1, window=window).astype(np.int64)
+                for img in (before, after):
+                    img[(img < 0) | (img > num_classes)] = 0
+                codes = before * n_values + after
+
+                matrix += np.bincount(codes.ravel(), minlength=n_values * n_values)
+                out.write(change_mask(codes, transitions, n_values), 1, window=window)
+
+                if zones is not None:
+                    zone_ids = zones.rasterize(window, src.transform)
+                    inside = zone_ids > 0
+                    if inside.any():
+                        keys = zone_ids[inside] * (n_values * n_values) + codes[inside]
+                        keys, counts = np.unique(keys, return_counts=True)
+                        zone_matrix[keys] += counts
+
+    matrix = matrix.reshape(n_values, n_values)
+    if zone_matrix is not None:
+        zone_matrix = zone_matrix.reshape(-1, n_values, n_values)[1:]
+    return matrix, zone_matrix
+
+
+def write_transition_matrix(matrix, pixel_area, *, output):
+    """Write a transition +matrix+ as a CSV table of areas (rows: from, cols: to)"""
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["from/to"] + list(range(len(matrix))))
+        for from_, row in enumerate(matrix):
+            writer.writerow([from_] + [n * pixel_area for n in row])
+
+
+def write_zone_stats(zone_matrix, pixel_area, *, zones, output):
+    """
+    Write non-zero transitions of each polygon as a CSV table, with columns
+    polygon, from, to, pixels and area
+    """
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["polygon", "from", "to", "pixels", "area"])
+        for k, from_, to in zip(*np.nonzero(zone_matrix)):
+            n = zone_matrix[k, from_, to]
+            writer.writerow([zones.ids[k], from_, to, n, n * pixel_area])
+
+
+def detect_changes(
+    rasters,
+    transitions=None,
+    polygons=None,
+    polygon_id_property=None,
+    block_size=1024,
+    workers=None,
+    cog=None,
+    *,
+    num_classes,
+    output_dir,
+):
+    """
+    Detect changes between class rasters of consecutive periods, in
+    +rasters+ (two or more, sorted by period and on the same grid).
+
+    Each pair of consecutive periods is compared in a single pass (see
+    compare_periods), and pairs are compared by a pool of +workers+ threads.
+    For each pair, these files are written to +output_dir+, named after both
+    rasters:
+
+      * <before>__<after>_changes.tif: change mask of +transitions+ (a list
+        of (from, to) class pairs, e.g. natural to artificial loma), or of
+        any class change if none are given.
+      * <before>__<after>_matrix.csv: transition matrix of areas between
+        classes (0 is nodata).
+      * <before>__<after>_polygons.csv: if a +polygons+ vector file is given,
+        area of each transition inside each polygon (identified by
+        +polygon_id_property+, or by their position in the file).
+
+    Returns a list of (before, after, matrix, zone_matrix) tuples, with
+    matrices of pixel counts.
+    """
+    if len(rasters) < 2:
+        raise RuntimeError("at least two rasters are needed to detect changes")
+    check_same_grid(rasters)
+
+    with rasterio.open(rasters[0]) as src:
+        crs = src.crs
+        pixel_area = abs(src.transform.a * src.transform.e)
+
+    zones = None
+    if polygons:
+        zones = PolygonZones(polygons, id_property=polygon_id_property, crs=crs)
+        _logger.info("Loaded %d polygons from %s", len(zones), polygons)
+
+    os.makedirs(output_dir, exist_ok=True)
+    pairs = list(zip(rasters[:-1], rasters[1:]))
+
+    def compare(pair):
+        before, after = pair
+        name = "__".join(
+            os.path.splitext(os.path.basename(path))[0] for path in (before, after)
+        )
+        base_path = os.path.join(output_dir, name)
+        matrix, zone_matrix = compare_periods(
+            before,
+            after,
+            transitions=transitions,
+            zones=zones,
+            block_size=block_size,
+            cog=cog,
+            num_classes=num_classes,
+            output=f"{base_path}_changes.tif",
+        )
+        write_transition_matrix(matrix, pixel_area, output=f"{base_path}_matrix.csv")
+        if zone_matrix is not None:
+            write_zone_stats(
+                zone_matrix, pixel_area, zones=zones, output=f"{base_path}_polygons.csv"
+            )
+        _logger.info("Changes between %s and %s written", before, after)
+        return before, after, matrix, zone_matrix
+
+    with ThreadPoolExecutor(workers or len(pairs)) as executor:
+        return list(executor.map(compare, pairs))
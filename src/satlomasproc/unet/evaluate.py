@@ -3,7 +3,7 @@ from glob import glob
 
 import matplotlib.pyplot as plt
 
-from satlomasproc.unet.train import build_data_generator
+from satlomasproc.unet.train import ChipSequence
 
 
 def plot_data_generator(num_samples=3, fig_size=(20, 10), *, train_config):
@@ -12,9 +12,10 @@ def plot_data_generator(num_samples=3, fig_size=(20, 10), *, train_config):
 
     images = glob(os.path.join(images_dir, '*.tif'))
 
-    data_generator = build_data_generator(images,
-                                          config=train_config,
-                                          mask_dir=mask_dir)
+    data_generator = ChipSequence(images,
+                                  config=train_config,
+                                  mask_dir=mask_dir,
+                                  steps=num_samples)
 
     def plot_samples(plt, generator, num):
         j = 0
@@ -0,0 +1,135 @@
+import logging
+import os
+import time
+from glob import glob
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from satlomasproc.chips.shards import ChipShardDataset
+from satlomasproc.unet.predict import read_batch
+from satlomasproc.unet.tflite import TFLiteModel
+from satlomasproc.unet.train import build_model
+from satlomasproc.unet.utils import grouper
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+_logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ("dynamic", "float16", "int8")
+
+
+def list_chips(images_path):
+    """
+    Return the chips in +images_path+ (paths, or indexes if it contains
+    shards), and the ChipShardDataset or None.
+    """
+    if ChipShardDataset.exists(images_path):
+        dataset = ChipShardDataset(images_path)
+        return list(range(len(dataset))), dataset
+    return sorted(glob(os.path.join(images_path, "images", "*.tif"))), None
+
+
+def export_tflite(
+    cfg, quantization=None, images_path=None, max_samples=100, *, output
+):
+    """
+    Export the Keras model in +cfg.model_path+ to a TFLite model in +output+.
+
+    The graph is built in inference mode (learning phase 0), so Dropout
+    layers are removed and BatchNormalization layers use their moving
+    statistics and are folded into constant multiply-adds by the converter.
+
+    +quantization+ can be:
+      - 'dynamic': weights are quantized to int8
+      - 'float16': weights are quantized to float16
+      - 'int8': weights and activations are quantized to int8, calibrated on
+        up to +max_samples+ chips from +images_path+ (required)
+    """
+    if quantization and quantization not in QUANTIZATIONS:
+        raise RuntimeError(f"unknown quantization {quantization}")
+    if quantization == "int8" and not images_path:
+        raise RuntimeError("int8 quantization requires images to calibrate on")
+
+    K.clear_session()
+    K.set_learning_phase(0)
+    model = build_model(cfg)
+    model.load_weights(cfg.model_path)
+
+    converter = tf.lite.TFLiteConverter.from_session(
+        K.get_session(), model.inputs, model.outputs
+    )
+    if quantization:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        chips, dataset = list_chips(images_path)
+        chips = chips[:max_samples]
+
+        def representative_dataset():
+            for chip in chips:
+                X, _, _ = read_batch([chip], cfg=cfg, dataset=dataset)
+                yield [X.astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    tflite_model = converter.convert()
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "wb") as f:
+        f.write(tflite_model)
+    _logger.info("%s written (%d bytes)", output, len(tflite_model))
+
+
+def iou(a, b):
+    """Return the IoU of boolean masks +a+ and +b+ (1 if both are empty)"""
+    union = np.logical_or(a, b).sum()
+    if not union:
+        return 1.0
+    return np.logical_and(a, b).sum() / union
+
+
+def compare_models(
+    cfg, tflite_path, threshold=0.5, max_samples=None, *, images_path
+):
+    """
+    Predict chips in +images_path+ with both the Keras model in
+    +cfg.model_path+ and the TFLite model in +tflite_path+, and return a
+    dict with the IoU between their binarized (>= +threshold+) predictions,
+    the maximum absolute difference of probabilities, and the throughput
+    (chips/s) of each model.
+    """
+    chips, dataset = list_chips(images_path)
+    if max_samples:
+        chips = chips[:max_samples]
+    if not chips:
+        raise RuntimeError(f"{images_path} does not contain any chip")
+
+    batches = [
+        read_batch([c for c in group if c is not None], cfg=cfg, dataset=dataset)[0]
+        for group in grouper(chips, cfg.batch_size)
+    ]
+
+    def run(model):
+        # Warm up (allocate tensors, build functions) before timing
+        model.predict(batches[0])
+        start = time.perf_counter()
+        preds = np.concatenate([model.predict(X) for X in batches])
+        return preds, len(chips) / (time.perf_counter() - start)
+
+    K.clear_session()
+    K.set_learning_phase(0)
+    keras_model = build_model(cfg)
+    keras_model.load_weights(cfg.model_path)
+    keras_preds, keras_speed = run(keras_model)
+    tflite_preds, tflite_speed = run(TFLiteModel(tflite_path))
+
+    return dict(
+        iou=iou(keras_preds >= threshold, tflite_preds >= threshold),
+        max_abs_diff=float(np.abs(keras_preds - tflite_preds).max()),
+        keras_chips_per_sec=keras_speed,
+        tflite_chips_per_sec=tflite_speed,
+    )
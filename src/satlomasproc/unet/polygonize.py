@@ -0,0 +1,320 @@
+import logging
+import multiprocessing as mp
+import os
+
+import fiona
+import rasterio
+from rasterio.features import shapes
+from rasterio.transform import Affine
+from rtree import index
+from shapely.affinity import affine_transform
+from shapely.geometry import mapping, shape
+from shapely.ops import unary_union
+from tqdm import tqdm
+
+from .postprocess import sliding_windows
+
+try:
+    from shapely import coverage_simplify, segmentize
+except ImportError:
+    # Shapely < 2.1
+    coverage_simplify = segmentize = None
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+_logger = logging.getLogger(__name__)
+
+# Output vector formats, by file extension: fiona driver
+VECTOR_DRIVERS = {".gpkg": "GPKG", ".fgb": "FlatGeobuf"}
+
+SCHEMA = {"geometry": "Polygon", "properties": {"class": "int", "area": "float"}}
+
+# Per-process state for parallel polygonization.
+_worker_state = {}
+
+
+def _init_polygonize_worker(src_path, band, simplify, min_area, coverage):
+    _worker_state.update(
+        src=rasterio.open(src_path),
+        band=band,
+        simplify=simplify,
+        min_area=min_area,
+        coverage=coverage,
+    )
+
+
+def shared_edges(geoms, values=None):
+    """
+    Yield pairs (k, m), with k < m, of +geoms+ that share an edge (not only a
+    corner), using an R-Tree index to find neighbour candidates.  If
+    +values+ are given, only pairs with the same value are returned.
+    """
+    idx = index.Index()
+    for k, geom in enumerate(geoms):
+        idx.insert(k, geom.bounds)
+    for k, geom in enumerate(geoms):
+        for m in idx.intersection(geom.bounds):
+            if m <= k or (values is not None and values[m] != values[k]):
+                continue
+            if geom.intersection(geoms[m]).length > 0:
+                yield k, m
+
+
+def connected_groups(n, pairs):
+    """Return groups of indexes in range(+n+) connected by +pairs+"""
+    parents = list(range(n))
+
+    def find(k):
+        while parents[k] != k:
+            parents[k] = parents[parents[k]]
+            k = parents[k]
+        return k
+
+    for k, m in pairs:
+        parents[find(m)] = find(k)
+
+    groups = {}
+    for k in range(n):
+        groups.setdefault(find(k), []).append(k)
+    return list(groups.values())
+
+
+def finish_polygons(polygons, simplify=0.0, min_area=0.0, coverage=False, *, transform):
+    """
+    Transform +polygons+ (class, geometry) pairs from pixel coordinates to
+    CRS coordinates with +transform+, simplify them with a +simplify+
+    tolerance (in CRS units), and return their polygon parts with an area of
+    at least +min_area+ (in CRS square units).
+
+    Each polygon is simplified on its own, unless +coverage+ is true, in
+    which case polygons are simplified together as a coverage, so that
+    boundaries shared by polygons in +polygons+ are simplified the same way,
+    without gaps or overlaps between them (needs Shapely 2.1 or later).
+    """
+    t = transform
+    matrix = [t.a, t.b, t.d, t.e, t.c, t.f]
+    geoms = [geom for _, geom in polygons]
+    coverage = simplify and coverage
+    if coverage:
+        # Add a vertex on each pixel corner, so that shared boundaries have
+        # the same vertices on both sides, as coverage simplification expects
+        geoms = [segmentize(geom, 1) for geom in geoms]
+    geoms = [affine_transform(geom, matrix) for geom in geoms]
+    if simplify and geoms:
+        if coverage:
+            geoms = coverage_simplify(geoms, simplify)
+        else:
+            geoms = [g.simplify(simplify, preserve_topology=True) for g in geoms]
+    res = []
+    for (value, _), geom in zip(polygons, geoms):
+        parts = getattr(geom, "geoms", [geom])
+        res.extend((value, p) for p in parts if not p.is_empty and p.area >= min_area)
+    return res
+
+
+def dissolve_seams(polygons, link_classes=False):
+    """
+    Dissolve +polygons+ (class, geometry) of the same class that share an
+    edge.  Returns a list of groups of dissolved (class, geometry) pairs:
+    each dissolved polygon is a group of its own, unless +link_classes+ is
+    true, in which case polygons of different classes that share an edge are
+    in the same group.
+    """
+    values = [value for value, _ in polygons]
+    geoms = [geom for _, geom in polygons]
+
+    dissolved = []
+    for ks in connected_groups(len(polygons), shared_edges(geoms, values)):
+        value = values[ks[0]]
+        if len(ks) == 1:
+            dissolved.append((value, geoms[ks[0]]))
+        else:
+            dissolved.append((value, unary_union([geoms[k] for k in ks])))
+
+    if not link_classes:
+        return [[p] for p in dissolved]
+    dissolved_geoms = [geom for _, geom in dissolved]
+    return [
+        [dissolved[k] for k in ks]
+        for ks in connected_groups(len(dissolved), shared_edges(dissolved_geoms))
+    ]
+
+
+def _polygonize_tile(window):
+    """
+    Polygonize a tile of the class raster, in pixel coordinates of the whole
+    raster (so that polygons of neighbouring tiles have exactly the same
+    vertices along their seam).
+
+    Returns finished polygons (in CRS coordinates) that do not touch an inner
+    tile edge, and polygons (still in pixel coordinates) that do, to be dissolved
+    with those of neighbouring tiles, as (class, geometry) pairs.  When
+    simplifying, polygons that share a boundary with a seam polygon are
+    returned as seam polygons too when simplifying as a coverage, so that
+    they are simplified together.
+    """
+    st = _worker_state
+    src = st["src"]
+    img = src.read(st["band"], window=window)
+    valid = img != (src.nodata if src.nodata is not None else 0)
+    if not valid.any():
+        return [], []
+
+    # Inner tile edges that polygons may cross, in pixel coordinates
+    left, top = window.col_off, window.row_off
+    right, bottom = left + window.width, top + window.height
+    t = Affine.translation(left, top)
+    polygons = []
+    touches = []
+    for geom, value in shapes(img, mask=valid, transform=t):
+        geom = shape(geom)
+        minx, miny, maxx, maxy = geom.bounds
+        polygons.append((int(value), geom))
+        touches.append(
+            (left > 0 and minx == left)
+            or (top > 0 and miny == top)
+            or (right < src.width and maxx == right)
+            or (bottom < src.height and maxy == bottom)
+        )
+
+    if st["simplify"] and st["coverage"]:
+        geoms = [geom for _, geom in polygons]
+        groups = connected_groups(len(polygons), shared_edges(geoms))
+    else:
+        groups = [[k] for k in range(len(polygons))]
+
+    inner, seam = [], []
+    for ks in groups:
+        if any(touches[k] for k in ks):
+            seam.extend(polygons[k] for k in ks)
+        else:
+            inner.extend(polygons[k] for k in ks)
+    inner = finish_polygons(
+        inner,
+        st["simplify"],
+        st["min_area"],
+        st["coverage"],
+        transform=src.transform,
+    )
+    return inner, seam
+
+
+def polygonize(
+    src_path,
+    simplify=0.0,
+    min_area=0.0,
+    band=1,
+    tile_size=1024,
+    workers=None,
+    batch_size=1000,
+    coverage=False,
+    *,
+    output,
+):
+    """
+    Polygonize a class raster (e.g. from coalesce_and_binarize_raster) into
+    a vector file of class polygons in +output+ (GeoPackage or FlatGeobuf,
+    by its extension).  Nodata pixels (or 0) are not polygonized.
+
+    The raster is split into tiles of +tile_size+ pixels, polygonized by
+    +workers+ processes in the pixel grid of the whole raster.  Polygons
+    inside a tile are simplified (with a +simplify+ tolerance, in CRS
+    units), filtered by +min_area+ (in CRS square units) and written as soon
+    as their tile is done, in batches of +batch_size+ features.  Polygons
+    that touch a tile seam are dissolved with those of neighbouring tiles
+    once each row of tiles is done, and only those that touch the bottom of
+    the last row are kept in memory for the next one.
+
+    Each polygon is simplified on its own by default, so neighbouring
+    polygons of different classes may have small gaps or overlaps between
+    them.  If +coverage+ is true, polygons that share a boundary are
+    simplified together (see finish_polygons), so simplification does not
+    open gaps or overlaps between classes.  To do so, polygons of different
+    classes that share a boundary across a tile seam are kept until all of
+    them are done, which may keep large parts of the raster in memory for
+    class rasters without nodata.
+
+    Each feature has its class value and area.
+    """
+    _, ext = os.path.splitext(output)
+    if ext not in VECTOR_DRIVERS:
+        formats = ", ".join(VECTOR_DRIVERS)
+        raise RuntimeError(f"unknown output format {ext} (must be one of {formats})")
+    if coverage and simplify and coverage_simplify is None:
+        raise RuntimeError("coverage simplification needs Shapely 2.1 or later")
+    if not workers:
+        workers = mp.cpu_count()
+
+    with rasterio.open(src_path) as src:
+        crs_wkt = src.crs.to_wkt() if src.crs else None
+        transform = src.transform
+        width, height = src.width, src.height
+    windows = [w for w, _ in sliding_windows(tile_size, width=width, height=height)]
+    _logger.info("Polygonize %d tiles with %d workers", len(windows), workers)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    if os.path.exists(output):
+        os.unlink(output)
+
+    n_features = 0
+    with fiona.open(
+        output, "w", driver=VECTOR_DRIVERS[ext], schema=SCHEMA, crs_wkt=crs_wkt
+    ) as dst:
+        batch = []
+
+        def write(polygons):
+            nonlocal batch, n_features
+            for value, geom in polygons:
+                batch.append(
+                    {
+                        "geometry": mapping(geom),
+                        "properties": {"class": value, "area": geom.area},
+                    }
+                )
+                n_features += 1
+                if len(batch) >= batch_size:
+                    dst.writerecords(batch)
+                    batch = []
+
+        def flush_seams(seam, bottom):
+            """
+            Dissolve +seam+ polygons of all tiles up to a row that ends at
+            +bottom+, write those that are done, and return the rest
+            """
+            groups = dissolve_seams(seam, link_classes=bool(simplify and coverage))
+            done, pending = [], []
+            for group in groups:
+                if bottom < height and any(g.bounds[3] == bottom for _, g in group):
+                    pending.extend(group)
+                else:
+                    done.extend(group)
+            write(
+                finish_polygons(done, simplify, min_area, coverage, transform=transform)
+            )
+            return pending
+
+        seam = []
+        with mp.Pool(
+            workers,
+            initializer=_init_polygonize_worker,
+            initargs=(src_path, band, simplify, min_area, coverage),
+        ) as pool:
+            results = pool.imap(_polygonize_tile, windows)
+            for window, (tile_inner, tile_seam) in tqdm(
+                zip(windows, results), total=len(windows)
+            ):
+                write(tile_inner)
+                seam.extend(tile_seam)
+                # Tiles are polygonized by rows, so once the last tile of a
+                # row is done, seam polygons above its bottom are complete
+                if window.col_off + window.width == width and seam:
+                    bottom = window.row_off + window.height
+                    _logger.debug("Dissolve %d polygons along tile seams", len(seam))
+                    seam = flush_seams(seam, bottom)
+
+        if batch:
+            dst.writerecords(batch)
+
+    _logger.info("%d polygons written to %s", n_features, output)
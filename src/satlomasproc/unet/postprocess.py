@@ -2,25 +2,33 @@ import logging
 import math
 import os
 import sys
-import tempfile
+import threading
+import xml.etree.ElementTree as ET
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from glob import glob
 
 import numpy as np
 import rasterio
+import rasterio.errors
 import rasterio.mask
-import rasterio.merge
 import rasterio.windows
-import scipy.signal
-from django.conf import settings
+import scipy.signal.windows
 from rasterio.transform import Affine
 from rasterio.windows import Window
 from rtree import index
 from shapely.geometry import box
 from tqdm import tqdm
 
-from .utils import grouper, run_command
+from satlomasproc.raster import (
+    COGOptions,
+    OverviewBuilder,
+    open_raster,
+    write_raster,
+)
+
+from .utils import prefetch
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -40,10 +48,10 @@ def spline_window(window_size, power=2):
     https://www.wolframalpha.com/input/?i=y%3Dx**2,+y%3D-(x-2)**2+%2B2,+y%3D(x-4)**2,+from+y+%3D+0+to+2
     """
     intersection = int(window_size / 4)
-    wind_outer = (abs(2 * (scipy.signal.triang(window_size))) ** power) / 2
+    wind_outer = (abs(2 * (scipy.signal.windows.triang(window_size))) ** power) / 2
     wind_outer[intersection:-intersection] = 0
 
-    wind_inner = 1 - (abs(2 * (scipy.signal.triang(window_size) - 1)) ** power) / 2
+    wind_inner = 1 - (abs(2 * (scipy.signal.windows.triang(window_size) - 1)) ** power) / 2
     wind_inner[:intersection] = 0
     wind_inner[-intersection:] = 0
 
@@ -60,56 +68,17 @@ def window_2D(size, power=2, n_channels=1):
     return np.repeat(wind, n_channels, axis=0).reshape(n_channels, size, size)
 
 
-def generate_spline_window_chips(*, image_paths, output_dir):
-    """Interpolates all images using a squared spline window"""
-    if not image_paths:
-        return []
-
-    first_image = image_paths[0]
-    with rasterio.open(first_image) as src:
-        chip_size = src.width
-        n_channels = src.count
-        assert src.width == src.height
-
-    spline_window = window_2D(size=chip_size, power=2, n_channels=n_channels)
-
-    res = []
-    for img_path in tqdm(image_paths):
-        with rasterio.open(img_path) as src:
-            profile = src.profile.copy()
-            img = src.read()
-
-        img = (img * spline_window).astype(np.uint8)
-
-        out_path = os.path.join(output_dir, os.path.basename(img_path))
-        os.makedirs(output_dir, exist_ok=True)
-        res.append(out_path)
-        with rasterio.open(out_path, "w", **profile) as dst:
-            for i in range(img.shape[0]):
-                dst.write(img[i, :, :], i + 1)
-
-    return res
-
-
-# Based on 'max' method from https://github.com/mapbox/rasterio/blob/master/rasterio/merge.py
-def mean_merge_method(
-    old_data, new_data, old_nodata, new_nodata, index=None, roff=None, coff=None
-):
-    mask = np.logical_and(~old_nodata, ~new_nodata)
-    old_data[mask] = np.mean([old_data[mask], new_data[mask]], axis=0)
-
-    mask = np.logical_and(old_nodata, ~new_nodata)
-    old_data[mask] = new_data[mask]
-
-
 def build_bounds_index(image_files):
     """Returns bounds of merged images and builds an R-Tree index"""
+    return build_index_from_bounds(get_chips_bounds(image_files))
+
+
+def build_index_from_bounds(chips_bounds):
+    """Returns bounds of merged +chips_bounds+ and builds an R-Tree index"""
     idx = index.Index()
     xs = []
     ys = []
-    for i, img_path in tqdm(list(enumerate(image_files))):
-        with rasterio.open(img_path) as src:
-            left, bottom, right, top = src.bounds
+    for i, (left, bottom, right, top) in enumerate(chips_bounds):
         xs.extend([left, right])
         ys.extend([bottom, top])
         idx.insert(i, (left, bottom, right, top))
@@ -132,21 +101,145 @@ def sliding_windows(size, whole=False, step_size=None, *, width, height):
             yield rasterio.windows.Window(j, i, real_w, real_h), (pos_i, pos_j)
 
 
-def merge_chips(images_files, *, win_bounds):
-    """Merge by taking mean between overlapping images"""
-    datasets = [rasterio.open(p) for p in images_files]
-    img, _ = rasterio.merge.merge(datasets, bounds=win_bounds, method=mean_merge_method)
-    for ds in datasets:
-        ds.close()
-    return img
+def get_chips_bounds(image_files):
+    """Returns the bounds of each image"""
+    res = []
+    for img_path in image_files:
+        with rasterio.open(img_path) as src:
+            res.append(src.bounds)
+    return res
 
 
-def smooth_stitch(*, input_dir, output_dir):
+def get_output_grid(bounds, res):
+    """
+    Returns the affine transform, width and height of a grid with resolution
+    +res+ that covers +bounds+ completely
+    """
+    dst_w, dst_s, dst_e, dst_n = bounds
+
+    # Get affine transform for complete bounds
+    logger.info("Output bounds: %r", (dst_w, dst_s, dst_e, dst_n))
+    output_transform = Affine.translation(dst_w, dst_n)
+    logger.info("Output transform, before scaling: %r", output_transform)
+
+    output_transform *= Affine.scale(res[0], -res[1])
+    logger.info("Output transform, after scaling: %r", output_transform)
+
+    # Compute output array shape. We guarantee it will cover the output
+    # bounds completely. We need this to build windows list later.
+    output_width = int(math.ceil((dst_e - dst_w) / res[0]))
+    output_height = int(math.ceil((dst_n - dst_s) / res[1]))
+
+    return output_transform, output_width, output_height
+
+
+def cast_to_dtype(img, dtype):
+    """Round and clip +img+ to the range of +dtype+ if it is an integer type"""
+    dtype = np.dtype(dtype)
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        img = np.clip(np.round(img), info.min, info.max)
+    return img.astype(dtype)
+
+
+# Per-process state for parallel stitching.
+_stitch_state = {}
+
+
+def _init_stitch_worker(state):
+    _stitch_state.update(state)
+
+
+def _stitch_band(band):
+    """
+    Stitch the output chips of a row band, from the chips that overlap it.
+
+    Only the rows of each chip inside the band are read and added to the
+    band accumulators, in the same order as chips are listed, so the result
+    does not depend on how the output is split into bands.
+    """
+    (row_start, row_end), chip_ids, windows = band
+    st = _stitch_state
+    nodata = st["nodata"]
+    band_height = row_end - row_start
+
+    acc = np.zeros((st["count"], band_height, st["width"]), dtype=np.float32)
+    acc_weights = np.zeros((band_height, st["width"]), dtype=np.float32)
+
+    for k in chip_ids:
+        row, col = st["offsets"][k]
+        chip_size = st["spline_window"].shape[0]
+        start, end = max(row, row_start), min(row + chip_size, row_end)
+        if start >= end:
+            continue
+
+        # Read only chip rows inside the band
+        with rasterio.open(st["image_paths"][k]) as src:
+            img = src.read(window=Window(0, start - row, src.width, end - start))
+
+        weights = st["spline_window"][start - row : end - row, : img.shape[2]]
+        if nodata is not None:
+            weights = weights * (img != nodata).any(axis=0)
+        rows = slice(start - row_start, end - row_start)
+        cols = slice(col, col + img.shape[2])
+        acc[:, rows, cols] += img * weights
+        acc_weights[rows, cols] += weights
+
+    profile = st["profile"].copy()
+    written = 0
+    with OverviewBuilder() as overviews:
+        for win, (i, j) in windows:
+            rows = slice(win.row_off - row_start, win.row_off - row_start + win.height)
+            cols = slice(win.col_off, win.col_off + win.width)
+
+            # Skip windows without any chip
+            weights = acc_weights[rows, cols]
+            if not (weights > 0).any():
+                continue
+
+            img = np.zeros((st["count"], win.height, win.width), dtype=np.float32)
+            np.divide(acc[:, rows, cols], weights, out=img, where=weights > 0)
+            img = cast_to_dtype(img, profile["dtype"])
+            if nodata is not None:
+                img[:, weights == 0] = nodata
+
+            # Write output chip
+            profile.update(
+                width=win.width,
+                height=win.height,
+                transform=rasterio.windows.transform(win, st["output_transform"]),
+            )
+            output_path = os.path.join(st["output_dir"], f"{i}_{j}.tif")
+            write_raster(
+                img,
+                output_path,
+                cog=st["cog"],
+                overview_builder=overviews,
+                profile=profile,
+            )
+            written += 1
+
+    return written
+
+
+def smooth_stitch(workers=1, cog=None, *, input_dir, output_dir):
     """
     Takes input directory of overlapping chips, and generates a new directory
     of non-overlapping chips with smooth edges.
+
+    Each chip is weighted with a squared spline window, and output chips are
+    the weighted mean of all chips overlapping each pixel (nodata pixels of
+    chips are not counted).
+
+    The output is split into row bands of chips, which are stitched
+    independently by +workers+ processes, from the chips overlapping each
+    band (found with an R-Tree index).  The result is the same for any
+    number of workers.
+
+    Output chips are written as COGs if +cog+ options are given (see
+    satlomasproc.raster).
     """
-    image_paths = glob(os.path.join(input_dir, "*.tif"))
+    image_paths = sorted(glob(os.path.join(input_dir, "*.tif")))
     if not image_paths:
         raise RuntimeError("%s does not contain any .tif file" % (input_dir))
 
@@ -158,154 +251,333 @@ def smooth_stitch(*, input_dir, output_dir):
         chip_size = src.width
         assert src.width == src.height
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmp_image_paths = generate_spline_window_chips(
-            image_paths=image_paths, output_dir=tmpdir
-        )
-
-        # Get bounds from all images and build R-Tree index
-        idx, (dst_w, dst_s, dst_e, dst_n) = build_bounds_index(tmp_image_paths)
-
-        # Get affine transform for complete bounds
-        logger.info("Output bounds: %r", (dst_w, dst_s, dst_e, dst_n))
-        output_transform = Affine.translation(dst_w, dst_n)
-        logger.info("Output transform, before scaling: %r", output_transform)
+    # Get bounds from all images and build R-Tree index
+    chips_bounds = get_chips_bounds(image_paths)
+    idx, (dst_w, dst_s, dst_e, dst_n) = build_index_from_bounds(chips_bounds)
 
-        output_transform *= Affine.scale(src_res[0], -src_res[1])
-        logger.info("Output transform, after scaling: %r", output_transform)
-
-        # Compute output array shape. We guarantee it will cover the output
-        # bounds completely. We need this to build windows list later.
-        output_width = int(math.ceil((dst_e - dst_w) / src_res[0]))
-        output_height = int(math.ceil((dst_n - dst_s) / src_res[1]))
-
-        # Set width and height for output chips, and other attributes
-        profile.update(width=chip_size, height=chip_size, tiled=True)
+    output_transform, output_width, output_height = get_output_grid(
+        (dst_w, dst_s, dst_e, dst_n), src_res
+    )
 
-        windows = list(
-            sliding_windows(chip_size, width=output_width, height=output_height)
+    # Output chips are tiled, and have the size of each window
+    profile.update(tiled=True)
+
+    windows = list(sliding_windows(chip_size, width=output_width, height=output_height))
+    logger.info("Num. windows: %d", len(windows))
+
+    # Split windows into row bands, and find the chips that overlap each band
+    rows = {}
+    for win, (i, j) in windows:
+        rows.setdefault(i, []).append((win, (i, j)))
+    bands = []
+    for row_windows in rows.values():
+        win = row_windows[0][0]
+        row_start, row_end = win.row_off, win.row_off + win.height
+        band_bounds = (
+            dst_w,
+            dst_n - row_end * src_res[1],
+            dst_e,
+            dst_n - row_start * src_res[1],
         )
-        logger.info("Num. windows: %d", len(windows))
-
-        for win, (i, j) in tqdm(windows):
-            # Get window affine transform and bounds
-            win_transform = rasterio.windows.transform(win, output_transform)
-            win_bounds = rasterio.windows.bounds(win, output_transform)
-
-            # Get chips that intersect with window
-            intersect_chip_paths = [
-                tmp_image_paths[i] for i in idx.intersection(win_bounds)
-            ]
-
-            if intersect_chip_paths:
-                # Merge them with median method
-                img = merge_chips(intersect_chip_paths, win_bounds=win_bounds)
-
-                # Write output chip
-                profile.update(transform=win_transform)
-                output_path = os.path.join(output_dir, f"{i}_{j}.tif")
+        chip_ids = sorted(idx.intersection(band_bounds))
+        if chip_ids:
+            bands.append(((row_start, row_end), chip_ids, row_windows))
+    logger.info("Num. row bands: %d", len(bands))
+
+    state = dict(
+        image_paths=image_paths,
+        # Pixel offset of each chip in output
+        offsets=[
+            (
+                int(round((dst_n - b.top) / src_res[1])),
+                int(round((b.left - dst_w) / src_res[0])),
+            )
+            for b in chips_bounds
+        ],
+        spline_window=window_2D(size=chip_size, power=2, n_channels=1)[0],
+        count=profile["count"],
+        nodata=profile["nodata"],
+        width=output_width,
+        profile=profile,
+        output_transform=output_transform,
+        output_dir=output_dir,
+        cog=cog,
+    )
 
-                os.makedirs(output_dir, exist_ok=True)
-                with rasterio.open(output_path, "w", **profile) as dst:
-                    for i in range(img.shape[0]):
-                        dst.write(img[i, :, :], i + 1)
+    os.makedirs(output_dir, exist_ok=True)
+    if workers > 1:
+        with mp.Pool(
+            workers, initializer=_init_stitch_worker, initargs=(state,)
+        ) as pool:
+            list(tqdm(pool.imap_unordered(_stitch_band, bands), total=len(bands)))
+    else:
+        _init_stitch_worker(state)
+        for band in tqdm(bands):
+            _stitch_band(band)
+
+
+def coalesce_and_binarize_array(img, threshold=0.5):
+    """
+    Return a class image from a band-major (bands, height, width) array of
+    class probabilities (0-255): the class with max probability (starting
+    from 1), where any class probability is at least +threshold+, or 0.
+    """
+    mask = (img >= threshold * 255).any(axis=0)
+    max_img = np.argmax(img, axis=0).astype(np.uint8)
+    max_img += 1
+    max_img *= mask
+    return max_img
 
 
-def coalesce_and_binarize(src_path, threshold=0.5, *, output_dir):
+def coalesce_and_binarize(src_path, threshold=0.5, cog=None, *, output_dir):
     # Read image
     with rasterio.open(src_path) as src:
         profile = src.profile.copy()
-        img = np.dstack(src.read())
-
-    # Build mask
-    mask_t = threshold * 255
-    mask = img[:, :, 0] >= mask_t
-    for b in range(1, img.shape[2]):
-        mask = mask | (img[:, :, b] >= mask_t)
-    mask = mask.astype(np.uint8)
+        img = src.read()
 
-    # Get class with max probability and apply mask
-    max_img = ((np.argmax(img, axis=2) + 1) * mask).astype(np.uint8)
+    max_img = coalesce_and_binarize_array(img, threshold)
 
     # Write image
     dst_path = os.path.join(output_dir, os.path.basename(src_path))
     profile.update(count=1, nodata=0, dtype=np.uint8)
-    with rasterio.open(dst_path, "w", **profile) as dst:
-        dst.write(max_img, 1)
+    write_raster(max_img[np.newaxis], dst_path, cog=cog, profile=profile)
 
 
-def coalesce_and_binarize_all(threshold=0.75, *, input_dir, output_dir):
+def coalesce_and_binarize_all(threshold=0.75, cog=None, *, input_dir, output_dir):
     images = glob(os.path.join(input_dir, "*.tif"))
     os.makedirs(output_dir, exist_ok=True)
-    with mp.Pool(mp.cpu_count()) as pool:
-        worker = partial(coalesce_and_binarize, threshold=threshold, output_dir=output_dir)
-        pool.map(worker, images)
+    workers = mp.cpu_count()
+    # Send chips in chunks, so that workers are not dominated by IPC
+    chunksize = max(1, len(images) // (workers * 4))
+    with mp.Pool(workers) as pool:
+        worker = partial(
+            coalesce_and_binarize, threshold=threshold, cog=cog, output_dir=output_dir
+        )
+        pool.map(worker, images, chunksize=chunksize)
 
 
-def remove_negative_class(src_path, *, num_class, output_dir):
+def coalesce_and_binarize_raster(
+    src_path, threshold=0.5, workers=None, cog=None, *, output
+):
+    """
+    Coalesce and binarize a whole probability raster (e.g. a stitched
+    prediction) into a single class raster in +output+.
+
+    The output is a COG (see +cog+, or satlomasproc.raster.COGOptions for
+    defaults), processed by blocks: each block is read, coalesced and
+    binarized by a pool of +workers+ threads (each one with its own dataset
+    handle), and written in order.
+    """
+    if not workers:
+        workers = mp.cpu_count()
+
+    with rasterio.open(src_path) as src:
+        profile = src.profile.copy()
+    profile.update(count=1, nodata=0, dtype=np.uint8)
+    cog = cog or COGOptions()
+
+    local = threading.local()
+    datasets = []
+
+    def process(window):
+        if not hasattr(local, "src"):
+            local.src = rasterio.open(src_path)
+            datasets.append(local.src)
+        img = local.src.read(window=window)
+        return window, coalesce_and_binarize_array(img, threshold)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    try:
+        with open_raster(output, cog=cog, profile=profile) as dst:
+            windows = [w for _, w in dst.block_windows(1)]
+            with ThreadPoolExecutor(workers) as executor:
+                results = prefetch(executor, process, windows, size=workers * 2)
+                for window, max_img in tqdm(results, total=len(windows)):
+                    dst.write(max_img, 1, window=window)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+
+def remove_negative_class(src_path, cog=None, *, num_class, output_dir):
     dst_path = os.path.join(output_dir, os.path.basename(src_path))
     with rasterio.open(src_path) as src:
-        with rasterio.open(dst_path, "w", **src.profile) as dst:
-            img = src.read()
-            img[img == num_class] = src.nodata
-            dst.write(img)
+        img = src.read()
+        img[img == num_class] = src.nodata
+        write_raster(img, dst_path, cog=cog, profile=src.profile)
 
 
-def remove_negative_class_all(*, input_dir, output_dir, num_class):
+def remove_negative_class_all(cog=None, *, input_dir, output_dir, num_class):
     images = glob(os.path.join(input_dir, "*.tif"))
     os.makedirs(output_dir, exist_ok=True)
     with mp.Pool(mp.cpu_count()) as pool:
-        worker = partial(remove_negative_class, num_class=num_class, output_dir=output_dir)
+        worker = partial(
+            remove_negative_class, cog=cog, num_class=num_class, output_dir=output_dir
+        )
         pool.map(worker, images)
 
 
-def gdal_merge(output, files, quiet=False):
-    gdal_merge_bin = f"{settings.GDAL_BIN_PATH}/gdal_merge.py"
-    cmd = (
-        f"{gdal_merge_bin} -n 0 -a_nodata 0 "
-        f"-co TILED=YES "
-        f"-o {output} {' '.join(files)}"
-    )
-    run_command(cmd, quiet=quiet)
+GDAL_DATA_TYPES = {
+    "uint8": "Byte",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
 
 
-def gdalwarp_merge(output, files, quiet=False):
-    gdalwarp_bin = f"{settings.GDAL_BIN_PATH}/gdalwarp"
-    cmd = (
-        f"{gdalwarp_bin} -srcnodata 0 -dstnodata 0 "
-        f"-overwrite -multi -wo NUM_THREADS=ALL_CPUS "
-        f"{' '.join(files)} {output}"
-    )
-    run_command(cmd, quiet=quiet)
+def chip_windows(chips_bounds, *, transform):
+    """Returns the window of each chip in the grid of +transform+"""
+    res = []
+    for left, bottom, right, top in chips_bounds:
+        col, row = ~transform * (left, top)
+        col_end, row_end = ~transform * (right, bottom)
+        col, row = int(round(col)), int(round(row))
+        width, height = int(round(col_end)) - col, int(round(row_end)) - row
+        res.append(Window(col, row, width, height))
+    return res
 
 
-def merge_all(batch_size=500, temp_dir=None, *, input_dir, output):
-    files = sorted(list(glob(os.path.join(input_dir, "*.tif"))))
+def write_mosaic_vrt(files, windows, *, profile, nodata, output):
+    """
+    Write a VRT mosaic of +files+, placed at +windows+ of the grid in
+    +profile+.  Later files are drawn over earlier ones, except for their
+    +nodata+ pixels.
+    """
+    root = ET.Element(
+        "VRTDataset",
+        rasterXSize=str(profile["width"]),
+        rasterYSize=str(profile["height"]),
+    )
+    if profile["crs"]:
+        ET.SubElement(root, "SRS").text = profile["crs"].to_wkt()
+    ET.SubElement(root, "GeoTransform").text = ", ".join(
+        repr(v) for v in profile["transform"].to_gdal()
+    )
+    data_type = GDAL_DATA_TYPES[np.dtype(profile["dtype"]).name]
+    for b in range(1, profile["count"] + 1):
+        band = ET.SubElement(root, "VRTRasterBand", dataType=data_type, band=str(b))
+        ET.SubElement(band, "NoDataValue").text = repr(nodata)
+        for path, win in zip(files, windows):
+            source = ET.SubElement(band, "ComplexSource")
+            ET.SubElement(
+                source, "SourceFilename", relativeToVRT="0"
+            ).text = os.path.abspath(path)
+            ET.SubElement(source, "SourceBand").text = str(b)
+            ET.SubElement(
+                source,
+                "SrcRect",
+                xOff="0",
+                yOff="0",
+                xSize=str(win.width),
+                ySize=str(win.height),
+            )
+            ET.SubElement(
+                source,
+                "DstRect",
+                xOff=str(win.col_off),
+                yOff=str(win.row_off),
+                xSize=str(win.width),
+                ySize=str(win.height),
+            )
+            ET.SubElement(source, "NODATA").text = repr(nodata)
+    ET.ElementTree(root).write(output)
+
+
+def mosaic(files, nodata=0, vrt=False, block_size=1024, cog=None, *, output):
+    """
+    Merge +files+ (rasters on the same grid, e.g. chips) into a single
+    raster in +output+.  Later files are drawn over earlier ones, except for
+    their +nodata+ pixels, like gdal_merge.py -n.
+
+    The output grid is computed from the bounds of all files.  If +vrt+ is
+    true, only a VRT referencing +files+ is written.  Otherwise, the output is
+    a COG (see +cog+, or satlomasproc.raster.COGOptions for defaults), built by
+    blocks of +block_size+ pixels: for each block, the intersecting part of
+    each overlapping file (found with an R-Tree index) is read and composed
+    in memory, and the block is written once.
+    """
     if not files:
-        print("No files")
+        raise RuntimeError("no files to merge")
 
-    tmpdir = None
-    if not temp_dir:
-        tmpdir = tempfile.TemporaryDirectory()
-        temp_dir = tmpdir.name
+    with rasterio.open(files[0]) as src:
+        profile = src.profile.copy()
+        src_res = src.res
 
-    os.makedirs(temp_dir, exist_ok=True)
+    chips_bounds = get_chips_bounds(files)
+    idx, bounds = build_index_from_bounds(chips_bounds)
+    transform, width, height = get_output_grid(bounds, src_res)
+    windows = chip_windows(chips_bounds, transform=transform)
+
+    profile.update(
+        driver="GTiff",
+        width=width,
+        height=height,
+        transform=transform,
+        nodata=nodata,
+    )
 
-    merged_files = []
-    total = math.ceil(len(files) / batch_size)
-    for i, group in tqdm(enumerate(grouper(files, batch_size)), total=total):
-        dst = os.path.join(temp_dir, f"{i}.tif")
-        group = [f for f in group if f]
-        gdal_merge(dst, group, quiet=True)
-        merged_files.append(dst)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    if vrt:
+        write_mosaic_vrt(files, windows, profile=profile, nodata=nodata, output=output)
+        return
+
+    blocks = list(sliding_windows(block_size, width=width, height=height))
+    cog = cog or COGOptions()
+    with open_raster(output, cog=cog, profile=profile) as dst:
+        for block_win, _ in tqdm(blocks):
+            win_bounds = rasterio.windows.bounds(block_win, transform)
+            chip_ids = sorted(idx.intersection(win_bounds))
+            if not chip_ids:
+                continue
+
+            block = np.full(
+                (profile["count"], block_win.height, block_win.width),
+                nodata,
+                dtype=profile["dtype"],
+            )
+            for k in chip_ids:
+                try:
+                    inter = rasterio.windows.intersection(windows[k], block_win)
+                except rasterio.errors.WindowError:
+                    continue
+                if not inter.width or not inter.height:
+                    continue
+                chip_win = Window(
+                    inter.col_off - windows[k].col_off,
+                    inter.row_off - windows[k].row_off,
+                    inter.width,
+                    inter.height,
+                )
+                with rasterio.open(files[k]) as src:
+                    data = src.read(window=chip_win)
+                view = block[
+                    :,
+                    inter.row_off - block_win.row_off :
+                    inter.row_off - block_win.row_off + inter.height,
+                    inter.col_off - block_win.col_off :
+                    inter.col_off - block_win.col_off + inter.width,
+                ]
+                valid = data != nodata
+                view[valid] = data[valid]
+
+            dst.write(block, window=block_win)
+
+
+def merge_all(vrt=False, cog=None, *, input_dir, output):
+    """
+    Merge all chips in +input_dir+ into a single raster in +output+ (see
+    mosaic, for +vrt+ and +cog+).
+    """
+    files = sorted(list(glob(os.path.join(input_dir, "*.tif"))))
+    if not files:
+        raise RuntimeError("%s does not contain any .tif file" % (input_dir))
 
-    os.makedirs(os.path.dirname(output), exist_ok=True)
     if os.path.exists(output):
         os.unlink(output)
 
-    gdalwarp_merge(output, merged_files)
-
-    if tmpdir:
-        tmpdir.cleanup()
+    mosaic(files, vrt=vrt, cog=cog, output=output)
 
     print(f"{output} written")
@@ -1,12 +1,36 @@
 import os
+import tempfile
+import time
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from glob import glob
 
 import attr
 import numpy as np
 import rasterio
+import rasterio.windows
+from rasterio.windows import Window
+from satlomasproc.chips.shards import ChipShardDataset
+from satlomasproc.chips.utils import get_rasters_percentiles, rescale_intensity
+from satlomasproc.raster import (
+    COGOptions,
+    OverviewBuilder,
+    open_raster,
+    write_raster,
+)
+from satlomasproc.unet.postprocess import window_2D
+from satlomasproc.unet.tflite import TFLiteModel
 from satlomasproc.unet.train import TrainConfig, build_model
-from satlomasproc.unet.utils import grouper, load_model, resize
+from satlomasproc.unet.utils import (
+    grouper,
+    load_model,
+    minmax_scale_batch,
+    prefetch,
+    resize,
+    resize_batch,
+)
 from sklearn.preprocessing import minmax_scale
 from tqdm import tqdm
 
@@ -29,64 +53,339 @@ class PredictConfig:
     n_channels = attr.ib(default=3)
     n_classes = attr.ib(default=1)
     class_weights = attr.ib(default=0)
+    read_workers = attr.ib(default=2)
+    write_workers = attr.ib(default=2)
+    queue_size = attr.ib(default=4)
+    # COG options for output rasters (see satlomasproc.raster.COGOptions)
+    cog = attr.ib(default=None)
 
 
-def predict(cfg):
-    predict_ids = glob(os.path.join(cfg.images_path, "images/*"))
+def read_chip(chip, n_channels, *, dataset=None):
+    """
+    Return image (with bands last), profile and output filename of +chip+,
+    either a path to an image or an index of a chip in +dataset+.
+    """
+    if dataset is not None:
+        img = np.moveaxis(dataset.image(chip)[:n_channels], 0, -1)
+        return img, dataset.profile(chip), f"{dataset.names[chip]}.tif"
+    with rasterio.open(chip) as src:
+        img = np.dstack([src.read(b) for b in range(1, n_channels + 1)])
+        return img, src.profile.copy(), os.path.basename(chip)
 
-    os.makedirs(cfg.results_path, exist_ok=True)
 
-    # Load model
+def load_predict_model(cfg):
+    """
+    Load model from +cfg.model_path+, either weights of a Keras model (.h5)
+    or an exported TFLite model (.tflite).
+    """
+    if cfg.model_path.endswith(".tflite"):
+        return TFLiteModel(cfg.model_path)
+
     # FIXME: Find a better way to load model (.load_model() did not work because
     # of the weighted_binary_crossentropy function).
     # build_model() only expects cfg to have: width, height, n_channels, n_classes
     model = build_model(cfg)
     model.load_weights(cfg.model_path)
+    return model
+
+
+def preprocess_chip(img, *, cfg):
+    """Scale and resize a chip image (with bands last) for the model"""
+    img = minmax_scale(img.ravel(), feature_range=(0, 255)).reshape(img.shape)
+    img = resize(img, (cfg.height, cfg.width))
+    return img.reshape(cfg.height, cfg.width, cfg.n_channels)
+
+
+def read_batch(chips, *, cfg, dataset=None):
+    """
+    Read and preprocess +chips+ (see read_chip).  Returns a batch array,
+    and the profiles and output filenames of chips.
+    """
+    X_predict = []
+    X_profile = []
+    X_filename = []
+
+    for chip in chips:
+        img_, profile_, filename = read_chip(chip, cfg.n_channels, dataset=dataset)
+        X_predict.append(preprocess_chip(img_, cfg=cfg))
+        X_profile.append(profile_)
+        X_filename.append(filename)
+
+    return np.array(X_predict), X_profile, X_filename
+
+
+def write_batch(preds_test_, X_profile, X_filename, overview_builder=None, *, cfg):
+    """
+    Scale predicted probabilities of a batch to 1-255 (as predict_raster
+    does), and write them to +cfg.results_path+, resized to the size of each
+    chip.  The scale is fixed, so results do not depend on the other chips in
+    the batch.  Returns the paths of written files.
+
+    Files are written as COGs if +cfg.cog+ is set, with overviews built in
+    +overview_builder+ threads if given (see satlomasproc.raster).
+    """
+    preds_test_scaled_ = 1 + np.clip(preds_test_, 0, 1) * 254
+
+    paths = []
+    for i, filename in enumerate(X_filename):
+        profile_ = X_profile[i]
+        profile_.update(count=cfg.n_classes, dtype=np.uint8, nodata=0)
+
+        out_height, out_width = profile_["height"], profile_["width"]
+
+        path = os.path.join(cfg.results_path, filename)
+        img = resize(preds_test_scaled_[i], (out_height, out_width))
+        img = img.round().astype(np.uint8)
+        img = img.reshape((out_height, out_width, cfg.n_classes))
+        write_raster(
+            np.moveaxis(img, -1, 0),
+            path,
+            cog=cfg.cog,
+            overview_builder=overview_builder,
+            profile=profile_,
+        )
+        paths.append(path)
+
+    return paths
+
+
+def predict(cfg):
+    """
+    Predict over all chips in +cfg.images_path+, and write a GeoTIFF of class
+    probabilities for each one in +cfg.results_path+.
+
+    Reading, prediction and writing run as a pipeline: +cfg.read_workers+
+    threads read and preprocess the next batches (up to +cfg.queue_size+)
+    while the model predicts the current one, and +cfg.write_workers+ threads
+    write predicted batches (up to +cfg.queue_size+ pending).
+    """
+    # Chips extracted as .npy shards are read by index
+    dataset = None
+    if ChipShardDataset.exists(cfg.images_path):
+        dataset = ChipShardDataset(cfg.images_path)
+        predict_ids = list(range(len(dataset)))
+    else:
+        predict_ids = glob(os.path.join(cfg.images_path, "images/*"))
+
+    os.makedirs(cfg.results_path, exist_ok=True)
+
+    model = load_predict_model(cfg)
+
+    # Seconds spent on each batch, by stage
+    stage_times = {"read": [], "predict": [], "write": []}
+
+    def timed(stage, fn):
+        def wrapper(*args):
+            start = time.perf_counter()
+            res = fn(*args)
+            stage_times[stage].append(time.perf_counter() - start)
+            return res
+
+        return wrapper
+
+    read = timed("read", partial(read_batch, cfg=cfg, dataset=dataset))
+
+    groups = [
+        [g for g in mini_group if g is not None]
+        for mini_group in grouper(predict_ids, cfg.batch_size)
+    ]
 
     # Predict over each batch of images
-    groups = list(grouper(predict_ids, cfg.batch_size))
-    for mini_group in tqdm(groups):
-        mini_group = [g for g in mini_group if g]
-
-        X_predict = []
-        X_profile = []
-
-        for i, img_path in enumerate(mini_group):
-            with rasterio.open(img_path) as src:
-                img_ = np.dstack([src.read(b) for b in range(1, cfg.n_channels + 1)])
-                profile_ = src.profile.copy()
-                img_ = minmax_scale(img_.ravel(), feature_range=(0, 255)).reshape(
-                    img_.shape
-                )
-                img_ = resize(img_, (cfg.height, cfg.width))
-                img_ = img_.reshape(cfg.height, cfg.width, cfg.n_channels)
-                X_predict.append(img_)
-                X_profile.append(profile_)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(cfg.read_workers) as readers, ThreadPoolExecutor(
+        cfg.write_workers
+    ) as writers, OverviewBuilder() as overviews:
+        write = timed(
+            "write", partial(write_batch, cfg=cfg, overview_builder=overviews)
+        )
+        batches = prefetch(readers, read, groups, size=cfg.queue_size)
+        pending_writes = deque()
+        for X_predict, X_profile, X_filename in tqdm(batches, total=len(groups)):
+            predict_start = time.perf_counter()
+            pred = model.predict(X_predict)
+            stage_times["predict"].append(time.perf_counter() - predict_start)
+
+            pending_writes.append(
+                writers.submit(write, pred, X_profile, X_filename)
+            )
+            while len(pending_writes) > cfg.queue_size:
+                pending_writes.popleft().result()
+
+        for future in pending_writes:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    n_chips = len(predict_ids)
+    print(
+        f"Predicted {n_chips} chips in {elapsed:.1f}s "
+        f"({n_chips / elapsed:.1f} chips/s)"
+    )
+    for stage, times in stage_times.items():
+        busy = sum(times)
+        if busy:
+            print(
+                f"  {stage}: {busy:.1f}s busy, {n_chips / busy:.1f} chips/s per worker"
+            )
+
+    print("Done!")
+
+
+def scene_windows(size, step_size, *, width, height):
+    """
+    Return windows of +size+ every +step_size+ pixels that cover a raster of
+    +width+ and +height+.  The last row and column of windows are aligned to
+    the raster edges, so every window lies inside the raster (unless the
+    raster is smaller than +size+).
+    """
+
+    def offsets(length):
+        res = list(range(0, max(length - size, 0) + 1, step_size))
+        if res[-1] + size < length:
+            res.append(length - size)
+        return res
+
+    return [
+        Window(j, i, size, size) for i in offsets(height) for j in offsets(width)
+    ]
 
-        # Predict batch
-        pred = model.predict(np.array(X_predict))
-        preds_test_ = pred
 
-        preds_test_scaled_ = minmax_scale(
-            preds_test_.ravel(), feature_range=(1, 255)
-        ).reshape(preds_test_.shape)
+def predict_raster(
+    cfg,
+    chip_size=256,
+    step_size=None,
+    bands=None,
+    rescale_mode=None,
+    rescale_range=None,
+    stats_path=None,
+    *,
+    raster,
+    output,
+):
+    """
+    Predict over a whole +raster+ and write class probabilities to +output+.
 
-        for i, img_path in enumerate(mini_group):
-            profile_ = X_profile[i]
-            profile_.update(count=cfg.n_classes, dtype=np.uint8, nodata=0)
+    Tiles of +chip_size+ pixels (the size of extracted training chips) are
+    read from +raster+ every +step_size+ pixels (by default, half the tile
+    size), resized to the model input size (+cfg.width+ x +cfg.height+) as in
+    training (see utils.resize_batch), and predicted in batches of
+    +cfg.batch_size+.  Predictions are resized back to +chip_size+, weighted
+    with a squared spline window (see postprocess.window_2D) and accumulated
+    into memory-mapped arrays the size of the raster, so overlapping tiles
+    are blended smoothly without writing intermediate chips.
 
-            out_height, out_width = profile_["height"], profile_["width"]
+    Tiles are rescaled like chips extracted for training (see
+    satlomasproc.chips.extract_chips), with +rescale_mode+ and
+    +rescale_range+, before being min-max scaled as in training.  With
+    'raster-percentiles' or 'global-percentiles', percentiles of the whole
+    raster are used for all tiles, and read from (or cached in) the JSON
+    file at +stats_path+ (defaults to 'stats.json' next to +output+).
 
-            filename = os.path.basename(img_path)
-            with rasterio.open(
-                os.path.join(cfg.results_path, filename), "w", **profile_
-            ) as dst:
+    The output is a uint8 COG with one band per class (see +cfg.cog+, or
+    satlomasproc.raster.COGOptions for defaults), and probabilities scaled to
+    1-255 (0 is nodata, where no tile could be predicted).
+    """
+    if cfg.width != cfg.height:
+        raise RuntimeError("model input must be square")
+    size = chip_size
+    if not step_size:
+        step_size = size // 2
+    if not bands:
+        bands = list(range(1, cfg.n_channels + 1))
 
-                img = resize(preds_test_scaled_[i], (out_height, out_width))
-                img = img.astype(np.uint8).reshape(
-                    (out_height, out_width, cfg.n_classes)
+    model = load_predict_model(cfg)
+
+    # Spline window weights, with bands last as in model predictions
+    weights = window_2D(size=size, power=2, n_channels=1)[0].astype(np.float32)
+
+    output_dir = os.path.dirname(os.path.abspath(output))
+    os.makedirs(output_dir, exist_ok=True)
+
+    if rescale_mode in ("raster-percentiles", "global-percentiles"):
+        lower_cut, upper_cut = rescale_range
+        band_ranges = get_rasters_percentiles(
+            [raster],
+            lower_cut=lower_cut,
+            upper_cut=upper_cut,
+            group=rescale_mode == "global-percentiles",
+            stats_path=stats_path or os.path.join(output_dir, "stats.json"),
+        )[raster]
+        rescale_mode = "values"
+        rescale_range = [band_ranges[b - 1] for b in bands]
+
+    with rasterio.open(raster) as src:
+        profile = src.profile.copy()
+        width, height = src.width, src.height
+        windows = scene_windows(size, step_size, width=width, height=height)
+
+        with tempfile.TemporaryDirectory(dir=output_dir) as tmpdir:
+            acc = np.lib.format.open_memmap(
+                os.path.join(tmpdir, "acc.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(height, width, cfg.n_classes),
+            )
+            acc_weights = np.lib.format.open_memmap(
+                os.path.join(tmpdir, "weights.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(height, width),
+            )
+
+            groups = list(grouper(windows, cfg.batch_size))
+            for group in tqdm(groups):
+                group = [w for w in group if w is not None]
+                tiles = np.array(
+                    [
+                        src.read(bands, window=w, boundless=True, fill_value=0)
+                        for w in group
+                    ]
                 )
-                for b in range(cfg.n_classes):
-                    dst.write(img[:, :, b], b + 1)
+                if tiles.dtype.kind == "f":
+                    tiles = np.nan_to_num(tiles, copy=False)
 
-    print("Done!")
+                # Skip empty (constant) tiles
+                valid = tiles.min(axis=(1, 2, 3)) != tiles.max(axis=(1, 2, 3))
+                if not valid.any():
+                    continue
+                group = [w for w, v in zip(group, valid) if v]
+                tiles = tiles[valid]
+                if rescale_mode:
+                    tiles = np.array(
+                        [
+                            rescale_intensity(tile, rescale_mode, rescale_range)
+                            for tile in tiles
+                        ]
+                    )
+                tiles = np.moveaxis(tiles, 1, -1)
+                tiles = minmax_scale_batch(tiles, feature_range=(0, 255))
+                tiles = resize_batch(tiles, (cfg.height, cfg.width))
+
+                preds = model.predict(tiles, batch_size=cfg.batch_size)
+                preds = resize_batch(preds, (size, size))
+
+                for w, pred in zip(group, preds):
+                    # Crop tiles that fall outside the raster (when it is
+                    # smaller than a tile)
+                    h_ = min(size, height - w.row_off)
+                    w_ = min(size, width - w.col_off)
+                    rows = slice(w.row_off, w.row_off + h_)
+                    cols = slice(w.col_off, w.col_off + w_)
+                    acc[rows, cols] += pred[:h_, :w_] * weights[:h_, :w_, None]
+                    acc_weights[rows, cols] += weights[:h_, :w_]
+
+            profile.update(count=cfg.n_classes, dtype=np.uint8, nodata=0)
+            cog = cfg.cog or COGOptions()
+            with open_raster(output, cog=cog, profile=profile) as dst:
+                for _, win in dst.block_windows(1):
+                    rows = slice(win.row_off, win.row_off + win.height)
+                    cols = slice(win.col_off, win.col_off + win.width)
+                    w = acc_weights[rows, cols, None]
+                    prob = np.zeros((win.height, win.width, cfg.n_classes), np.float32)
+                    np.divide(acc[rows, cols], w, out=prob, where=w > 0)
+                    img = np.where(w > 0, 1 + np.clip(prob, 0, 1) * 254, 0)
+                    img = np.moveaxis(img, -1, 0).round().astype(np.uint8)
+                    dst.write(img, window=win)
+
+            del acc, acc_weights
+
+    print(f"{output} written")
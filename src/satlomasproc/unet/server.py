@@ -0,0 +1,238 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+import attr
+import numpy as np
+import rasterio
+import rasterio.windows
+from rasterio.windows import Window
+from satlomasproc.unet.predict import (
+    load_predict_model,
+    preprocess_chip,
+    read_batch,
+    write_batch,
+)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+_logger = logging.getLogger(__name__)
+
+
+class DynamicBatcher:
+    """
+    Runs model predictions on a single thread, batching chips submitted by
+    concurrent callers.
+
+    The model is built and loaded once, in the batcher thread (which keeps
+    the TensorFlow graph and session on that thread).  Each batch takes up
+    to +cfg.batch_size+ chips, waiting at most +max_latency+ seconds for
+    more chips after the first one arrives.
+    """
+
+    def __init__(self, cfg, max_latency=0.01):
+        self.cfg = cfg
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error:
+            raise self.error
+
+    def submit(self, image):
+        """Queue a preprocessed chip, and return a Future of its prediction"""
+        future = Future()
+        self.queue.put((image, future))
+        return future
+
+    def predict(self, images):
+        """Predict a list of preprocessed chips, and return their predictions"""
+        futures = [self.submit(image) for image in images]
+        return np.array([f.result() for f in futures])
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_latency
+        while len(batch) < self.cfg.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            model = load_predict_model(self.cfg)
+        except Exception as err:
+            self.error = err
+            return
+        finally:
+            self.ready.set()
+
+        while True:
+            batch = self._next_batch()
+            images, futures = zip(*batch)
+            try:
+                preds = model.predict(np.array(images))
+            except Exception as err:
+                for future in futures:
+                    future.set_exception(err)
+                continue
+            _logger.debug("Predicted batch of %d chips", len(preds))
+            for future, pred in zip(futures, preds):
+                future.set_result(pred)
+
+
+def read_window_chips(raster, windows, *, cfg):
+    """
+    Read and preprocess +windows+ (col_off, row_off, width, height) from
+    +raster+.  Returns the same as predict.read_batch, with output filenames
+    named after the raster and window offsets.
+    """
+    basename, _ = os.path.splitext(os.path.basename(raster))
+    bands = list(range(1, cfg.n_channels + 1))
+
+    X_predict = []
+    X_profile = []
+    X_filename = []
+
+    with rasterio.open(raster) as src:
+        for col_off, row_off, width, height in windows:
+            window = Window(col_off, row_off, width, height)
+            img = np.moveaxis(src.read(bands, window=window, boundless=True), 0, -1)
+            profile = src.profile.copy()
+            profile.update(
+                width=width,
+                height=height,
+                transform=rasterio.windows.transform(window, src.transform),
+            )
+            X_predict.append(preprocess_chip(img, cfg=cfg))
+            X_profile.append(profile)
+            X_filename.append(f"{basename}_{row_off}_{col_off}.tif")
+
+    return np.array(X_predict), X_profile, X_filename
+
+
+def resolve_path(path, *, root):
+    """
+    Return the real path of +path+ (relative to +root+ if not absolute).
+    Raises ValueError if it is outside +root+.
+    """
+    root = os.path.realpath(root)
+    res = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, res]) != root:
+        raise ValueError(f"{path} is outside of {root}")
+    return res
+
+
+def handle_predict(batcher, params, *, root):
+    """
+    Handle a prediction request.  +params+ must have an 'output_dir' where
+    predictions are written, and either a list of 'chips' (paths to images),
+    or a 'raster' and a list of 'windows' (col_off, row_off, width, height).
+    All paths must be inside +root+ (relative paths are relative to it).
+    """
+    output_dir = resolve_path(params["output_dir"], root=root)
+    cfg = attr.evolve(batcher.cfg, results_path=output_dir)
+    if "chips" in params:
+        chips = [resolve_path(chip, root=root) for chip in params["chips"]]
+        X_predict, X_profile, X_filename = read_batch(chips, cfg=cfg)
+    elif "raster" in params:
+        X_predict, X_profile, X_filename = read_window_chips(
+            resolve_path(params["raster"], root=root), params["windows"], cfg=cfg
+        )
+    else:
+        raise ValueError("request must have either 'chips' or 'raster'")
+    if not len(X_predict):
+        return []
+
+    preds = batcher.predict(list(X_predict))
+
+    os.makedirs(cfg.results_path, exist_ok=True)
+    return write_batch(preds, X_profile, X_filename, cfg=cfg)
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length))
+            start = time.perf_counter()
+            paths = handle_predict(self.server.batcher, params, root=self.server.root)
+            elapsed = time.perf_counter() - start
+        except (KeyError, ValueError, TypeError) as err:
+            self._send_json(400, {"error": f"invalid request: {err!r}"})
+        except Exception as err:
+            _logger.exception("Prediction failed")
+            self._send_json(500, {"error": repr(err)})
+        else:
+            self._send_json(200, {"outputs": paths, "elapsed": elapsed})
+
+    def log_message(self, format, *args):
+        _logger.info("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(cfg, max_latency=0.01, *, host, port, root):
+    """
+    Load the model in +cfg+ once, and serve predictions over HTTP on +host+
+    and +port+.  Requests from concurrent clients are predicted together in
+    dynamic batches (see DynamicBatcher).  Requests can only read and write
+    files inside the +root+ directory.
+
+    Endpoints:
+      GET /health
+      POST /predict  {"output_dir": ..., "chips": [...]}
+                     {"output_dir": ..., "raster": ..., "windows": [...]}
+    """
+    batcher = DynamicBatcher(cfg, max_latency=max_latency)
+    server = ThreadingHTTPServer((host, port), PredictionRequestHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    server.root = root
+    _logger.info("Serving predictions on http://%s:%d", host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def request_predict(url, **params):
+    """Send a prediction request to a server at +url+, and return its response"""
+    req = Request(
+        f"{url.rstrip('/')}/predict",
+        data=json.dumps(params).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urlopen(req) as res:
+        return json.loads(res.read())
@@ -0,0 +1,35 @@
+import numpy as np
+import tensorflow as tf
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+
+class TFLiteModel:
+    """
+    Runs an exported TFLite model (see unet.export) with the same predict()
+    interface as a Keras model.
+    """
+
+    def __init__(self, path, num_threads=None):
+        kwargs = {"num_threads": num_threads} if num_threads else {}
+        self.interpreter = tf.lite.Interpreter(model_path=path, **kwargs)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    def predict(self, images, batch_size=None):
+        """
+        Predict a batch of +images+ of shape (B, H, W, C).  All images are
+        predicted in one invocation, so +batch_size+ is ignored.
+        """
+        images = np.asarray(images, dtype=np.float32)
+        if len(images) != self.batch_size:
+            # Resize input tensor for the new batch size
+            self.interpreter.resize_tensor_input(self.input["index"], images.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(images)
+        self.interpreter.set_tensor(self.input["index"], images)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output["index"])
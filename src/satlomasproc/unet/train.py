@@ -2,6 +2,7 @@ import os
 import random
 import sys
 import warnings
+from functools import lru_cache
 from glob import glob
 
 import albumentations as A
@@ -28,8 +29,12 @@ from keras.layers import (
 )
 from keras.models import Model
 from keras.optimizers import Adam
-from satlomasproc.unet.utils import resize
+from keras.utils import Sequence
+from satlomasproc.chips.manifest import params_hash
+from satlomasproc.chips.shards import ChipShardDataset
+from satlomasproc.unet.utils import minmax_scale_batch, resize, resize_batch
 from sklearn.preprocessing import minmax_scale
+from tqdm import tqdm
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -55,6 +60,10 @@ class TrainConfig:
     seed = attr.ib(default=None)
     evaluate = attr.ib(default=True)
     class_weights = attr.ib(default=0)
+    cache_dir = attr.ib(default=None)
+    workers = attr.ib(default=1)
+    max_queue_size = attr.ib(default=10)
+    use_multiprocessing = attr.ib(default=False)
 
 
 def mean_iou(y_true, y_pred):
@@ -229,6 +238,17 @@ def build_model(cfg):
     return model
 
 
+@lru_cache()
+def build_augmentation_pipeline():
+    return A.Compose(
+        [
+            A.RandomRotate90(p=0.5),
+            A.HorizontalFlip(p=0.5),
+            A.RandomBrightnessContrast(p=0.2),
+        ]
+    )
+
+
 def preprocess_input(image, mask, *, config):
     # Scale image to 0-255 range
     image_ = minmax_scale(image.ravel(), feature_range=(0, 255)).reshape(image.shape)
@@ -243,13 +263,7 @@ def preprocess_input(image, mask, *, config):
 
     if config.apply_image_augmentation:
         # Add extra augmentations to image and mask
-        aug_pipeline = A.Compose(
-            [
-                A.RandomRotate90(p=0.5),
-                A.HorizontalFlip(p=0.5),
-                A.RandomBrightnessContrast(p=0.2),
-            ]
-        )
+        aug_pipeline = build_augmentation_pipeline()
         res = aug_pipeline(image=image_.astype(np.uint8), mask=mask_)
         image_, mask_ = res["image"], res["mask"]
 
@@ -261,6 +275,78 @@ def preprocess_input(image, mask, *, config):
     return image_, mask_
 
 
+def augment_batch(images, masks, random_state):
+    """
+    Apply random 90 degree rotations and horizontal flips to +images+ and
+    +masks+, and random brightness/contrast changes to +images+ (uint8).
+    Same augmentations and probabilities as build_augmentation_pipeline, but
+    drawn and applied for the whole batch at once.
+    """
+    n = len(images)
+    rs = random_state
+
+    # Rotate by 0, 90, 180 or 270 degrees (only 0 or 180 for non-square
+    # chips), and flip.  Chips with the same rotation and flip are
+    # transformed together.
+    if images.shape[1] == images.shape[2]:
+        factors = rs.randint(4, size=n)
+    else:
+        factors = 2 * rs.randint(2, size=n)
+    factors[rs.rand(n) >= 0.5] = 0
+    flips = rs.rand(n) < 0.5
+
+    images_, masks_ = np.empty_like(images), np.empty_like(masks)
+    for k in np.unique(factors):
+        for flip in (False, True):
+            group = np.flatnonzero((factors == k) & (flips == flip))
+            if not len(group):
+                continue
+            for src, dst in ((images, images_), (masks, masks_)):
+                chips = np.rot90(src[group], k, axes=(1, 2))
+                dst[group] = chips[:, :, ::-1] if flip else chips
+    images, masks = images_, masks_
+
+    idx = np.flatnonzero(rs.rand(n) < 0.2)
+    if len(idx):
+        alpha = 1 + rs.uniform(-0.2, 0.2, size=(len(idx), 1, 1, 1))
+        beta = rs.uniform(-0.2, 0.2, size=(len(idx), 1, 1, 1)) * 255
+        adjusted = images[idx] * alpha.astype(np.float32) + beta.astype(np.float32)
+        images[idx] = np.clip(adjusted, 0, 255)
+
+    return images, masks
+
+
+def preprocess_batch(images, masks, *, config, random_state=np.random):
+    """
+    Preprocess a batch of +images+ and +masks+, of shape (B, H, W, C), like
+    preprocess_input does for each chip: min-max scale each image to 0-255,
+    scale masks to 0-1, resize and augment.  Chips with NaN values are
+    dropped.
+    """
+    if images.dtype.kind == "f" or masks.dtype.kind == "f":
+        valid = ~np.isnan(images).any(axis=(1, 2, 3))
+        valid &= ~np.isnan(masks).any(axis=(1, 2, 3))
+        if not valid.all():
+            images, masks = images[valid], masks[valid]
+
+    # Scale each image to 0-255 range
+    images = minmax_scale_batch(images, feature_range=(0, 255))
+    # Scale to 0-1 by dividing by 255 (we assume that mask has true values
+    # filled with 255, and false values as 0).
+    masks = masks.astype(np.float32)
+    masks /= 255
+
+    # Resize images and masks
+    size = (config.height, config.width)
+    images = resize_batch(images, size)
+    masks = resize_batch(masks, size)
+
+    if config.apply_image_augmentation:
+        images, masks = augment_batch(images.astype(np.uint8), masks, random_state)
+
+    return images, masks
+
+
 def get_raster(image_path, n_channels=None):
     with rasterio.open(image_path) as src:
         if not n_channels:
@@ -277,46 +363,173 @@ def get_mask_raster(image_path, n_channels=None, *, mask_dir):
         return np.dstack([src.read(b) for b in range(1, n_channels + 1)])
 
 
-def build_data_generator(image_files, *, config, mask_dir):
-    if not image_files:
-        raise RuntimeError("image_files is empty")
-
-    while True:
-        # Select files (paths/indices) for the batch
-        batch_paths = np.random.choice(a=image_files, size=config.batch_size)
-        batch_input = []
-        batch_output = []
-
-        # Read in each input, perform preprocessing and get labels
-        for input_path in batch_paths:
+def get_shard_chip(dataset, k, *, n_channels, n_classes):
+    """Return image and mask of chip +k+ from +dataset+, with bands last"""
+    image = np.moveaxis(dataset.image(k)[:n_channels], 0, -1)
+    mask = np.moveaxis(dataset.mask(k)[:n_classes], 0, -1)
+    return image, mask
+
+
+def build_chip_cache(image_files, *, config, mask_dir):
+    """
+    Decode chips in +image_files+ and their masks into two memory-mapped
+    arrays of shape (N, height, width, bands) in +config.cache_dir+, and
+    return them.  Chips must all have the same size.
+
+    The cache is keyed by the paths and modification times of the chips and
+    their masks, and by the chip preprocessing settings (size, bands and
+    classes), so it is reused by later runs over the same chips, and rebuilt
+    if any of them changes.
+    """
+    mask_files = [os.path.join(mask_dir, os.path.basename(p)) for p in image_files]
+    key = params_hash(
+        files=[(p, os.path.getmtime(p)) for p in image_files],
+        mask_files=[(p, os.path.getmtime(p)) for p in mask_files],
+        height=config.height,
+        width=config.width,
+        n_channels=config.n_channels,
+        n_classes=config.n_classes,
+    )
+    images_path = os.path.join(config.cache_dir, f"{key}.images.npy")
+    masks_path = os.path.join(config.cache_dir, f"{key}.masks.npy")
+
+    if not (os.path.exists(images_path) and os.path.exists(masks_path)):
+        print("Build chip cache in", config.cache_dir)
+        os.makedirs(config.cache_dir, exist_ok=True)
+        images, masks = None, None
+        for k, input_path in enumerate(tqdm(image_files)):
             input = get_raster(input_path, n_channels=config.n_channels)
             mask = get_mask_raster(
                 input_path, mask_dir=mask_dir, n_channels=config.n_classes
             )
+            if images is None:
+                # Write to temporary files, so that an interrupted build is
+                # not mistaken for a complete cache
+                images = np.lib.format.open_memmap(
+                    f"{images_path}.tmp",
+                    mode="w+",
+                    dtype=input.dtype,
+                    shape=(len(image_files), *input.shape),
+                )
+                masks = np.lib.format.open_memmap(
+                    f"{masks_path}.tmp",
+                    mode="w+",
+                    dtype=mask.dtype,
+                    shape=(len(image_files), *mask.shape),
+                )
+            if input.shape != images.shape[1:] or mask.shape != masks.shape[1:]:
+                raise RuntimeError(
+                    f"{input_path} has a different size than other chips, "
+                    "and can not be cached"
+                )
+            images[k] = input
+            masks[k] = mask
+        images.flush()
+        masks.flush()
+        del images, masks
+        os.replace(f"{masks_path}.tmp", masks_path)
+        os.replace(f"{images_path}.tmp", images_path)
+
+    return np.load(images_path, mmap_mode="r"), np.load(masks_path, mmap_mode="r")
+
+
+class ChipSequence(Sequence):
+    """
+    Sequence of +steps+ batches of random chips from +image_files+, that
+    Keras can build in parallel with several workers.
+
+    If +dataset+ is a ChipShardDataset, +image_files+ are indexes of chips in
+    the dataset.  If +cache+ is a pair of image and mask arrays (see
+    build_chip_cache), +image_files+ are indexes in these arrays.
+
+    If +config.seed+ is set, each batch is drawn and augmented from a random
+    state seeded by the seed, the epoch and the batch index, so batches are
+    the same regardless of the number of workers and of which worker builds
+    them.
+    """
+
+    def __init__(
+        self, image_files, *, config, mask_dir, steps, dataset=None, cache=None
+    ):
+        if not len(image_files):
+            raise RuntimeError("image_files is empty")
+        self.image_files = image_files
+        self.config = config
+        self.mask_dir = mask_dir
+        self.steps = steps
+        self.dataset = dataset
+        self.cache = cache
+        self.epoch = 0
+
+    def __len__(self):
+        return self.steps
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def random_state(self, index):
+        if self.config.seed is None:
+            return np.random.RandomState()
+        return np.random.RandomState([self.config.seed, self.epoch, index])
+
+    def load_chip(self, input_path):
+        if self.dataset is not None:
+            return get_shard_chip(
+                self.dataset,
+                input_path,
+                n_channels=self.config.n_channels,
+                n_classes=self.config.n_classes,
+            )
+        input = get_raster(input_path, n_channels=self.config.n_channels)
+        mask = get_mask_raster(
+            input_path, mask_dir=self.mask_dir, n_channels=self.config.n_classes
+        )
+        return input, mask
 
-            input, mask = preprocess_input(image=input, mask=mask, config=config)
-
-            if not np.any(np.isnan(input)):
-                if not np.any(np.isnan(mask)):
-                    batch_input.append(input)
-                    batch_output.append(mask)
-
-        # Return a tuple of (input, output) to feed the network
-        batch_x = np.array(batch_input)
-        batch_y = np.array(batch_output)
+    def __getitem__(self, index):
+        rs = self.random_state(index)
 
-        yield batch_x, batch_y
+        # Select files (paths/indices) for the batch
+        batch_paths = rs.choice(a=self.image_files, size=self.config.batch_size)
+
+        # Read all cached chips of the batch at once
+        if self.cache is not None:
+            cached_images, cached_masks = self.cache
+            batch_input = cached_images[batch_paths]
+            batch_output = cached_masks[batch_paths]
+        else:
+            chips = [self.load_chip(input_path) for input_path in batch_paths]
+            batch_input = np.array([input for input, _ in chips])
+            batch_output = np.array([mask for _, mask in chips])
+
+        # Preprocess and augment the whole batch, and return a tuple of
+        # (input, output) to feed the network
+        return preprocess_batch(
+            batch_input, batch_output, config=self.config, random_state=rs
+        )
 
 
 def train(cfg):
-    if cfg.seed:
-        random.seed = cfg.seed
-        np.random.seed = cfg.seed
+    if cfg.seed is not None:
+        random.seed(cfg.seed)
+        np.random.seed(cfg.seed)
 
     model = build_model(cfg)
     print(model.summary())
 
-    all_images = glob(os.path.join(cfg.images_path, "images", "*.tif"))
+    mask_dir = os.path.join(cfg.images_path, "masks")
+
+    # Chips extracted as .npy shards, or decoded into the chip cache, are
+    # sampled by index
+    dataset, cache = None, None
+    if ChipShardDataset.exists(cfg.images_path):
+        dataset = ChipShardDataset(cfg.images_path)
+        all_images = list(range(len(dataset)))
+    else:
+        all_images = sorted(glob(os.path.join(cfg.images_path, "images", "*.tif")))
+        if cfg.cache_dir and all_images:
+            cache = build_chip_cache(all_images, config=cfg, mask_dir=mask_dir)
+            all_images = list(range(len(all_images)))
     print("All images:", len(all_images))
 
     # Split dataset by shuffling and taking the first N elements for validation,
@@ -332,9 +545,23 @@ def train(cfg):
     if not val_images:
         raise RuntimeError("val_images is empty")
 
-    mask_dir = os.path.join(cfg.images_path, "masks")
-    train_generator = build_data_generator(train_images, config=cfg, mask_dir=mask_dir)
-    val_generator = build_data_generator(val_images, config=cfg, mask_dir=mask_dir)
+    validation_steps = max(1, round(cfg.steps_per_epoch * cfg.validation_split))
+    train_sequence = ChipSequence(
+        train_images,
+        config=cfg,
+        mask_dir=mask_dir,
+        steps=cfg.steps_per_epoch,
+        dataset=dataset,
+        cache=cache,
+    )
+    val_sequence = ChipSequence(
+        val_images,
+        config=cfg,
+        mask_dir=mask_dir,
+        steps=validation_steps,
+        dataset=dataset,
+        cache=cache,
+    )
 
     # Make sure weights dir exist
     os.makedirs(os.path.dirname(cfg.model_path), exist_ok=True)
@@ -345,12 +572,15 @@ def train(cfg):
     # reduce_lr = ReduceLROnPlateau(monitor='val_loss', factor=0.2,
     #                               patience=5, min_lr=0.001)
     results = model.fit_generator(
-        train_generator,
+        train_sequence,
         epochs=cfg.epochs,
         steps_per_epoch=cfg.steps_per_epoch,
-        validation_data=val_generator,
-        validation_steps=round(cfg.steps_per_epoch * cfg.validation_split),
+        validation_data=val_sequence,
+        validation_steps=validation_steps,
         callbacks=[early_stopping, checkpoint],
+        workers=cfg.workers,
+        max_queue_size=cfg.max_queue_size,
+        use_multiprocessing=cfg.use_multiprocessing,
     )
 
     # Save model
@@ -359,7 +589,11 @@ def train(cfg):
     # Evaluate model on validation set
     if cfg.evaluate:
         scores = model.evaluate_generator(
-            val_generator, steps=len(val_images) // cfg.batch_size
+            val_sequence,
+            steps=len(val_images) // cfg.batch_size,
+            workers=cfg.workers,
+            max_queue_size=cfg.max_queue_size,
+            use_multiprocessing=cfg.use_multiprocessing,
         )
         loss, accuracy, mean_iou = scores
         print("*** Final validation metrics ***")
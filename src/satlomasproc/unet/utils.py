@@ -1,9 +1,10 @@
+import subprocess
+from collections import deque
+from functools import lru_cache
 from itertools import zip_longest
 
 import keras
-import skimage.transform
-import cv2
-import subprocess
+import numpy as np
 
 __author__ = "Damián Silvani"
 __copyright__ = "Dymaxion Labs"
@@ -23,16 +24,95 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(*args, fillvalue=fillvalue)
 
 
+def prefetch(executor, fn, items, size):
+    """
+    Map +fn+ over +items+ with +executor+, yielding results in order, and
+    keeping at most +size+ calls ahead of the consumer.
+    """
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(fn, item))
+        if len(futures) > size:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
 def load_model(model_path):
     return keras.models.load_model(model_path)
 
 
 def resize(image, size):
-    """Resize multiband image to an image of size (h, w)"""
-    n_channels = image.shape[2]
-    if n_channels >= 4:
-        return skimage.transform.resize(
-            image, size, mode="constant", preserve_range=True
-        )
+    """
+    Resize multiband image of shape (H, W, C) or (H, W) to an image of size
+    (h, w).  Same as resize_batch on a batch of one image.
+    """
+    if image.ndim == 2:
+        return resize_batch(image[np.newaxis, ..., np.newaxis], size)[0, ..., 0]
+    return resize_batch(image[np.newaxis], size)[0]
+
+
+def minmax_scale_batch(images, feature_range=(0, 255)):
+    """
+    Min-max scale each image of a batch of shape (B, ...) to +feature_range+,
+    like sklearn's minmax_scale on each raveled image.  Returns a float32 array.
+    """
+    axes = tuple(range(1, images.ndim))
+    min_ = images.min(axis=axes, keepdims=True).astype(np.float32)
+    range_ = images.max(axis=axes, keepdims=True) - min_
+    range_[range_ == 0] = 1
+    low, high = feature_range
+    images = images.astype(np.float32)
+    images -= min_
+    images *= (high - low) / range_
+    if low:
+        images += low
+    return images
+
+
+@lru_cache()
+def resize_weights(n_in, n_out):
+    """
+    Return the (n_out, n_in) matrix that resamples a row of +n_in+ pixels to
+    +n_out+ pixels.  When downscaling, each output pixel is the mean of the
+    input pixels it covers, weighted by their overlap (like cv2's INTER_AREA).
+    When upscaling, output pixels are linearly interpolated.
+    """
+    scale = n_in / n_out
+    if scale >= 1:
+        edges = np.arange(n_out + 1) * scale
+        x = np.arange(n_in)
+        overlap = np.minimum(edges[1:, None], x + 1) - np.maximum(edges[:-1, None], x)
+        weights = np.clip(overlap, 0, None) / scale
     else:
-        return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        centers = np.clip((np.arange(n_out) + 0.5) * scale - 0.5, 0, n_in - 1)
+        left = np.floor(centers).astype(int)
+        right = np.minimum(left + 1, n_in - 1)
+        frac = centers - left
+        weights = np.zeros((n_out, n_in))
+        rows = np.arange(n_out)
+        np.add.at(weights, (rows, left), 1 - frac)
+        np.add.at(weights, (rows, right), frac)
+    weights = weights.astype(np.float32)
+    weights.flags.writeable = False
+    return weights
+
+
+def resize_batch(images, size):
+    """
+    Resize a batch of multiband images of shape (B, H, W, C) to images of
+    size (h, w), on the whole batch at once (see resize_weights).  Returns a
+    float32 array, or +images+ if they already have that size.
+    """
+    height, width = size
+    n, h, w, c = images.shape
+    if (h, w) == (height, width):
+        return images
+    if h % height == 0 and w % width == 0:
+        # Same as the weights below, but faster
+        fy, fx = h // height, w // width
+        images = images.reshape(n, height, fy, width, fx, c)
+        return images.mean(axis=(2, 4), dtype=np.float32)
+    images = np.moveaxis(images.astype(np.float32), -1, 1)
+    images = resize_weights(h, height) @ images @ resize_weights(w, width).T
+    return np.moveaxis(images, 1, -1)
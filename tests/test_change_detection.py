@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import os
+
+import fiona
+import numpy as np
+import pytest
+import rasterio
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping
+
+pytest.importorskip("keras")
+pytest.importorskip("cv2")
+
+from satlomasproc.unet.change_detection import (  # noqa: E402
+    PolygonZones,
+    compare_periods,
+    detect_changes,
+)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+WIDTH, HEIGHT = 230, 170
+NUM_CLASSES = 3
+POLYGONS = [
+    box(300100, 8698800, 301200, 8699900),
+    box(301200, 8698400, 302250, 8699000),
+]
+
+
+def write_class_raster(path, img):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=WIDTH,
+        height=HEIGHT,
+        count=1,
+        dtype=np.uint8,
+        crs="EPSG:32718",
+        transform=TRANSFORM,
+        nodata=0,
+    ) as dst:
+        dst.write(img, 1)
+    return path
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    rs = np.random.RandomState(0)
+    imgs = [
+        rs.randint(0, NUM_CLASSES + 1, size=(HEIGHT, WIDTH)).astype(np.uint8)
+        for _ in range(3)
+    ]
+    paths = [
+        write_class_raster(str(tmp_path / f"period_{k}.tif"), img)
+        for k, img in enumerate(imgs)
+    ]
+    return paths, imgs
+
+
+@pytest.fixture
+def polygons(tmp_path):
+    path = str(tmp_path / "zones.gpkg")
+    schema = {"geometry": "Polygon", "properties": {"name": "str"}}
+    with fiona.open(path, "w", driver="GPKG", schema=schema, crs="EPSG:32718") as dst:
+        for k, shp in enumerate(POLYGONS):
+            dst.write({"geometry": mapping(shp), "properties": {"name": f"z{k}"}})
+    return path
+
+
+def transition_matrix(before, after):
+    n_values = NUM_CLASSES + 1
+    codes = before.astype(np.int64) * n_values + after
+    counts = np.bincount(codes.ravel(), minlength=n_values * n_values)
+    return counts.reshape(n_values, n_values)
+
+
+@pytest.mark.parametrize("block_size", [64, 1024])
+def test_compare_periods(tmp_path, rasters, polygons, block_size):
+    (before_path, after_path, _), (before, after, _) = rasters
+    zones = PolygonZones(polygons, id_property="name", crs=CRS.from_epsg(32718))
+    output = str(tmp_path / "changes.tif")
+    matrix, zone_matrix = compare_periods(
+        before_path,
+        after_path,
+        transitions=[(1, 2), (3, 1)],
+        zones=zones,
+        block_size=block_size,
+        num_classes=NUM_CLASSES,
+        output=output,
+    )
+
+    assert np.array_equal(matrix, transition_matrix(before, after))
+    assert matrix.sum() == WIDTH * HEIGHT
+
+    assert zone_matrix.shape == (2, NUM_CLASSES + 1, NUM_CLASSES + 1)
+    for k, shp in enumerate(POLYGONS):
+        inside = rasterize([shp], out_shape=(HEIGHT, WIDTH), transform=TRANSFORM)
+        inside = inside.astype(bool)
+        expected = transition_matrix(before[inside], after[inside])
+        assert np.array_equal(zone_matrix[k], expected)
+
+    expected_mask = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    expected_mask[(before == 1) & (after == 2)] = 1
+    expected_mask[(before == 3) & (after == 1)] = 2
+    with rasterio.open(output) as src:
+        assert np.array_equal(src.read(1), expected_mask)
+
+
+def test_compare_periods_any_change(tmp_path, rasters):
+    (before_path, after_path, _), (before, after, _) = rasters
+    output = str(tmp_path / "changes.tif")
+    compare_periods(before_path, after_path, num_classes=NUM_CLASSES, output=output)
+
+    expected = (before != after) & (before > 0) & (after > 0)
+    with rasterio.open(output) as src:
+        assert np.array_equal(src.read(1), expected.astype(np.uint8))
+
+
+def test_detect_changes(tmp_path, rasters, polygons):
+    paths, imgs = rasters
+    output_dir = str(tmp_path / "out")
+    res = detect_changes(
+        paths,
+        polygons=polygons,
+        polygon_id_property="name",
+        workers=2,
+        num_classes=NUM_CLASSES,
+        output_dir=output_dir,
+    )
+
+    assert [(before, after) for before, after, _, _ in res] == list(
+        zip(paths[:-1], paths[1:])
+    )
+    for k, (_, _, matrix, _) in enumerate(res):
+        name = f"period_{k}__period_{k + 1}"
+        for suffix in ("_changes.tif", "_matrix.csv", "_polygons.csv"):
+            assert os.path.exists(os.path.join(output_dir, name + suffix))
+
+        # Areas in the CSV table are pixel counts times pixel area (100 m2)
+        with open(os.path.join(output_dir, f"{name}_matrix.csv")) as f:
+            rows = list(csv.reader(f))[1:]
+        areas = np.array([[float(v) for v in row[1:]] for row in rows])
+        assert np.array_equal(areas, transition_matrix(imgs[k], imgs[k + 1]) * 100)
+
+
+def test_detect_changes_needs_same_grid(tmp_path, rasters):
+    paths, imgs = rasters
+    other = str(tmp_path / "other.tif")
+    with rasterio.open(
+        other,
+        "w",
+        driver="GTiff",
+        width=WIDTH,
+        height=HEIGHT,
+        count=1,
+        dtype=np.uint8,
+        crs="EPSG:32718",
+        transform=from_origin(300010, 8700000, 10, 10),
+    ) as dst:
+        dst.write(imgs[0], 1)
+    with pytest.raises(RuntimeError):
+        detect_changes(
+            [paths[0], other], num_classes=NUM_CLASSES, output_dir=str(tmp_path)
+        )
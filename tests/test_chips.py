@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+from glob import glob
+
+import fiona
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+import satlomasproc.chips as chips_module
+from satlomasproc.chips import extract_chips
+from satlomasproc.chips.manifest import (
+    CHIP_FAILED,
+    CHIP_LOW_CONTRAST,
+    CHIP_WRITTEN,
+    ChipManifest,
+)
+from satlomasproc.chips.shards import ChipShardDataset
+from shapely.geometry import box, mapping
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+
+
+@pytest.fixture
+def raster(tmp_path):
+    rs = np.random.RandomState(0)
+    img = rs.randint(0, 3000, size=(3, 300, 340)).astype(np.uint16)
+    path = str(tmp_path / "r.tif")
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=340,
+        height=300,
+        count=3,
+        dtype=np.uint16,
+        crs="EPSG:32718",
+        transform=TRANSFORM,
+    ) as dst:
+        dst.write(img)
+    return path
+
+
+@pytest.fixture
+def labels(tmp_path):
+    path = str(tmp_path / "labels.gpkg")
+    schema = {"geometry": "Polygon", "properties": {"class": "int"}}
+    shapes = [
+        (box(300300, 8697500, 301200, 8699000), 1),
+        (box(301500, 8698000, 303000, 8699700), 2),
+    ]
+    with fiona.open(path, "w", driver="GPKG", schema=schema, crs="EPSG:32718") as dst:
+        for shp, value in shapes:
+            dst.write({"geometry": mapping(shp), "properties": {"class": value}})
+    return path
+
+
+def read_chips(output_dir):
+    chips = {}
+    for path in sorted(glob(os.path.join(output_dir, "*", "*.tif"))):
+        with rasterio.open(path) as src:
+            chips[os.path.relpath(path, output_dir)] = (src.read(), src.transform)
+    return chips
+
+
+def extract(output_dir, workers, **kwargs):
+    params = dict(
+        size=64,
+        step_size=48,
+        bands=[1, 2, 3],
+        classes=["1", "2"],
+        rescale_mode="percentiles",
+        rescale_range=(2, 98),
+        write_geojson=False,
+    )
+    params.update(kwargs)
+    raster = params.pop("raster")
+    extract_chips([raster], workers=workers, output_dir=output_dir, **params)
+
+
+@pytest.mark.parametrize("read_mode", ["window", "strip"])
+def test_parallel_extraction_is_same_as_serial(tmp_path, raster, labels, read_mode):
+    serial_dir, parallel_dir = str(tmp_path / "serial"), str(tmp_path / "parallel")
+    extract(serial_dir, 1, raster=raster, labels=labels, read_mode=read_mode)
+    extract(parallel_dir, 3, raster=raster, labels=labels, read_mode=read_mode)
+
+    serial, parallel = read_chips(serial_dir), read_chips(parallel_dir)
+    assert len(serial) > 0
+    assert serial.keys() == parallel.keys()
+    for name, (img, transform) in serial.items():
+        assert np.array_equal(img, parallel[name][0])
+        assert transform == parallel[name][1]
+
+
+def test_parallel_shard_extraction_is_same_as_serial(tmp_path, raster, labels):
+    serial_dir, parallel_dir = str(tmp_path / "serial"), str(tmp_path / "parallel")
+    for output_dir, workers in [(serial_dir, 1), (parallel_dir, 3)]:
+        extract(
+            output_dir,
+            workers,
+            raster=raster,
+            labels=labels,
+            output_format="npy",
+            shard_size=7,
+        )
+
+    serial, parallel = ChipShardDataset(serial_dir), ChipShardDataset(parallel_dir)
+    assert len(serial) > 0
+    assert serial.names == parallel.names
+    for k in range(len(serial)):
+        assert np.array_equal(serial.image(k), parallel.image(k))
+        assert np.array_equal(serial.mask(k), parallel.mask(k))
+        assert serial.transform(k) == parallel.transform(k)
+
+    # Files and shards hold the same chips
+    files_dir = str(tmp_path / "files")
+    extract(files_dir, 1, raster=raster, labels=labels)
+    files = read_chips(files_dir)
+    for k, name in enumerate(serial.names):
+        img, _ = files[os.path.join("images", f"{name}.tif")]
+        assert np.array_equal(serial.image(k), img)
+
+
+def test_chip_manifest(tmp_path, raster):
+    path = str(tmp_path / "out" / "manifest.sqlite")
+    with ChipManifest(path, batch_size=2) as manifest:
+        manifest.add(raster, "params", 0, 0, CHIP_WRITTEN)
+        manifest.add(raster, "params", 0, 1, CHIP_LOW_CONTRAST)
+        manifest.add(raster, "params", 1, 0, CHIP_FAILED)
+        assert manifest.done_windows(raster, "params") == {(0, 0), (0, 1)}
+        assert manifest.count(raster, "params", CHIP_FAILED) == 1
+        assert manifest.done_windows(raster, "other") == set()
+        assert not manifest.is_complete(raster, "params")
+        manifest.mark_complete(raster, "params")
+
+    with ChipManifest(path) as manifest:
+        assert manifest.is_complete(raster, "params")
+        assert manifest.done_windows(raster, "params") == {(0, 0), (0, 1)}
+
+        # Chips of a previous version of the raster are not done
+        mtime = os.path.getmtime(raster)
+        os.utime(raster, (mtime + 10, mtime + 10))
+        assert not manifest.is_complete(raster, "params")
+        assert manifest.done_windows(raster, "params") == set()
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Names of chip images written by extract_chips"""
+    names = []
+    write_tif = chips_module.write_tif
+
+    def write(img, path, *args, **kwargs):
+        names.append(os.path.basename(path))
+        return write_tif(img, path, *args, **kwargs)
+
+    monkeypatch.setattr(chips_module, "write_tif", write)
+    return names
+
+
+def test_manifest_skips_extracted_chips(tmp_path, raster, labels, written):
+    output_dir = str(tmp_path / "out")
+    extract(output_dir, 1, raster=raster, labels=labels, manifest=True)
+    names = sorted(written)
+    assert names
+
+    written.clear()
+    extract(output_dir, 1, raster=raster, labels=labels, manifest=True)
+    assert written == []
+
+
+@pytest.mark.parametrize("change", ["params", "labels"])
+def test_manifest_is_invalidated(tmp_path, raster, labels, written, change):
+    output_dir = str(tmp_path / "out")
+    extract(output_dir, 1, raster=raster, labels=labels, manifest=True)
+    names = sorted(written)
+
+    written.clear()
+    kwargs = dict(raster=raster, labels=labels, manifest=True)
+    if change == "params":
+        kwargs.update(rescale_range=(1, 99))
+    else:
+        mtime = os.path.getmtime(labels)
+        os.utime(labels, (mtime + 10, mtime + 10))
+    extract(output_dir, 1, **kwargs)
+    assert sorted(written) == names
+
+
+def test_manifest_retries_failed_chips(tmp_path, raster, labels, written, monkeypatch):
+    failed = []
+    write_mask_tif = chips_module.write_mask_tif
+
+    def write_mask(mask, path, *args, **kwargs):
+        if len(failed) < 3:
+            failed.append(os.path.basename(path))
+            raise RuntimeError("write failed")
+        return write_mask_tif(mask, path, *args, **kwargs)
+
+    output_dir = str(tmp_path / "out")
+    manifest_path = os.path.join(output_dir, "manifest.sqlite")
+    monkeypatch.setattr(chips_module, "write_mask_tif", write_mask)
+    extract(output_dir, 1, raster=raster, labels=labels, manifest=True)
+
+    conn = sqlite3.connect(manifest_path)
+    statuses = dict(conn.execute("SELECT status, COUNT(*) FROM chips GROUP BY status"))
+    (n_complete,) = conn.execute("SELECT COUNT(*) FROM rasters").fetchone()
+    conn.close()
+    assert statuses[CHIP_FAILED] == 3
+    assert n_complete == 0
+
+    # Only failed chips are extracted again, and then the raster is complete
+    written.clear()
+    monkeypatch.setattr(chips_module, "write_mask_tif", write_mask_tif)
+    extract(output_dir, 1, raster=raster, labels=labels, manifest=True)
+    assert sorted(written) == sorted(failed)
+    for name in failed:
+        assert os.path.exists(os.path.join(output_dir, "masks", name))
+
+    conn = sqlite3.connect(manifest_path)
+    statuses = dict(conn.execute("SELECT status, COUNT(*) FROM chips GROUP BY status"))
+    (n_complete,) = conn.execute("SELECT COUNT(*) FROM rasters").fetchone()
+    conn.close()
+    assert CHIP_FAILED not in statuses
+    assert n_complete == 1
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_raster_masks_are_same_as_window_masks(tmp_path, raster, labels, workers):
+    window_dir, raster_dir = str(tmp_path / "window"), str(tmp_path / "raster")
+    extract(window_dir, workers, raster=raster, labels=labels, mask_mode="window")
+    extract(raster_dir, workers, raster=raster, labels=labels, mask_mode="raster")
+
+    window, burned = read_chips(window_dir), read_chips(raster_dir)
+    masks = [name for name in window if name.startswith("masks")]
+    assert masks
+    assert any(window[name][0].any() for name in masks)
+    assert window.keys() == burned.keys()
+    for name, (img, transform) in window.items():
+        assert np.array_equal(img, burned[name][0])
+        assert transform == burned[name][1]
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import numpy as np
+import pytest
+import rasterio
+import rasterio.windows
+import satlomasproc.chips.utils as chips_utils
+from rasterio.transform import from_origin
+from satlomasproc.chips.utils import (
+    PercentileSketch,
+    calculate_rasters_percentiles,
+    filter_windows_by_aoi,
+    get_rasters_percentiles,
+    sliding_windows,
+    weighted_percentiles,
+)
+from shapely.geometry import Polygon, box
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+
+AOIS = [
+    # Concave polygon with a hole, crossing cell edges at arbitrary angles
+    Polygon(
+        [(300150, 8699950), (302900, 8699400), (301700, 8698100), (300400, 8697300)],
+        holes=[[(301000, 8699000), (301500, 8699000), (301300, 8698600)]],
+    ),
+    # Box whose edges run exactly along grid cell edges
+    box(300640, 8697440, 302560, 8699360),
+]
+
+
+def brute_force(windows, aoi, within):
+    res = []
+    for k, w in enumerate(windows):
+        shp = box(*rasterio.windows.bounds(w, TRANSFORM))
+        if aoi.contains(shp) if within else aoi.intersects(shp):
+            res.append(k)
+    return res
+
+
+@pytest.mark.parametrize("aoi", AOIS)
+@pytest.mark.parametrize("within", [False, True])
+@pytest.mark.parametrize("size,step_size", [(64, 64), (64, 32), (100, 48)])
+def test_filter_windows_by_aoi(aoi, within, size, step_size):
+    windows = [
+        w
+        for w, _ in sliding_windows(
+            (size, size), (step_size, step_size), 300, 280, whole=True
+        )
+    ]
+    res = filter_windows_by_aoi(
+        windows, aoi, within=within, transform=TRANSFORM, cell_size=step_size
+    )
+    assert res == brute_force(windows, aoi, within)
+
+
+def test_filter_windows_by_aoi_empty():
+    assert filter_windows_by_aoi([], AOIS[0], transform=TRANSFORM, cell_size=32) == []
+
+
+def write_raster(path, img, nodata=None):
+    profile = dict(
+        driver="GTiff",
+        width=img.shape[2],
+        height=img.shape[1],
+        count=img.shape[0],
+        dtype=img.dtype,
+        crs="EPSG:32718",
+        transform=TRANSFORM,
+        nodata=nodata,
+    )
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(img)
+    return str(path)
+
+
+def test_weighted_percentiles_unit_weights():
+    values = np.random.RandomState(0).normal(size=1001)
+    q = [0, 2, 25, 50, 98, 100]
+    res = weighted_percentiles(values, np.ones(len(values)), q)
+    assert np.allclose(res, np.percentile(values, q))
+
+
+def test_weighted_percentiles_integer_weights():
+    values = np.array([3.0, 1.0, 2.0, 5.0])
+    weights = np.array([2, 1, 3, 1])
+    q = [10, 50, 90]
+    res = weighted_percentiles(values, weights, q)
+    assert np.allclose(res, np.percentile(np.repeat(values, weights), q))
+
+
+def test_percentile_sketch_merge_histogram():
+    rs = np.random.RandomState(0)
+    a = rs.randint(0, 3000, size=(2, 5000)).astype(np.uint16)
+    b = rs.randint(1000, 9000, size=(2, 300)).astype(np.uint16)
+    sketch = PercentileSketch(2, np.uint16)
+    sketch.update(a)
+    other = PercentileSketch(2, np.uint16)
+    other.update(b)
+    sketch.merge(other)
+    q = [2, 50, 98]
+    expected = np.percentile(np.concatenate([a, b], axis=1), q, axis=1).T
+    assert np.allclose(sketch.percentiles(q), expected)
+
+
+def test_percentile_sketch_merge_samples():
+    rs = np.random.RandomState(0)
+    a = rs.normal(size=(1, 5000))
+    b = rs.normal(loc=10, size=(1, 300))
+    sketch = PercentileSketch(1, np.float32)
+    sketch.update(a)
+    other = PercentileSketch(1, np.float32)
+    other.update(b)
+    sketch.merge(other)
+    q = [2, 50, 98]
+    expected = np.percentile(np.concatenate([a, b], axis=1), q, axis=1).T
+    assert np.allclose(sketch.percentiles(q), expected)
+
+
+def test_percentile_sketch_merge_is_weighted():
+    # A small raster (1000 pixels) and a large one (100000 pixels), each
+    # represented by 1000 samples, in bounded sketches
+    rs = np.random.RandomState(0)
+    small = PercentileSketch(1, np.float32, max_samples=500, seed=0)
+    small.update(rs.normal(size=(1, 1000)))
+    large = PercentileSketch(1, np.float32, max_samples=500, seed=0)
+    large.update(rs.normal(loc=10, size=(1, 1000)), weights=np.full(1000, 100.0))
+
+    res = []
+    for first, second in [(small, large), (large, small)]:
+        sketch = PercentileSketch(1, np.float32, max_samples=500, seed=1)
+        sketch.merge(first)
+        sketch.merge(second)
+        res.append(sketch.percentiles([50])[0, 0])
+
+    # The median is that of the large raster, regardless of merge order
+    assert res[0] == pytest.approx(10, abs=0.3)
+    assert res[1] == pytest.approx(10, abs=0.3)
+
+
+def test_percentile_sketch_many_updates():
+    rs = np.random.RandomState(0)
+    values = rs.normal(size=(2, 20000))
+    sketch = PercentileSketch(2, np.float64, max_samples=1000, seed=0)
+    for chunk in np.split(values, 2000, axis=1):
+        sketch.update(chunk)
+
+    # The sample is bounded, and keeps the total weight
+    assert sketch.samples.shape == (2, 1000)
+    assert sketch.weights.sum() == pytest.approx(20000)
+    q = [10, 50, 90]
+    expected = np.percentile(values, q, axis=1).T
+    assert np.allclose(sketch.percentiles(q), expected, atol=0.15)
+
+    # Samples smaller than the bound are kept as they are
+    small = PercentileSketch(2, np.float64, max_samples=1000)
+    for chunk in np.split(values[:, :500], 50, axis=1):
+        small.update(chunk)
+    assert np.array_equal(small.samples, values[:, :500])
+    assert np.array_equal(small.weights, np.ones(500))
+
+
+def test_calculate_rasters_percentiles(tmp_path):
+    rs = np.random.RandomState(0)
+    imgs = [
+        rs.randint(0, 1000, size=(2, 64, 64)).astype(np.int16),
+        rs.randint(500, 4000, size=(2, 200, 300)).astype(np.int16),
+    ]
+    rasters = [write_raster(tmp_path / f"{k}.tif", img) for k, img in enumerate(imgs)]
+    res = calculate_rasters_percentiles(rasters, lower_cut=2, upper_cut=98)
+    values = np.concatenate([img.reshape(2, -1) for img in imgs], axis=1)
+    expected = np.percentile(values, [2, 98], axis=1).T
+    assert np.allclose(res, expected)
+
+
+def test_calculate_rasters_percentiles_no_valid_pixels(tmp_path):
+    nan = write_raster(tmp_path / "nan.tif", np.full((1, 32, 32), np.nan, np.float32))
+    nodata = write_raster(
+        tmp_path / "nodata.tif", np.zeros((1, 32, 32), np.uint8), nodata=0
+    )
+    for raster in (nan, nodata):
+        with pytest.raises(RuntimeError):
+            calculate_rasters_percentiles([raster])
+
+
+@pytest.fixture
+def calculated(monkeypatch):
+    """Rasters whose percentiles are calculated, one list per calculation"""
+    calls = []
+    calculate_rasters = chips_utils.calculate_rasters_percentiles
+
+    def calculate(rasters, *args, **kwargs):
+        calls.append(list(rasters))
+        return calculate_rasters(rasters, *args, **kwargs)
+
+    monkeypatch.setattr(chips_utils, "calculate_rasters_percentiles", calculate)
+    return calls
+
+
+def random_rasters(tmp_path, seed=0):
+    rs = np.random.RandomState(seed)
+    imgs = [
+        rs.randint(0, 1000, size=(2, 64, 64)).astype(np.int16),
+        rs.randint(500, 4000, size=(2, 100, 80)).astype(np.int16),
+    ]
+    rasters = [write_raster(tmp_path / f"{k}.tif", img) for k, img in enumerate(imgs)]
+    return rasters, imgs
+
+
+def percentiles(imgs, q):
+    values = np.concatenate([img.reshape(img.shape[0], -1) for img in imgs], axis=1)
+    return np.percentile(values, q, axis=1).T
+
+
+def test_get_rasters_percentiles_cache(tmp_path, calculated):
+    rasters, imgs = random_rasters(tmp_path)
+    stats_path = str(tmp_path / "stats" / "stats.json")
+    res = get_rasters_percentiles(rasters, 2, 98, stats_path=stats_path)
+    assert calculated == [[r] for r in rasters]
+    for raster, img in zip(rasters, imgs):
+        assert np.allclose(res[raster], percentiles([img], [2, 98]))
+
+    # Cache hit
+    calculated.clear()
+    assert get_rasters_percentiles(rasters, 2, 98, stats_path=stats_path) == res
+    assert calculated == []
+
+    # Other cuts are calculated and cached along with previous ones
+    res_ = get_rasters_percentiles(rasters, 1, 99, stats_path=stats_path)
+    assert calculated == [[r] for r in rasters]
+    assert np.allclose(res_[rasters[0]], percentiles([imgs[0]], [1, 99]))
+    with open(stats_path) as f:
+        assert len(json.load(f)) == 4
+
+
+def test_get_rasters_percentiles_changed_raster(tmp_path, calculated):
+    rasters, imgs = random_rasters(tmp_path)
+    stats_path = str(tmp_path / "stats.json")
+    get_rasters_percentiles(rasters, 2, 98, stats_path=stats_path)
+
+    # Only the raster whose contents changed is calculated again
+    calculated.clear()
+    img = imgs[0] * 2
+    write_raster(rasters[0], img)
+    res = get_rasters_percentiles(rasters, 2, 98, stats_path=stats_path)
+    assert calculated == [[rasters[0]]]
+    assert np.allclose(res[rasters[0]], percentiles([img], [2, 98]))
+
+
+def test_get_rasters_percentiles_group(tmp_path, calculated):
+    rasters, imgs = random_rasters(tmp_path)
+    stats_path = str(tmp_path / "stats.json")
+    get_rasters_percentiles(rasters, 2, 98, stats_path=stats_path)
+
+    # Group percentiles are cached apart from per-raster percentiles
+    calculated.clear()
+    res = get_rasters_percentiles(rasters, 2, 98, group=True, stats_path=stats_path)
+    assert calculated == [rasters]
+    expected = percentiles(imgs, [2, 98])
+    for raster in rasters:
+        assert np.allclose(res[raster], expected)
+
+    calculated.clear()
+    res_ = get_rasters_percentiles(rasters, 2, 98, group=True, stats_path=stats_path)
+    assert res_ == res
+    assert calculated == []
+
+    # A group with other rasters is calculated again
+    res_ = get_rasters_percentiles(
+        rasters[:1], 2, 98, group=True, stats_path=stats_path
+    )
+    assert calculated == [rasters[:1]]
+    assert np.allclose(res_[rasters[0]], percentiles(imgs[:1], [2, 98]))
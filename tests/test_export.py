@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("keras")
+pytest.importorskip("cv2")
+pytest.importorskip("tensorflow")
+
+from satlomasproc.unet import export as export_module  # noqa: E402
+from satlomasproc.unet import tflite as tflite_module  # noqa: E402
+from satlomasproc.unet.export import compare_models, iou  # noqa: E402
+from satlomasproc.unet.predict import PredictConfig, read_batch  # noqa: E402
+from satlomasproc.unet.tflite import TFLiteModel  # noqa: E402
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+
+
+class FakeInterpreter:
+    """TFLite interpreter of a model that averages bands"""
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.input_shape = (1, 8, 8, 3)
+        self.resized = []
+        self.allocated = False
+        self.tensors = {}
+
+    def get_input_details(self):
+        return [{"index": 0}]
+
+    def get_output_details(self):
+        return [{"index": 1}]
+
+    def resize_tensor_input(self, index, shape):
+        assert index == 0
+        self.input_shape = tuple(shape)
+        self.resized.append(self.input_shape)
+        self.allocated = False
+
+    def allocate_tensors(self):
+        self.allocated = True
+
+    def set_tensor(self, index, value):
+        assert self.allocated
+        assert value.shape == self.input_shape
+        assert value.dtype == np.float32
+        self.tensors[index] = value
+
+    def invoke(self):
+        self.tensors[1] = self.tensors[0].mean(axis=-1, keepdims=True)
+
+    def get_tensor(self, index):
+        return self.tensors[index]
+
+
+@pytest.fixture
+def interpreter(monkeypatch):
+    interpreters = []
+
+    def build(**kwargs):
+        interpreters.append(FakeInterpreter(**kwargs))
+        return interpreters[-1]
+
+    monkeypatch.setattr(
+        tflite_module, "tf", SimpleNamespace(lite=SimpleNamespace(Interpreter=build))
+    )
+    return interpreters
+
+
+def test_tflite_model(interpreter):
+    model = TFLiteModel("model.tflite", num_threads=2)
+    (interp,) = interpreter
+    assert interp.model_path == "model.tflite"
+    assert interp.num_threads == 2
+
+    rs = np.random.RandomState(0)
+    for batch_size in (4, 4, 2, 4, 1):
+        images = rs.randint(0, 256, size=(batch_size, 8, 8, 3)).astype(np.uint8)
+        preds = model.predict(images)
+        assert preds.shape == (batch_size, 8, 8, 1)
+        assert np.allclose(preds, images.mean(axis=-1, keepdims=True))
+
+    # The input tensor is resized only when the batch size changes
+    assert interp.resized == [(4, 8, 8, 3), (2, 8, 8, 3), (4, 8, 8, 3), (1, 8, 8, 3)]
+
+
+def test_iou():
+    a = np.array([[True, True, False], [False, False, False]])
+    b = np.array([[True, False, False], [True, False, False]])
+    assert iou(a, b) == pytest.approx(1 / 3)
+    assert iou(a, a) == 1
+    assert iou(a, ~a) == 0
+    # Both masks are empty
+    assert iou(np.zeros(3, bool), np.zeros(3, bool)) == 1
+
+
+class FakeKerasModel:
+    """Predicts the first band scaled to 0-1, and records predicted chips"""
+
+    def __init__(self):
+        self.n_chips = 0
+
+    def load_weights(self, path):
+        pass
+
+    def predict(self, X):
+        self.n_chips += len(X)
+        return X[..., :1] / 255
+
+
+class FakeTFLiteModel(FakeKerasModel):
+    """Same as FakeKerasModel, but predictions are off by +offset+"""
+
+    offset = 0.05
+
+    def __init__(self, path):
+        super().__init__()
+
+    def predict(self, X):
+        return np.clip(super().predict(X) + self.offset, 0, 1)
+
+
+@pytest.fixture
+def models(monkeypatch):
+    res = {}
+
+    def build_model(cfg):
+        res["keras"] = FakeKerasModel()
+        return res["keras"]
+
+    def tflite_model(path):
+        res["tflite"] = FakeTFLiteModel(path)
+        return res["tflite"]
+
+    backend = SimpleNamespace(
+        clear_session=lambda: None, set_learning_phase=lambda value: None
+    )
+    monkeypatch.setattr(export_module, "K", backend)
+    monkeypatch.setattr(export_module, "build_model", build_model)
+    monkeypatch.setattr(export_module, "TFLiteModel", tflite_model)
+    return res
+
+
+@pytest.fixture
+def chips(tmp_path):
+    rs = np.random.RandomState(0)
+    os.makedirs(tmp_path / "chips" / "images")
+    for k in range(5):
+        with rasterio.open(
+            str(tmp_path / "chips" / "images" / f"c_{k}.tif"),
+            "w",
+            driver="GTiff",
+            width=16,
+            height=16,
+            count=3,
+            dtype=np.uint8,
+            crs="EPSG:32718",
+            transform=TRANSFORM,
+        ) as dst:
+            dst.write(rs.randint(0, 256, size=(3, 16, 16)).astype(np.uint8))
+    return str(tmp_path / "chips")
+
+
+def test_compare_models(chips, models):
+    cfg = PredictConfig(batch_size=2, height=16, width=16)
+    res = compare_models(cfg, "model.tflite", threshold=0.5, images_path=chips)
+
+    paths = sorted(os.path.join(chips, "images", f"c_{k}.tif") for k in range(5))
+    X, _, _ = read_batch(paths, cfg=cfg)
+    keras_preds = X[..., :1] / 255
+    tflite_preds = np.clip(keras_preds + FakeTFLiteModel.offset, 0, 1)
+    a, b = keras_preds >= 0.5, tflite_preds >= 0.5
+    expected_iou = np.logical_and(a, b).sum() / np.logical_or(a, b).sum()
+
+    assert 0 < expected_iou < 1
+    assert res["iou"] == pytest.approx(expected_iou)
+    assert res["max_abs_diff"] == pytest.approx(FakeTFLiteModel.offset, abs=1e-6)
+    assert res["keras_chips_per_sec"] > 0
+    assert res["tflite_chips_per_sec"] > 0
+    # Each model predicts all chips, and a first batch to warm up
+    assert models["keras"].n_chips == 5 + 2
+
+
+def test_compare_models_max_samples(tmp_path, chips, models):
+    cfg = PredictConfig(batch_size=2, height=16, width=16)
+    compare_models(cfg, "model.tflite", max_samples=3, images_path=chips)
+    assert models["keras"].n_chips == 3 + 2
+
+    os.makedirs(tmp_path / "empty")
+    with pytest.raises(RuntimeError):
+        compare_models(cfg, "model.tflite", images_path=str(tmp_path / "empty"))
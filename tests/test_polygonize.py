@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import fiona
+import numpy as np
+import pytest
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+from scipy import ndimage
+from shapely.geometry import shape
+
+pytest.importorskip("keras")
+pytest.importorskip("cv2")
+
+from satlomasproc.unet import polygonize as polygonize_module  # noqa: E402
+from satlomasproc.unet.polygonize import polygonize  # noqa: E402
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+# Geographic grid, with a pixel size that is not exactly representable
+RES = 8.983152841195214e-05
+TRANSFORM = from_origin(-77.123456789, -12.0123456, RES, RES)
+
+
+@pytest.fixture
+def class_raster(tmp_path):
+    """Class raster of 3 classes with nodata (0), made of blobs"""
+    rs = np.random.RandomState(0)
+    img = ndimage.zoom(rs.randint(0, 4, size=(12, 15)), 10, order=0)
+    img = ndimage.median_filter(img, 5).astype(np.uint8)
+    path = str(tmp_path / "cls.tif")
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=img.shape[1],
+        height=img.shape[0],
+        count=1,
+        dtype=np.uint8,
+        crs="EPSG:4326",
+        transform=TRANSFORM,
+        nodata=0,
+    ) as dst:
+        dst.write(img, 1)
+    return path
+
+
+def read_polygons(path):
+    with fiona.open(path) as src:
+        return [(f["properties"]["class"], shape(f["geometry"])) for f in src]
+
+
+def normalized(polygons):
+    # Remove collinear vertices left along dissolved tile seams
+    return sorted((c, shapely.normalize(g.simplify(0)).wkb) for c, g in polygons)
+
+
+@pytest.mark.parametrize("tile_size", [32, 50])
+def test_tiles_are_dissolved(tmp_path, class_raster, tile_size):
+    single = str(tmp_path / "single.gpkg")
+    tiled = str(tmp_path / "tiled.fgb")
+    polygonize(class_raster, tile_size=1000, workers=1, output=single)
+    polygonize(class_raster, tile_size=tile_size, workers=2, output=tiled)
+
+    expected = read_polygons(single)
+    assert len(expected) > 10
+    assert normalized(read_polygons(tiled)) == normalized(expected)
+
+
+def test_min_area(tmp_path, class_raster):
+    output = str(tmp_path / "out.gpkg")
+    min_area = 50 * RES ** 2
+    polygonize(class_raster, min_area=min_area, tile_size=32, workers=2, output=output)
+
+    with fiona.open(output) as src:
+        areas = [f["properties"]["area"] for f in src]
+    assert areas
+    assert min(areas) >= min_area
+
+
+@pytest.mark.skipif(
+    not hasattr(shapely, "coverage_simplify"), reason="needs Shapely 2.1 or later"
+)
+@pytest.mark.parametrize("tile_size", [32, 1000])
+def test_simplify_keeps_coverage(tmp_path, class_raster, tile_size):
+    output = str(tmp_path / "out.gpkg")
+    polygonize(
+        class_raster,
+        simplify=3 * RES,
+        tile_size=tile_size,
+        workers=2,
+        coverage=True,
+        output=output,
+    )
+
+    geoms = [g for _, g in read_polygons(output)]
+    assert all(g.is_valid for g in geoms)
+    # No gaps nor overlaps between neighbouring polygons
+    assert shapely.coverage_is_valid(geoms)
+
+
+def test_simplify_each_polygon(tmp_path, class_raster, monkeypatch):
+    # Without coverage simplification, polygons of different classes are not
+    # kept together across tile seams, so only polygons that touch the
+    # bottom of a row of tiles are kept in memory
+    calls = []
+    dissolve_seams = polygonize_module.dissolve_seams
+
+    def dissolve(polygons, link_classes=False):
+        calls.append(link_classes)
+        return dissolve_seams(polygons, link_classes)
+
+    monkeypatch.setattr(polygonize_module, "dissolve_seams", dissolve)
+    exact, simplified = str(tmp_path / "exact.gpkg"), str(tmp_path / "simple.gpkg")
+    polygonize(class_raster, tile_size=32, workers=2, output=exact)
+    polygonize(
+        class_raster, simplify=3 * RES, tile_size=32, workers=2, output=simplified
+    )
+
+    assert calls and not any(calls)
+    expected = read_polygons(exact)
+    polygons = read_polygons(simplified)
+    assert all(g.is_valid for _, g in polygons)
+    assert sum(len(g.exterior.coords) for _, g in polygons) < sum(
+        len(g.exterior.coords) for _, g in expected
+    )
+    # Boundaries move by at most the tolerance
+    for value in (1, 2, 3):
+        geom = shapely.union_all([g for c, g in polygons if c == value])
+        expected_geom = shapely.union_all([g for c, g in expected if c == value])
+        assert geom.hausdorff_distance(expected_geom) <= 3 * RES * 1.001
+
+
+def test_unknown_format(tmp_path, class_raster):
+    with pytest.raises(RuntimeError):
+        polygonize(class_raster, output=str(tmp_path / "out.shp"))
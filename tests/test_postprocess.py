@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import os
+from glob import glob
+
+import numpy as np
+import pytest
+import rasterio
+import rasterio.windows
+from rasterio.transform import Affine, from_origin
+from rasterio.windows import Window
+
+pytest.importorskip("keras")
+pytest.importorskip("cv2")
+
+from satlomasproc.unet.postprocess import (  # noqa: E402
+    coalesce_and_binarize_array,
+    coalesce_and_binarize_raster,
+    mosaic,
+    smooth_stitch,
+    spline_window,
+)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+
+
+def smooth_image(height, width, count=2):
+    yy, xx = np.mgrid[0:height, 0:width]
+    bands = [np.sin(xx / 50 + k) * np.cos(yy / 70) for k in range(count)]
+    return (1 + 254 * (0.5 + 0.5 * np.stack(bands))).astype(np.uint8)
+
+
+@pytest.fixture
+def chips(tmp_path):
+    """Overlapping chips of 64x64 pixels, every 32 pixels, of a smooth image"""
+    img = smooth_image(300, 420)
+    chips_dir = str(tmp_path / "chips")
+    os.makedirs(chips_dir)
+    profile = dict(driver="GTiff", dtype="uint8", count=2, crs="EPSG:32718", nodata=0)
+    for i in range(0, img.shape[1] - 64 + 1, 32):
+        for j in range(0, img.shape[2] - 64 + 1, 32):
+            window = Window(j, i, 64, 64)
+            path = os.path.join(chips_dir, f"c_{i}_{j}.tif")
+            with rasterio.open(
+                path,
+                "w",
+                width=64,
+                height=64,
+                transform=rasterio.windows.transform(window, TRANSFORM),
+                **profile,
+            ) as dst:
+                dst.write(img[:, i : i + 64, j : j + 64])
+    return chips_dir, img
+
+
+def read_stitched(output_dir):
+    res = {}
+    for path in sorted(glob(os.path.join(output_dir, "*.tif"))):
+        with rasterio.open(path) as src:
+            res[os.path.basename(path)] = (src.read(), src.transform)
+    return res
+
+
+def test_spline_window():
+    wind = spline_window(64)
+    assert wind.shape == (64,)
+    assert np.allclose(wind, wind[::-1])
+    assert np.isclose(np.average(wind), 1)
+
+
+def test_smooth_stitch(tmp_path, chips):
+    chips_dir, img = chips
+    serial_dir, parallel_dir = str(tmp_path / "serial"), str(tmp_path / "parallel")
+    smooth_stitch(input_dir=chips_dir, output_dir=serial_dir)
+    smooth_stitch(workers=3, input_dir=chips_dir, output_dir=parallel_dir)
+
+    serial, parallel = read_stitched(serial_dir), read_stitched(parallel_dir)
+    assert len(serial) > 1
+    assert serial.keys() == parallel.keys()
+    for name, (stitched, transform) in serial.items():
+        # Same result for any number of workers
+        assert np.array_equal(stitched, parallel[name][0])
+        assert transform == parallel[name][1]
+
+        # All chips have the same values where they overlap, so their
+        # weighted mean is the original image
+        row = int(round((TRANSFORM.f - transform.f) / 10))
+        col = int(round((transform.c - TRANSFORM.c) / 10))
+        _, height, width = stitched.shape
+        expected = img[:, row : row + height, col : col + width]
+        assert np.abs(stitched.astype(int) - expected).max() <= 1
+
+
+def test_coalesce_and_binarize_raster(tmp_path):
+    rs = np.random.RandomState(0)
+    img = rs.randint(0, 256, size=(3, 700, 900)).astype(np.uint8)
+    src_path = str(tmp_path / "prob.tif")
+    with rasterio.open(
+        src_path,
+        "w",
+        driver="GTiff",
+        width=900,
+        height=700,
+        count=3,
+        dtype=np.uint8,
+        crs="EPSG:32718",
+        transform=TRANSFORM,
+        tiled=True,
+    ) as dst:
+        dst.write(img)
+
+    expected = coalesce_and_binarize_array(img, threshold=0.75)
+    for workers in (1, 4):
+        output = str(tmp_path / f"cls_{workers}.tif")
+        coalesce_and_binarize_raster(src_path, 0.75, workers=workers, output=output)
+        with rasterio.open(output) as src:
+            assert np.array_equal(src.read(1), expected)
+
+
+def test_coalesce_and_binarize_array():
+    img = np.array([[[10, 180]], [[250, 100]]], dtype=np.uint8)
+    assert coalesce_and_binarize_array(img, threshold=0.75).tolist() == [[2, 0]]
+
+
+@pytest.fixture
+def mosaic_chips(tmp_path):
+    """
+    Overlapping chips of different sizes, at random offsets of a grid, with
+    holes of nodata (0) values
+    """
+    rs = np.random.RandomState(0)
+    chips_dir = str(tmp_path / "mosaic_chips")
+    os.makedirs(chips_dir)
+    chips = []
+    for k in range(12):
+        height, width = rs.randint(20, 70, size=2)
+        row, col = rs.randint(0, 150, size=2)
+        img = rs.randint(1, 256, size=(2, height, width)).astype(np.uint8)
+        img[:, rs.rand(height, width) < 0.3] = 0
+        path = os.path.join(chips_dir, f"c_{k:02}.tif")
+        window = Window(col, row, width, height)
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=width,
+            height=height,
+            count=2,
+            dtype="uint8",
+            crs="EPSG:32718",
+            transform=rasterio.windows.transform(window, TRANSFORM),
+            nodata=0,
+        ) as dst:
+            dst.write(img)
+        chips.append((path, row, col, img))
+    return chips
+
+
+@pytest.mark.parametrize("vrt", [False, True])
+def test_mosaic(tmp_path, mosaic_chips, vrt):
+    output = str(tmp_path / ("mosaic.vrt" if vrt else "mosaic.tif"))
+    mosaic([path for path, *_ in mosaic_chips], vrt=vrt, block_size=64, output=output)
+
+    # Later chips are drawn over earlier ones, except for their nodata pixels
+    top = min(row for _, row, _, _ in mosaic_chips)
+    left = min(col for _, _, col, _ in mosaic_chips)
+    bottom = max(row + img.shape[1] for _, row, _, img in mosaic_chips)
+    right = max(col + img.shape[2] for _, _, col, img in mosaic_chips)
+    expected = np.zeros((2, bottom - top, right - left), dtype=np.uint8)
+    for _, row, col, img in mosaic_chips:
+        _, height, width = img.shape
+        row, col = row - top, col - left
+        view = expected[:, row : row + height, col : col + width]
+        valid = img != 0
+        view[valid] = img[valid]
+
+    with rasterio.open(output) as src:
+        assert src.transform == TRANSFORM * Affine.translation(left, top)
+        assert src.crs == "EPSG:32718"
+        assert src.nodata == 0
+        assert np.array_equal(src.read(), expected)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import os
+from glob import glob
+
+import attr
+import numpy as np
+import pytest
+import rasterio
+import rasterio.windows
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from satlomasproc.raster import COGOptions
+
+pytest.importorskip("keras")
+pytest.importorskip("cv2")
+
+from satlomasproc.unet import predict as predict_module  # noqa: E402
+from satlomasproc.unet.predict import (  # noqa: E402
+    PredictConfig,
+    predict,
+    predict_raster,
+    read_batch,
+    write_batch,
+)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+
+
+class FakeModel:
+    """Predicts the first band (scaled to 0-1) as class 1, and its complement"""
+
+    def __init__(self, cfg):
+        self.input_shape = (cfg.height, cfg.width, cfg.n_channels)
+        self.n_batches = 0
+
+    def predict(self, X, batch_size=None):
+        assert X.shape[1:] == self.input_shape
+        self.n_batches += 1
+        prob = X[..., :1] / 255
+        return np.concatenate([prob, 1 - prob], axis=-1)
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    models = []
+
+    def load(cfg):
+        models.append(FakeModel(cfg))
+        return models[-1]
+
+    monkeypatch.setattr(predict_module, "load_predict_model", load)
+    return models
+
+
+@pytest.fixture
+def raster(tmp_path):
+    """
+    Smooth image with a period of 64 pixels, so that every tile of 64 pixels
+    or more has values from 0 to 255 (and min-max scaling keeps them)
+    """
+    yy, xx = np.mgrid[0:150, 0:170]
+    img = 127.5 + 127.5 * np.sin(2 * np.pi * xx / 64) * np.cos(2 * np.pi * yy / 64)
+    img = np.stack([img, img[::-1], 255 - img]).astype(np.float32)
+    path = str(tmp_path / "scene.tif")
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=170,
+        height=150,
+        count=3,
+        dtype=np.float32,
+        crs="EPSG:32718",
+        transform=TRANSFORM,
+    ) as dst:
+        dst.write(img)
+    return path, img
+
+
+@pytest.mark.parametrize("model_size,max_error", [(64, 1), (32, 6)])
+def test_predict_raster(tmp_path, raster, fake_model, model_size, max_error):
+    path, img = raster
+    output = str(tmp_path / "out" / "prob.tif")
+    cfg = PredictConfig(width=model_size, height=model_size, batch_size=4, n_classes=2)
+    predict_raster(cfg, chip_size=64, step_size=32, raster=path, output=output)
+
+    (model,) = fake_model
+    # 4 x 5 tiles of 64 pixels, every 32 pixels and aligned to the edges
+    assert model.n_batches == 5
+
+    with rasterio.open(path) as src, rasterio.open(output) as dst:
+        assert dst.crs == src.crs
+        assert dst.transform == src.transform
+        assert (dst.width, dst.height) == (src.width, src.height)
+        assert dst.count == 2
+        assert dst.nodata == 0
+        res = dst.read()
+
+    # Every tile predicts the same probabilities where they overlap, so
+    # blending them gives back the first band (with some resampling error
+    # when tiles are resized to the model input size)
+    prob = img[0] / 255
+    expected = np.round(1 + np.stack([prob, 1 - prob]) * 254)
+    assert res.min() >= 1
+    assert np.abs(res.astype(int) - expected).max() <= max_error
+
+
+@pytest.fixture
+def chips(tmp_path, raster):
+    """Chips of different sizes of the raster"""
+    path, img = raster
+    chips_dir = tmp_path / "chips"
+    os.makedirs(chips_dir / "images")
+    k = 0
+    for size in (24, 40):
+        for row in range(0, 150 - size, 30):
+            for col in range(0, 170 - size, 45):
+                window = Window(col, row, size, size)
+                with rasterio.open(
+                    str(chips_dir / "images" / f"c_{k}.tif"),
+                    "w",
+                    driver="GTiff",
+                    width=size,
+                    height=size,
+                    count=3,
+                    dtype=np.float32,
+                    crs="EPSG:32718",
+                    transform=rasterio.windows.transform(window, TRANSFORM),
+                ) as dst:
+                    dst.write(img[:, row : row + size, col : col + size])
+                k += 1
+    return str(chips_dir)
+
+
+def read_results(results_path):
+    res = {}
+    for path in sorted(glob(os.path.join(results_path, "*.tif"))):
+        with rasterio.open(path) as src:
+            res[os.path.basename(path)] = (src.read(), src.transform)
+    return res
+
+
+@pytest.mark.parametrize("cog", [None, COGOptions()])
+def test_predict_is_same_as_serial(tmp_path, chips, fake_model, cog):
+    cfg = PredictConfig(
+        images_path=chips,
+        results_path=str(tmp_path / "results"),
+        batch_size=4,
+        height=32,
+        width=32,
+        n_classes=2,
+        read_workers=3,
+        write_workers=3,
+        queue_size=2,
+        cog=cog,
+    )
+    predict(cfg)
+
+    # Predict and write chip by chip
+    serial_cfg = attr.evolve(cfg, results_path=str(tmp_path / "serial"))
+    os.makedirs(serial_cfg.results_path)
+    model = predict_module.load_predict_model(serial_cfg)
+    for chip in sorted(glob(os.path.join(chips, "images", "*.tif"))):
+        X, profiles, filenames = read_batch([chip], cfg=serial_cfg)
+        write_batch(model.predict(X), profiles, filenames, cfg=serial_cfg)
+
+    res = read_results(cfg.results_path)
+    expected = read_results(serial_cfg.results_path)
+    assert len(expected) == len(glob(os.path.join(chips, "images", "*.tif")))
+    assert res.keys() == expected.keys()
+    for name, (img, transform) in expected.items():
+        assert np.array_equal(res[name][0], img)
+        assert res[name][1] == transform
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from satlomasproc.raster import (
+    COGOptions,
+    OverviewBuilder,
+    write_raster,
+)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+
+def profile(width, height, dtype=np.uint8, count=1):
+    return dict(
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=count,
+        dtype=dtype,
+        crs="EPSG:32718",
+        transform=from_origin(300000, 8700000, 10, 10),
+        nodata=0,
+    )
+
+
+def image(width, height, dtype=np.uint8, count=1):
+    rs = np.random.RandomState(0)
+    return rs.randint(0, 200, size=(count, height, width)).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype,predictor", [(np.uint8, "2"), (np.float32, "3")])
+def test_write_cog(tmp_path, dtype, predictor):
+    path = str(tmp_path / "out.tif")
+    img = image(1100, 700, dtype=dtype, count=2)
+    options = COGOptions(block_size=256, compress="deflate")
+    write_raster(img, path, cog=options, profile=profile(1100, 700, dtype, 2))
+
+    with rasterio.open(path) as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.tags(ns="IMAGE_STRUCTURE")["PREDICTOR"] == predictor
+        assert src.profile["tiled"]
+        assert src.block_shapes[0] == (256, 256)
+        assert src.compression.value == "DEFLATE"
+        assert src.overviews(1) == [2, 4]
+        assert np.array_equal(src.read(), img)
+
+
+def test_write_small_cog(tmp_path):
+    # Chips smaller than a block are written as a single block, without
+    # overviews
+    path = str(tmp_path / "chip.tif")
+    img = image(100, 60)
+    write_raster(img, path, cog=COGOptions(), profile=profile(100, 60))
+
+    with rasterio.open(path) as src:
+        assert src.block_shapes[0] == (112, 112)
+        assert src.overviews(1) == []
+        assert np.array_equal(src.read(), img)
+
+
+def test_overview_builder(tmp_path):
+    options = COGOptions(block_size=128, compress="zstd")
+    paths = [str(tmp_path / f"{k}.tif") for k in range(3)]
+    with OverviewBuilder(workers=2) as builder:
+        for path in paths:
+            write_raster(
+                image(600, 500),
+                path,
+                cog=options,
+                overview_builder=builder,
+                profile=profile(600, 500),
+            )
+
+    for path in paths:
+        with rasterio.open(path) as src:
+            assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+            assert src.compression.value == "ZSTD"
+            assert src.overviews(1) == [2, 4]
+
+
+def test_no_cog_options(tmp_path):
+    # Rasters are written as given by their profile without COG options
+    path = str(tmp_path / "out.tif")
+    img = image(600, 500)
+    write_raster(img, path, profile=profile(600, 500))
+
+    with rasterio.open(path) as src:
+        assert "LAYOUT" not in src.tags(ns="IMAGE_STRUCTURE")
+        assert not src.profile.get("tiled")
+        assert src.overviews(1) == []
+        assert np.array_equal(src.read(), img)
+
+
+def test_invalid_cog_options():
+    with pytest.raises(ValueError):
+        COGOptions(block_size=100)
+    with pytest.raises(ValueError):
+        COGOptions(compress="jpeg")
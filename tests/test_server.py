@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+import rasterio
+import rasterio.windows
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+pytest.importorskip("keras")
+pytest.importorskip("cv2")
+
+from satlomasproc.unet import server as server_module  # noqa: E402
+from satlomasproc.unet.predict import PredictConfig  # noqa: E402
+from satlomasproc.unet.server import DynamicBatcher, handle_predict  # noqa: E402
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+
+
+class FakeModel:
+    """Predicts the first band (scaled to 0-1), and records batch sizes"""
+
+    def __init__(self, cfg):
+        self.batch_sizes = []
+
+    def predict(self, X):
+        self.batch_sizes.append(len(X))
+        if np.isnan(X).any():
+            raise RuntimeError("NaN values")
+        return X[..., :1] / 255
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    models = []
+
+    def load(cfg):
+        models.append(FakeModel(cfg))
+        return models[-1]
+
+    monkeypatch.setattr(server_module, "load_predict_model", load)
+    return models
+
+
+def test_batches(fake_model):
+    cfg = PredictConfig(batch_size=4, height=8, width=8)
+    batcher = DynamicBatcher(cfg, max_latency=0.5)
+    (model,) = fake_model
+
+    images = np.random.RandomState(0).rand(10, 8, 8, 3) * 255
+    preds = batcher.predict(list(images))
+
+    # Chips are predicted in order, in full batches while there are enough
+    # chips queued
+    assert model.batch_sizes == [4, 4, 2]
+    assert np.allclose(preds, images[..., :1] / 255)
+
+
+def test_batches_of_concurrent_callers(fake_model):
+    cfg = PredictConfig(batch_size=8, height=8, width=8)
+    batcher = DynamicBatcher(cfg, max_latency=0.5)
+    (model,) = fake_model
+
+    images = np.random.RandomState(0).rand(4, 8, 8, 3) * 255
+    results = {}
+
+    def predict(k):
+        results[k] = batcher.predict(list(images[2 * k : 2 * k + 2]))
+
+    threads = [threading.Thread(target=predict, args=(k,)) for k in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Chips of both callers are predicted in the same batch
+    assert model.batch_sizes == [4]
+    for k in range(2):
+        assert np.allclose(results[k], images[2 * k : 2 * k + 2, ..., :1] / 255)
+
+
+def test_batch_timeout(fake_model):
+    cfg = PredictConfig(batch_size=8, height=8, width=8)
+    batcher = DynamicBatcher(cfg, max_latency=0.1)
+    (model,) = fake_model
+
+    image = np.full((8, 8, 3), 51.0)
+    start = time.perf_counter()
+    pred = batcher.submit(image).result(timeout=5)
+    elapsed = time.perf_counter() - start
+
+    # An incomplete batch is predicted once the latency is over
+    assert 0.1 <= elapsed < 2
+    assert model.batch_sizes == [1]
+    assert np.allclose(pred, 0.2)
+
+
+def test_batch_errors(fake_model):
+    batcher = DynamicBatcher(PredictConfig(height=8, width=8), max_latency=0.01)
+    image = np.full((8, 8, 3), np.nan)
+    with pytest.raises(RuntimeError):
+        batcher.predict([image])
+
+    # The batcher keeps predicting after a failed batch
+    assert np.allclose(batcher.predict([np.zeros((8, 8, 3))]), 0)
+
+
+def test_load_errors(monkeypatch):
+    def load(cfg):
+        raise OSError("model not found")
+
+    monkeypatch.setattr(server_module, "load_predict_model", load)
+    with pytest.raises(OSError):
+        DynamicBatcher(PredictConfig())
+
+
+@pytest.fixture
+def scene(tmp_path):
+    """Raster with the same gradient (0-255) on every band, and chips of it"""
+    yy, xx = np.mgrid[0:64, 0:96]
+    band = (xx * 255 / 95) * (yy >= 32) + (255 - xx * 255 / 95) * (yy < 32)
+    img = np.repeat(band[np.newaxis], 3, axis=0).astype(np.uint8)
+    profile = dict(
+        driver="GTiff", dtype="uint8", count=3, crs="EPSG:32718", nodata=None
+    )
+    path = str(tmp_path / "scene.tif")
+    with rasterio.open(
+        path, "w", width=96, height=64, transform=TRANSFORM, **profile
+    ) as dst:
+        dst.write(img)
+
+    os.makedirs(tmp_path / "chips")
+    chips = []
+    for k, (row, col) in enumerate([(0, 0), (32, 32), (0, 64)]):
+        window = Window(col, row, 32, 32)
+        chip = os.path.join("chips", f"c_{k}.tif")
+        with rasterio.open(
+            str(tmp_path / chip),
+            "w",
+            width=32,
+            height=32,
+            transform=rasterio.windows.transform(window, TRANSFORM),
+            **profile,
+        ) as dst:
+            dst.write(img[:, row : row + 32, col : col + 32])
+        chips.append((chip, window))
+    return path, img, chips
+
+
+def expected_prediction(img, window):
+    # The model predicts the first band, min-max scaled to 0-255, and
+    # probabilities are scaled to 1-255
+    rows, cols = window.toslices()
+    chip = img[0, rows, cols].astype(float)
+    chip = (chip - chip.min()) / (chip.max() - chip.min())
+    return np.round(1 + chip * 254)
+
+
+@pytest.mark.parametrize("mode", ["chips", "raster"])
+def test_handle_predict(tmp_path, fake_model, scene, mode):
+    path, img, chips = scene
+    cfg = PredictConfig(batch_size=2, height=32, width=32)
+    batcher = DynamicBatcher(cfg, max_latency=0.01)
+
+    if mode == "chips":
+        params = dict(chips=[chip for chip, _ in chips])
+    else:
+        windows = [(w.col_off, w.row_off, w.width, w.height) for _, w in chips]
+        params = dict(raster="scene.tif", windows=windows)
+    paths = handle_predict(
+        batcher, dict(output_dir="out", **params), root=str(tmp_path)
+    )
+
+    assert len(paths) == len(chips)
+    for output, (_, window) in zip(paths, chips):
+        assert os.path.dirname(output) == str(tmp_path / "out")
+        with rasterio.open(output) as src:
+            assert src.transform == rasterio.windows.transform(window, TRANSFORM)
+            assert src.crs == "EPSG:32718"
+            assert src.count == 1
+            res = src.read(1)
+        # Predictions do not depend on the other chips of the batch
+        assert np.abs(res.astype(int) - expected_prediction(img, window)).max() <= 1
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        dict(output_dir="../out", chips=["chips/c_0.tif"]),
+        dict(output_dir="out", chips=["/etc/passwd"]),
+        dict(output_dir="out", raster="../scene.tif", windows=[(0, 0, 32, 32)]),
+    ],
+)
+def test_handle_predict_outside_root(tmp_path, fake_model, scene, params):
+    batcher = DynamicBatcher(PredictConfig(height=32, width=32), max_latency=0.01)
+    with pytest.raises(ValueError):
+        handle_predict(batcher, params, root=str(tmp_path / "chips"))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pytest
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from satlomasproc.chips.shards import ChipShardDataset, ShardWriter, write_latest_key
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+
+def write_chips(output_dir, names, value=0, *, prefix, key, shard_size=3):
+    writer = ShardWriter(
+        output_dir, shard_size=shard_size, prefix=prefix, crs="EPSG:32718", key=key
+    )
+    chips = {}
+    for k, name in enumerate(names):
+        image = np.full((3, 8, 8), value + k, dtype=np.uint8)
+        mask = np.full((1, 8, 8), k % 2, dtype=np.uint8)
+        transform = from_origin(300000 + k * 80, 8700000, 10, 10)
+        writer.add(name, image, mask, transform=transform)
+        chips[name] = (image, mask, transform)
+    writer.flush()
+    write_latest_key(output_dir, key)
+    return chips
+
+
+def test_round_trip(tmp_path):
+    names = [f"r_{k}_0" for k in range(7)]
+    chips = write_chips(str(tmp_path), names, prefix="r_run1_0_0", key="a")
+
+    assert ChipShardDataset.exists(str(tmp_path))
+    dataset = ChipShardDataset(str(tmp_path))
+    assert len(dataset) == 7
+    assert dataset.names == sorted(names)
+    for k, name in enumerate(dataset.names):
+        image, mask, transform = chips[name]
+        assert np.array_equal(dataset.image(k), image)
+        assert np.array_equal(dataset.mask(k), mask)
+        assert dataset.transform(k).almost_equals(transform)
+        profile = dataset.profile(k)
+        assert (profile["width"], profile["height"]) == (8, 8)
+        assert profile["crs"] == CRS.from_epsg(32718)
+
+
+def test_rerun_reads_latest_chips(tmp_path):
+    output_dir = str(tmp_path)
+    write_chips(output_dir, ["a", "b", "c", "d"], value=0, prefix="r_run1", key="k")
+    write_chips(output_dir, ["c", "d", "e"], value=100, prefix="r_run0", key="k")
+    # Make sure the second run is the most recent one
+    shards_dir = os.path.join(output_dir, "shards", "k")
+    for name in os.listdir(shards_dir):
+        if name.startswith("r_run0"):
+            path = os.path.join(shards_dir, name)
+            os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 10))
+
+    dataset = ChipShardDataset(output_dir)
+    assert dataset.names == ["a", "b", "c", "d", "e"]
+    values = [int(dataset.image(k)[0, 0, 0]) for k in range(len(dataset))]
+    assert values == [0, 1, 100, 101, 102]
+
+
+def test_keys_are_isolated(tmp_path):
+    output_dir = str(tmp_path)
+    write_chips(output_dir, ["a", "b"], value=0, prefix="r_run1", key="k1")
+    write_chips(output_dir, ["a", "c", "d"], value=100, prefix="r_run2", key="k2")
+
+    assert ChipShardDataset.latest_key(output_dir) == "k2"
+    latest = ChipShardDataset(output_dir)
+    assert latest.names == ["a", "c", "d"]
+    assert int(latest.image(0)[0, 0, 0]) == 100
+
+    previous = ChipShardDataset(output_dir, key="k1")
+    assert previous.names == ["a", "b"]
+    assert int(previous.image(0)[0, 0, 0]) == 0
+
+
+def test_missing_dataset(tmp_path):
+    assert not ChipShardDataset.exists(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        ChipShardDataset(str(tmp_path))
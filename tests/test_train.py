@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+pytest.importorskip("keras")
+pytest.importorskip("cv2")
+
+from satlomasproc.unet.train import (  # noqa: E402
+    ChipSequence,
+    TrainConfig,
+    augment_batch,
+    build_chip_cache,
+    preprocess_batch,
+    preprocess_input,
+)
+from satlomasproc.unet.utils import (  # noqa: E402
+    resize,
+    resize_batch,
+    resize_weights,
+)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Dymaxion Labs"
+__license__ = "apache-2.0"
+
+TRANSFORM = from_origin(300000, 8700000, 10, 10)
+
+
+def random_chips(n, height, width, *, n_channels=3, n_classes=1, seed=0):
+    rs = np.random.RandomState(seed)
+    images = rs.randint(0, 3000, size=(n, height, width, n_channels))
+    masks = 255 * rs.randint(0, 2, size=(n, height, width, n_classes))
+    return images.astype(np.uint16), masks.astype(np.uint8)
+
+
+@pytest.mark.parametrize("size", [(32, 32), (40, 40), (30, 50), (80, 80)])
+def test_resize_batch(size):
+    images, _ = random_chips(4, 64, 64)
+    resized = resize_batch(images, size)
+    assert resized.shape == (4, *size, 3)
+    for image, expected in zip(images, resized):
+        assert np.array_equal(resize(image, size), expected)
+
+    # Constant images stay constant, and downscaling keeps the mean
+    constant = np.full((2, 64, 64, 1), 7, dtype=np.uint8)
+    assert np.allclose(resize_batch(constant, size), 7)
+    if size[0] <= 64 and size[1] <= 64:
+        assert np.allclose(resized.mean(axis=(1, 2)), images.mean(axis=(1, 2)))
+
+
+def test_resize_batch_integer_factors():
+    # Blocks are averaged, which is the same as resampling with area weights
+    images, _ = random_chips(3, 60, 90)
+    blocks = resize_batch(images, (20, 30))
+    expected = np.einsum(
+        "yh,nhwc,xw->nyxc",
+        resize_weights(60, 20),
+        images.astype(np.float64),
+        resize_weights(90, 30),
+    )
+    assert np.allclose(blocks, expected, atol=1e-3)
+    assert np.allclose(blocks[:, 0, 0], images[:, :3, :3].mean(axis=(1, 2)))
+
+
+@pytest.mark.parametrize("size", [64, 32, 40, 80])
+def test_preprocess_batch_is_same_as_preprocess_input(size):
+    config = TrainConfig(
+        images_path=None, width=size, height=size, apply_image_augmentation=False
+    )
+    images, masks = random_chips(5, 64, 64)
+    batch_images, batch_masks = preprocess_batch(images, masks, config=config)
+
+    assert batch_images.shape == (5, size, size, 3)
+    assert batch_masks.shape == (5, size, size, 1)
+    for k in range(len(images)):
+        image, mask = preprocess_input(images[k], masks[k], config=config)
+        assert np.allclose(batch_images[k], image, atol=1e-3)
+        assert np.allclose(batch_masks[k], mask, atol=1e-6)
+
+
+@pytest.mark.parametrize("shape", [(32, 32), (32, 48)])
+def test_augment_batch_is_same_as_each_chip(shape):
+    n = 40
+    images, masks = random_chips(n, *shape)
+    images = (images // 12).astype(np.uint8)
+    masks = masks.astype(np.float32) / 255
+    res_images, res_masks = augment_batch(
+        images.copy(), masks.copy(), np.random.RandomState(1)
+    )
+
+    # Same draws as augment_batch, applied to each chip
+    rs = np.random.RandomState(1)
+    if shape[0] == shape[1]:
+        factors = rs.randint(4, size=n)
+    else:
+        factors = 2 * rs.randint(2, size=n)
+    factors[rs.rand(n) >= 0.5] = 0
+    flips = rs.rand(n) < 0.5
+    idx = np.flatnonzero(rs.rand(n) < 0.2)
+    alpha = 1 + rs.uniform(-0.2, 0.2, size=len(idx))
+    beta = rs.uniform(-0.2, 0.2, size=len(idx)) * 255
+    adjust = {i: (np.float32(a), np.float32(b)) for i, a, b in zip(idx, alpha, beta)}
+
+    assert len(np.unique(factors)) > 1 and flips.any() and len(idx)
+    for k in range(n):
+        image, mask = np.rot90(images[k], factors[k]), np.rot90(masks[k], factors[k])
+        if flips[k]:
+            image, mask = image[:, ::-1], mask[:, ::-1]
+        if k in adjust:
+            a, b = adjust[k]
+            image = np.clip(image * a + b, 0, 255).astype(np.uint8)
+        assert np.array_equal(res_images[k], image)
+        assert np.array_equal(res_masks[k], mask)
+
+
+def write_chip(path, img):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=img.shape[2],
+        height=img.shape[1],
+        count=img.shape[0],
+        dtype=img.dtype,
+        crs="EPSG:32718",
+        transform=TRANSFORM,
+    ) as dst:
+        dst.write(img)
+
+
+@pytest.fixture
+def chips(tmp_path):
+    """Directory of 6 chips of 32x32 pixels and their masks"""
+    images, masks = random_chips(6, 32, 32)
+    chips_dir = tmp_path / "chips"
+    os.makedirs(chips_dir / "images")
+    os.makedirs(chips_dir / "masks")
+    paths = []
+    for k, (image, mask) in enumerate(zip(images, masks)):
+        path = str(chips_dir / "images" / f"c_{k}.tif")
+        write_chip(path, np.moveaxis(image, -1, 0))
+        write_chip(str(chips_dir / "masks" / f"c_{k}.tif"), np.moveaxis(mask, -1, 0))
+        paths.append(path)
+    return str(chips_dir), paths, images, masks
+
+
+def test_build_chip_cache(tmp_path, chips):
+    chips_dir, paths, images, masks = chips
+    mask_dir = os.path.join(chips_dir, "masks")
+    config = TrainConfig(
+        images_path=chips_dir, width=16, height=16, cache_dir=str(tmp_path / "cache")
+    )
+    cached_images, cached_masks = build_chip_cache(
+        paths, config=config, mask_dir=mask_dir
+    )
+    assert np.array_equal(cached_images, images)
+    assert np.array_equal(cached_masks, masks)
+
+    # The cache is reused while chips and settings do not change
+    images_, masks_ = build_chip_cache(paths, config=config, mask_dir=mask_dir)
+    assert images_.filename == cached_images.filename
+    assert masks_.filename == cached_masks.filename
+    assert len(os.listdir(config.cache_dir)) == 2
+
+    # The cache is built again if a mask changes
+    mask = 255 - masks[2]
+    write_chip(os.path.join(mask_dir, "c_2.tif"), np.moveaxis(mask, -1, 0))
+    images_, masks_ = build_chip_cache(paths, config=config, mask_dir=mask_dir)
+    assert masks_.filename != cached_masks.filename
+    assert np.array_equal(images_, images)
+    assert np.array_equal(masks_[2], mask)
+
+    # or if the chip size changes
+    config = attr.evolve(config, height=20, width=20)
+    images__, _ = build_chip_cache(paths, config=config, mask_dir=mask_dir)
+    assert images__.filename not in (images_.filename, cached_images.filename)
+
+
+def test_chip_sequence_is_deterministic(tmp_path, chips):
+    chips_dir, paths, _, _ = chips
+    mask_dir = os.path.join(chips_dir, "masks")
+    config = TrainConfig(
+        images_path=chips_dir,
+        width=16,
+        height=16,
+        batch_size=4,
+        seed=42,
+        cache_dir=str(tmp_path / "cache"),
+    )
+
+    def batches(seq, indexes, workers=1):
+        with ThreadPoolExecutor(workers) as executor:
+            return dict(zip(indexes, executor.map(seq.__getitem__, indexes)))
+
+    seq = ChipSequence(paths, config=config, mask_dir=mask_dir, steps=8)
+    expected = batches(seq, range(8))
+
+    # Same batches when built in any order, by several workers, or from the
+    # chip cache
+    cache = build_chip_cache(paths, config=config, mask_dir=mask_dir)
+    others = [
+        ChipSequence(paths, config=config, mask_dir=mask_dir, steps=8),
+        ChipSequence(
+            range(len(paths)), config=config, mask_dir=mask_dir, steps=8, cache=cache
+        ),
+    ]
+    for other in others:
+        for workers in (1, 3):
+            res = batches(other, [5, 2, 7, 0, 1, 6, 3, 4], workers=workers)
+            for index, (images, masks) in expected.items():
+                assert np.array_equal(res[index][0], images)
+                assert np.array_equal(res[index][1], masks)
+
+    # Batches differ between indexes and between epochs
+    assert not all(
+        np.array_equal(expected[index][0], expected[index + 1][0]) for index in range(7)
+    )
+    seq.on_epoch_end()
+    next_epoch = batches(seq, range(8))
+    assert not any(
+        np.array_equal(expected[index][0], next_epoch[index][0]) for index in range(8)
+    )
+    for other in others:
+        other.on_epoch_end()
+        res = batches(other, range(8), workers=3)
+        for index, (images, masks) in next_epoch.items():
+            assert np.array_equal(res[index][0], images)
+            assert np.array_equal(res[index][1], masks)